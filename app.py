@@ -1,9 +1,24 @@
+import logging
+import time
+
+# Startup time is measured from here, so it includes the imports of the app but not the interpreter start
+start_time = time.perf_counter()
+
 import dash
 import dash_bootstrap_components as dbc
 
+import config
+from database_controllers import registry
 from layouts import main_page_layout
 from callbacks import main_page_callbacks
+from services import figure_export
+from services import metrics
+from services import uploads
+
+imports_time = time.perf_counter()
 
+logging.basicConfig(level=config.log_level, format="%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css", dbc.themes.PULSE]
 
@@ -11,9 +26,30 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets, suppress_ca
 
 server = app.server
 
+uploads.register_routes(server)
+figure_export.register_routes(server)
+
+# Before the callbacks are registered so that they are timed
+metrics.instrument_app(app)
+
 main_page_callbacks.get_callbacks(app)
 
-app.layout = main_page_layout.get_layout()
+# A function so that every page load gets its own session-id
+app.layout = main_page_layout.get_layout
+
+startup_seconds = time.perf_counter() - start_time
+metrics.observe_stage("startup", startup_seconds)
+# The database drivers and plotly are imported on first use, see database_controllers.registry.
+# The drivers that something imported during the startup are reported with their load times
+driver_load_times = ", ".join(f"{source} {seconds:.2f}s" for source, seconds in registry.load_times().items())
+logger.info(
+    "Started in %.2fs (imports %.2fs, app setup %.2fs), data sources: %s, drivers loaded: %s",
+    startup_seconds,
+    imports_time - start_time,
+    time.perf_counter() - imports_time,
+    ", ".join(config.data_sources),
+    driver_load_times or "none, they load on first use",
+)
 
 if __name__ == "__main__":
     app.run_server(debug=False)
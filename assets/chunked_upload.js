@@ -0,0 +1,112 @@
+// Resumable chunked upload of large csv/excel files to the /uploads routes (see services/uploads.py).
+// The dataset that the file was converted to is handed to Dash through the hidden large-upload-result input.
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var MAX_RETRIES = 3;
+    var POLL_INTERVAL = 1000;
+
+    function uploadsUrl(path) {
+        // The app can be served under a path prefix, like the export links (app.get_relative_path)
+        var dashConfig = JSON.parse(document.getElementById("_dash-config").textContent);
+        return (dashConfig.requests_pathname_prefix || "/") + "uploads/" + path;
+    }
+
+    function sleep(milliseconds) {
+        return new Promise(function (resolve) { setTimeout(resolve, milliseconds); });
+    }
+
+    function randomId() {
+        var bytes = new Uint8Array(16);
+        window.crypto.getRandomValues(bytes);
+        return Array.from(bytes, function (b) { return b.toString(16).padStart(2, "0"); }).join("");
+    }
+
+    function setDashInputValue(input, value) {
+        // dcc.Input is a React component, set the value with the native setter so that React sees the change
+        var setter = Object.getOwnPropertyDescriptor(window.HTMLInputElement.prototype, "value").set;
+        setter.call(input, value);
+        input.dispatchEvent(new Event("input", { bubbles: true }));
+    }
+
+    async function sendChunk(uploadId, offset, chunk) {
+        for (var attempt = 1; ; attempt++) {
+            try {
+                var response = await fetch(uploadsUrl(uploadId + "?offset=" + offset), { method: "PUT", body: chunk });
+                // 409 means the server has less than offset bytes, continue from what it has
+                if (response.ok || response.status === 409) {
+                    return (await response.json()).received;
+                }
+                throw new Error("server responded with " + response.status);
+            } catch (err) {
+                if (attempt >= MAX_RETRIES) {
+                    throw err;
+                }
+            }
+        }
+    }
+
+    async function uploadFile(file, status) {
+        // The same file resumes the upload it started before (e.g after a network error or a page reload)
+        var resumeKey = "upload:" + file.name + ":" + file.size + ":" + file.lastModified;
+        var uploadId = window.localStorage.getItem(resumeKey) || randomId();
+        window.localStorage.setItem(resumeKey, uploadId);
+
+        var response = await fetch(uploadsUrl(uploadId));
+        var offset = (await response.json()).received;
+        while (offset < file.size) {
+            offset = await sendChunk(uploadId, offset, file.slice(offset, offset + CHUNK_SIZE));
+            status.textContent = "Uploading " + file.name + " " + Math.floor((100 * offset) / file.size) + "%";
+        }
+
+        status.textContent = "Processing " + file.name + "...";
+        response = await fetch(uploadsUrl(uploadId + "/complete"), {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ filename: file.name }),
+        });
+        window.localStorage.removeItem(resumeKey);
+        var started = await response.json();
+        if (started.error) {
+            return started;
+        }
+
+        // Large files take a while to convert, the background job is polled until it finishes
+        while (true) {
+            await sleep(POLL_INTERVAL);
+            var job = await (await fetch(uploadsUrl("jobs/" + started.job_id))).json();
+            if (job.state === "done") {
+                return job.dataset;
+            }
+            if (job.state === "error") {
+                return { error: job.error };
+            }
+            status.textContent = "Processing " + file.name + "..." + (job.progress ? " " + job.progress : "");
+        }
+    }
+
+    document.addEventListener("click", function (event) {
+        if (!event.target.closest || !event.target.closest("#large-upload-btn")) {
+            return;
+        }
+        // Dash has no file input component, open the file dialog of a detached one
+        var input = document.createElement("input");
+        input.type = "file";
+        input.accept = ".csv,.xls,.xlsx";
+        input.addEventListener("change", function () {
+            if (!input.files.length) {
+                return;
+            }
+            var file = input.files[0];
+            var status = document.getElementById("large-upload-status");
+            uploadFile(file, status)
+                .then(function (result) {
+                    status.textContent = "";
+                    setDashInputValue(document.getElementById("large-upload-result"), JSON.stringify(result));
+                })
+                .catch(function (err) {
+                    status.textContent = "Upload failed (" + err.message + "), select the file again to resume it";
+                });
+        });
+        input.click();
+    });
+})();
@@ -0,0 +1,53 @@
+// Applies the figure-update store of visualize_data (see services/figure_cache.py) to the data_graph figure.
+// The last figures are kept here by key, an update can point to one of them or be a diff of one of them.
+(function () {
+    var figures = new Map(); // key -> figure, the most recently used last
+
+    function copy(figure) {
+        // Plotly writes into the figure it draws, the kept figures stay untouched
+        return JSON.parse(JSON.stringify(figure));
+    }
+
+    function applyDiff(base, diff) {
+        var data = diff.traces.map(function (change) {
+            var trace = change.base === null ? {} : Object.assign({}, base.data[change.base]);
+            change.unset.forEach(function (key) {
+                delete trace[key];
+            });
+            return Object.assign(trace, change.set);
+        });
+        return { data: data, layout: diff.layout === null ? base.layout : diff.layout };
+    }
+
+    function keep(key, figure, size) {
+        figures.delete(key);
+        figures.set(key, figure);
+        while (figures.size > size) {
+            figures.delete(figures.keys().next().value);
+        }
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figures: {
+            apply: function (update, cache) {
+                var figure;
+                if (update.full) {
+                    figure = update.full;
+                } else if (update.diff) {
+                    figure = figures.has(update.base) ? applyDiff(figures.get(update.base), update.diff) : null;
+                } else {
+                    figure = figures.get(update.key) || null;
+                }
+                var known = { size: cache.size, keys: Array.from(figures.keys()) };
+                if (figure === null) {
+                    // The figure was dropped (e.g the page was reloaded), plotting again sends all of it
+                    return [window.dash_clientside.no_update, known];
+                }
+
+                keep(update.key, figure, cache.size);
+                known.keys = Array.from(figures.keys());
+                return [copy(figure), known];
+            },
+        },
+    });
+})();
@@ -0,0 +1,460 @@
+import argparse
+import base64
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Only the rows of the smaller sizes are uploaded as files, the browser sends them base64 encoded in one request
+MAX_UPLOAD_ROWS = {"csv": 1_000_000, "xlsx": 100_000}
+
+
+def make_dataset(rows, numeric_columns, seed=0):
+    """
+    A table with the mixed column types of real query results: ints, floats, dates, booleans, categories and text
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({f"value_{i}": rng.normal(size=rows).round(4) for i in range(numeric_columns)})
+    df.insert(0, "id", np.arange(rows, dtype="int64"))
+    df["quantity"] = rng.integers(0, 1000, rows)
+    df["created_at"] = (pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**8, rows), unit="s")).astype(
+        str
+    )
+    df["active"] = rng.random(rows) < 0.5
+    df["region"] = rng.choice(["north", "south", "east", "west"], rows)
+    df["name"] = pd.Series(rng.integers(0, 10**6, rows)).map("customer-{}".format)
+    return df
+
+
+def create_database(path, rows, numeric_columns, wide_columns):
+    """
+    Write the "orders" table (numeric_columns float columns) and the "wide" table (wide_columns float columns)
+    of rows rows to a SQLite file, block by block so that 10M rows fit in memory
+    """
+    block_rows = 500_000
+    with sqlite3.connect(path) as conn:
+        for table, columns in [("orders", numeric_columns), ("wide", wide_columns)]:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            for seed, start in enumerate(range(0, rows, block_rows)):
+                block = make_dataset(min(block_rows, rows - start), columns, seed)
+                block["id"] += start
+                block.to_sql(table, conn, if_exists="append", index=False)
+
+
+class PeakMemory:
+    """
+    Context manager that samples the resident memory of the process in a thread and keeps the peak
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs (e.g macOS), the peak of the whole run is the best we have
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class CallbackClient:
+    """
+    Calls the callbacks of the app through /_dash-update-component like the browser does,
+    so the timings include the JSON serialization of the inputs and outputs
+    """
+
+    def __init__(self, server):
+        self.client = server.test_client()
+        self.response_bytes = 0
+
+    def call(self, outputs, inputs, state=(), changed=None):
+        """
+        outputs is a list of "id.property", inputs and state lists of (id, property, value) in the order
+        of the callback. Returns a dictionary with the outputs ({id: {property: value}}), None if nothing changed.
+        """
+        output_specs = [{"id": output.split(".")[0], "property": output.split(".")[1]} for output in outputs]
+        body = {
+            "output": f"..{'...'.join(outputs)}.." if len(outputs) > 1 else outputs[0],
+            "outputs": output_specs if len(outputs) > 1 else output_specs[0],
+            "inputs": [{"id": id_, "property": prop, "value": value} for id_, prop, value in inputs],
+            "state": [{"id": id_, "property": prop, "value": value} for id_, prop, value in state],
+            "changedPropIds": changed or [f"{inputs[0][0]}.{inputs[0][1]}"],
+        }
+        response = self.client.post("/_dash-update-component", json=body)
+        self.response_bytes += len(response.data)
+        if response.status_code == 204:
+            return None
+        if response.status_code != 200:
+            raise RuntimeError(f"{outputs} failed with status {response.status_code}")
+        return json.loads(response.data)["response"]
+
+
+class Scenarios:
+    """
+    The callback hot paths, each method runs one of them once
+    """
+
+    def __init__(self, client, database_path):
+        self.client = client
+        self.db_config = {"database": database_path}
+        self.data = {}  # table -> db-data of its query
+
+    def _update_db_data(
+        self, changed, table_name=None, query=None, upload_dataset=None, data_source="sqlite", preview_mode="first"
+    ):
+        outputs = [
+            "db-data.data",
+            "query-error.children",
+            "query-job.data",
+            "query-poll.disabled",
+            "query-progress.children",
+            "script-data.data",
+        ]
+        query_job = None
+        n_intervals = 0
+        while True:
+            inputs = [
+                ("tables-dropdown", "value", table_name),
+                ("query-admitted", "data", {"query": query, "id": "benchmark"}),
+                ("run_script_btn", "n_clicks", 0),
+                ("upload-dataset", "data", upload_dataset),
+                ("query-poll", "n_intervals", n_intervals),
+                ("script-results", "value", None),
+            ]
+            state = [
+                ("query", "value", query),
+                ("database-config", "data", self.db_config),
+                ("data_source", "value", data_source),
+                ("session-id", "data", "benchmark"),
+                ("query-job", "data", query_job),
+                ("script-data", "data", None),
+                ("db-data", "data", None),
+                ("preview-mode", "value", preview_mode),
+                ("preview-size", "value", 1000),
+                ("snapshots", "data", None),
+            ]
+            response = self.client.call(outputs, inputs, state, [changed])
+            if response is not None and "db-data" in response:
+                data = response["db-data"]["data"]
+                if data is None:
+                    raise RuntimeError(f"The query failed: {response['query-error']['children']}")
+                return data
+            if response is not None and "query-job" in response:
+                query_job = response["query-job"]["data"]
+            # The browser polls every config.job_poll_interval ms, poll right away to time the query itself
+            time.sleep(0.001)
+            changed = "query-poll.n_intervals"
+            n_intervals += 1
+
+    def query(self, table):
+        self.data[table] = self._update_db_data("query-admitted.data", query=f"SELECT * FROM {table}")
+
+    def table_preview(self, preview_mode="first"):
+        self.data["preview"] = self._update_db_data(
+            "tables-dropdown.value", table_name="orders", preview_mode=preview_mode
+        )
+
+    def show_datatable(self, table):
+        self.client.call(["datatable.children"], [("db-data", "data", self.data[table])])
+
+    def column_profile(self, table):
+        self.client.call(
+            ["column-profile.children", "plot-suggestions.children", "plot-suggestions-data.data"],
+            [("db-data", "data", self.data[table])],
+        )
+
+    def datatable_page(self, table, sort_by=(), filter_query=""):
+        self.client.call(
+            ["results-table.data", "results-table.page_count", "datatable-message.children"],
+            [
+                ("results-table", "page_current", 3),
+                ("results-table", "page_size", 10),
+                ("results-table", "sort_by", list(sort_by)),
+                ("results-table", "filter_query", filter_query),
+            ],
+            [
+                ("db-data", "data", self.data[table]),
+                ("database-config", "data", self.db_config),
+                ("data_source", "value", "sqlite"),
+            ],
+        )
+
+    def plot(self, plot_type, x, y, group=None, aggregation="none", cached=None):
+        """
+        cached is None to build the figure, "server" to use the figure cache of the server
+        and "browser" to have the browser already keep the figure
+        """
+        from services import figure_cache
+
+        client_keys = []
+        if cached is None:
+            figure_cache.clear()
+        elif cached == "browser":
+            client_keys = [
+                figure_cache.figure_key(self.data["orders"]["result_id"], plot_type, x, y, group, aggregation)
+            ]
+        self.client.call(
+            ["figure-update.data", "plot-notice.children", "plot-params.data"],
+            [("plot_btn", "n_clicks", 1), ("data_graph", "relayoutData", None)],
+            [
+                ("db-data", "data", self.data["orders"]),
+                ("plot_type", "value", plot_type),
+                ("plot_x_axis", "value", x),
+                ("plot_y_axis", "value", y),
+                ("plot_group_by_col", "value", group),
+                ("plot-aggregation", "value", aggregation),
+                ("plot-params", "data", None),
+                ("figure-client-cache", "data", {"size": 5, "keys": client_keys}),
+                ("database-config", "data", self.db_config),
+                ("data_source", "value", "sqlite"),
+            ],
+        )
+
+    def upload(self, contents, filename):
+        response = self.client.call(
+            ["upload-dataset.data", "upload-data.contents"],
+            [("upload-data", "contents", contents), ("large-upload-result", "value", None)],
+            [("upload-data", "filename", filename)],
+        )
+        upload_dataset = response["upload-dataset"]["data"]
+        if "error" in upload_dataset:
+            raise RuntimeError(upload_dataset["error"])
+        # The uploaded file becomes the result that the table and the plots show
+        self._update_db_data("upload-dataset.data", upload_dataset=upload_dataset, data_source="csv")
+
+
+def file_contents(df, file_format):
+    if file_format == "csv":
+        content, mimetype = df.to_csv(index=False).encode(), "text/csv"
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"benchmark-{os.getpid()}.xlsx")
+        df.to_excel(path, index=False)
+        with open(path, "rb") as f:
+            content = f.read()
+        os.remove(path)
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    return f"data:{mimetype};base64,{base64.b64encode(content).decode()}"
+
+
+def measure(client, func, repeat):
+    """
+    Run func repeat times (after one warm up run) and return its latency percentiles,
+    the peak resident memory and the bytes of the callback responses
+    """
+    func()
+    times = []
+    response_bytes = []
+    with PeakMemory() as memory:
+        for _ in range(repeat):
+            client.response_bytes = 0
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+            response_bytes.append(client.response_bytes)
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return {
+        "p50_ms": p50 * 1000,
+        "p95_ms": p95 * 1000,
+        "p99_ms": p99 * 1000,
+        "peak_rss_mb": memory.peak / 1024 / 1024,
+        "payload_kb": float(np.median(response_bytes)) / 1024,
+    }
+
+
+def run(rows, args, directory):
+    import app
+    from services import profiling
+
+    database_path = os.path.join(directory, f"benchmark-{rows}.sqlite")
+    create_database(database_path, rows, args.columns, args.wide_columns)
+    client = CallbackClient(app.server)
+    scenarios = Scenarios(client, database_path)
+
+    cases = [
+        ("update_db_data query", lambda: scenarios.query("orders")),
+        ("update_db_data wide query", lambda: scenarios.query("wide")),
+        ("update_db_data table sample", lambda: scenarios.table_preview("sample")),
+        ("update_db_data table preview", scenarios.table_preview),
+        ("show_datatable", lambda: scenarios.show_datatable("orders")),
+        ("show_datatable wide", lambda: scenarios.show_datatable("wide")),
+        # The profile is computed by the warm up run, these measure the cached profile and the suggestions
+        ("show_column_profile", lambda: scenarios.column_profile("orders")),
+        ("show_column_profile wide", lambda: scenarios.column_profile("wide")),
+        ("update_datatable_page", lambda: scenarios.datatable_page("orders")),
+        (
+            "update_datatable_page sort+filter",
+            lambda: scenarios.datatable_page(
+                "orders", [{"column_id": "value_0", "direction": "desc"}], "{region} = north"
+            ),
+        ),
+        (
+            "update_datatable_page sort pushdown",
+            lambda: scenarios.datatable_page("preview", [{"column_id": "value_0", "direction": "desc"}]),
+        ),
+        ("update_datatable_page wide", lambda: scenarios.datatable_page("wide")),
+        ("visualize_data scatter", lambda: scenarios.plot("scatter", "value_0", "value_1")),
+        ("visualize_data scatter cached", lambda: scenarios.plot("scatter", "value_0", "value_1", cached="server")),
+        (
+            "visualize_data scatter in browser",
+            lambda: scenarios.plot("scatter", "value_0", "value_1", cached="browser"),
+        ),
+        ("visualize_data line", lambda: scenarios.plot("line", "id", "value_0", "region")),
+        ("visualize_data bar", lambda: scenarios.plot("bar", "region", "quantity")),
+        ("visualize_data bar avg pushdown", lambda: scenarios.plot("bar", "region", "quantity", aggregation="avg")),
+    ]
+
+    results = {}
+    for name, func in cases:
+        results[f"{name} @ {rows:,}"] = measure(client, func, args.repeat)
+        print(f"  {name}", file=sys.stderr)
+
+    df = make_dataset(rows, args.columns)
+    results[f"profiling.profile_dataframe @ {rows:,}"] = measure(
+        client, lambda: profiling.profile_dataframe(df), args.repeat
+    )
+    print("  profiling.profile_dataframe", file=sys.stderr)
+
+    for file_format in ["csv", "xlsx"]:
+        if rows > MAX_UPLOAD_ROWS[file_format]:
+            continue
+        if file_format == "xlsx" and not _has_module("openpyxl"):
+            print("  skipping the xlsx upload, openpyxl is not installed", file=sys.stderr)
+            continue
+        contents = file_contents(df, file_format)
+        name = f"upload.{file_format}"
+        results[f"csv_excel.parse_contents {file_format} @ {rows:,}"] = measure(
+            client, lambda: scenarios.upload(contents, name), args.repeat
+        )
+        print(f"  csv_excel.parse_contents {file_format}", file=sys.stderr)
+
+    os.remove(database_path)
+    return results
+
+
+def _has_module(name):
+    import importlib.util
+
+    return importlib.util.find_spec(name) is not None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of every benchmark against the baseline and return the ones that got slower than threshold
+    """
+    regressions = []
+    rows = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append([name, None, result["p50_ms"], None, None, result["peak_rss_mb"], result["payload_kb"], "new"])
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0
+        status = "ok"
+        if change > threshold:
+            status = "SLOWER"
+            regressions.append(name)
+        elif change < -threshold:
+            status = "faster"
+        rows.append(
+            [
+                name,
+                base["p50_ms"],
+                result["p50_ms"],
+                change * 100,
+                base["peak_rss_mb"],
+                result["peak_rss_mb"],
+                result["payload_kb"],
+                status,
+            ]
+        )
+    columns = ["benchmark", "base p50 ms", "p50 ms", "change %", "base rss mb", "rss mb", "payload kb", ""]
+    print(pd.DataFrame(rows, columns=columns).to_string(index=False, float_format="{:.1f}".format, na_rep="-"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the callbacks of the app on synthetic data")
+    parser.add_argument("--rows", default="1000,100000,1000000", help="Comma separated dataset sizes, up to 10M")
+    parser.add_argument("--columns", type=int, default=10, help="Number of float columns of the orders table")
+    parser.add_argument("--wide-columns", type=int, default=200, help="Number of float columns of the wide table")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs of every benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Path of the baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare the results with the baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative p50 increase that counts as a regression"
+    )
+    args = parser.parse_args()
+
+    # Before the app is imported: the jobs run in this process so their memory is measured,
+    # and the query cache must not answer the repeated queries
+    os.environ.setdefault("JOB_EXECUTOR", "thread")
+    os.environ["QUERY_CACHE_TTL"] = "0"
+    directory = tempfile.mkdtemp(prefix="dashproject-benchmark-")
+    os.environ.setdefault("SHARED_STATE_DIR", directory)
+
+    import config
+    from benchmarks import sqlite
+
+    sqlite.register(config)
+
+    results = {}
+    for rows in [int(size) for size in args.rows.split(",")]:
+        print(f"{rows:,} rows", file=sys.stderr)
+        results.update(run(rows, args, directory))
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        table = pd.DataFrame.from_dict(results, orient="index")
+        print(table.to_string(float_format="{:.1f}".format))
+        regressions = []
+
+    if args.save_baseline:
+        baseline = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "results": results,
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+    if regressions:
+        sys.exit(f"{len(regressions)} benchmarks are more than {args.threshold:.0%} slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
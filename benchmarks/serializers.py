@@ -0,0 +1,64 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from services import serializers
+
+
+def make_result(rows, numeric_columns):
+    """
+    A wide query result with the column types that JSON loses: ints, dates, categoricals and text
+    """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({f"value_{i}": rng.random(rows) for i in range(numeric_columns)})
+    df["id"] = np.arange(rows, dtype="int64")
+    df["created_at"] = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**8, rows), unit="s")
+    df["category"] = pd.Categorical(rng.choice(["north", "south", "east", "west"], rows))
+    df["name"] = pd.Series(rng.integers(0, 10**6, rows)).map("customer-{}".format)
+    return df
+
+
+def run(name, df, directory, compression, repeat):
+    path = os.path.join(directory, f"result.{serializers.extension(name)}")
+    encode_times = []
+    decode_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        serializers.write(name, df, path, compression)
+        encode_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        loaded = serializers.read(name, path)
+        decode_times.append(time.perf_counter() - start)
+
+    lost_dtypes = [col for col in df.columns if str(loaded[col].dtype) != str(df[col].dtype)]
+    return {
+        "serializer": name if name == "json" or not compression else f"{name}+{compression}",
+        "size_mb": os.path.getsize(path) / 1024 / 1024,
+        "encode_s": min(encode_times),
+        "decode_s": min(decode_times),
+        "lost_dtypes": ", ".join(lost_dtypes) or "-",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the serializers of query results")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--columns", type=int, default=20, help="Number of float columns")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_result(args.rows, args.columns)
+    print(f"{args.rows:,} rows, {len(df.columns)} columns, {df.memory_usage(deep=True).sum() / 1024 / 1024:.1f} MB")
+    with tempfile.TemporaryDirectory() as directory:
+        results = [run(name, df, directory, None, args.repeat) for name in serializers.SERIALIZERS]
+        results += [run(name, df, directory, "zstd", args.repeat) for name in ["parquet", "arrow"]]
+    print(pd.DataFrame(results).to_string(index=False, float_format="{:.3f}".format))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import contextlib
+import sqlite3
+
+from database_controllers import streaming
+
+# Name of the data source the benchmarks add to config
+DATA_SOURCE = "sqlite"
+
+
+def _connect(config):
+    # The jobs read the database from the threads of the job executor
+    return sqlite3.connect(config["database"], check_same_thread=False)
+
+
+@contextlib.contextmanager
+def connection(config):
+    """
+    Context manager with a connection to the SQLite file in config, SQLite connections are too cheap to pool
+    """
+    conn = _connect(config)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def connect(host, user, password, database):
+    """
+    Same interface as the controllers of the real databases, database is the path of the SQLite file
+    """
+    sqlite_info = {"database": database}
+    with connection(sqlite_info) as conn:
+        conn.execute("SELECT 1")
+
+    return sqlite_info
+
+
+def list_tables(config):
+    # SQLite has no row estimates without ANALYZE
+    with connection(config) as conn:
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+        return [(x[0], None) for x in cursor]
+
+
+def table_columns(config, table):
+    with connection(config) as conn:
+        return [(column[1], column[2]) for column in conn.execute(f"PRAGMA table_info('{table}')")]
+
+
+def execute_query(config, query, params=None):
+    with connection(config) as conn:
+        cursor = conn.execute(query, params or ())
+        columns = [i[0] for i in cursor.description]
+        results = cursor.fetchall()
+
+    return columns, results
+
+
+def stream_query(config, query, max_rows, max_bytes, query_token=None, on_batch=None):
+    with connection(config) as conn:
+        cursor = conn.execute(query)
+        return streaming.fetch_dataframe(cursor, max_rows, max_bytes, on_batch)
+
+
+def sample_table(config, table, sample_size, row_estimate, scan_max_rows, query_token=None, on_batch=None):
+    # No sampling in SQLite, the table is read whole
+    with connection(config) as conn:
+        cursor = conn.execute(f'SELECT * FROM "{table}"')
+        df, _ = streaming.reservoir_dataframe(cursor, sample_size, on_batch)
+    return df, "reservoir sampling of a full scan"
+
+
+@contextlib.contextmanager
+def session_connection(config):
+    """
+    Connection for the statements of a script that share session state, every statement is committed
+    """
+    conn = _connect(config)
+    conn.isolation_level = None
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def execute_statement(conn, query, max_rows, max_bytes, query_token=None):
+    cursor = conn.execute(query)
+    if cursor.description is None:
+        return None, False, cursor.rowcount
+    df, truncated = streaming.fetch_dataframe(cursor, max_rows, max_bytes)
+    return df, truncated, len(df)
+
+
+def cancel_query(config, backend_id):
+    pass  # The benchmarks don't cancel queries
+
+
+def register(config):
+    """
+    Add SQLite to the data sources of config (the module), as if it was one of the databases.
+    There is no freshness function, so its query results are never cached and every query runs.
+    """
+    if DATA_SOURCE not in config.database_sources:
+        config.database_sources.append(DATA_SOURCE)
+        config.data_sources.append(DATA_SOURCE)
+    config.database_connection_functions[DATA_SOURCE] = connect
+    config.database_execute_functions[DATA_SOURCE] = execute_query
+    config.database_stream_functions[DATA_SOURCE] = stream_query
+    config.database_cancel_functions[DATA_SOURCE] = cancel_query
+    config.database_session_functions[DATA_SOURCE] = session_connection
+    config.database_statement_functions[DATA_SOURCE] = execute_statement
+    config.database_tables_functions[DATA_SOURCE] = list_tables
+    config.database_columns_functions[DATA_SOURCE] = table_columns
+    config.database_sample_functions[DATA_SOURCE] = sample_table
+    config.database_sql_dialects[DATA_SOURCE] = {"quote": '"', "placeholder": "?", "text_type": "TEXT"}
@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+import pytest
+
+import config
+from services import admission
+
+
+def _ticket(name, identity, state, slots=None):
+    ticket = {"path": name, "identity": identity, "state": state}
+    if slots is not None:
+        ticket["slots"] = slots
+    return ticket
+
+
+def test_connections_with_fewer_running_queries_go_first(monkeypatch):
+    monkeypatch.setattr(config, "admission_max_queries", 4)
+    monkeypatch.setattr(config, "admission_max_queries_per_connection", 0)
+    tickets = [
+        _ticket("1", "a", "running"),
+        _ticket("2", "a", "waiting"),
+        _ticket("3", "b", "waiting"),
+    ]
+    assert admission._next_ticket(tickets) == "3"
+    assert admission._next_ticket(tickets[:2]) == "2"
+
+
+def test_no_ticket_when_the_slots_are_taken(monkeypatch):
+    monkeypatch.setattr(config, "admission_max_queries", 2)
+    monkeypatch.setattr(config, "admission_max_queries_per_connection", 0)
+    tickets = [_ticket("1", "a", "running"), _ticket("2", "b", "running"), _ticket("3", "c", "waiting")]
+    assert admission._next_ticket(tickets) is None
+    assert admission._next_ticket([_ticket("1", "a", "waiting")]) == "1"
+
+
+def test_tickets_take_a_slot_per_connection(monkeypatch):
+    monkeypatch.setattr(config, "admission_max_queries", 4)
+    monkeypatch.setattr(config, "admission_max_queries_per_connection", 3)
+    tickets = [
+        _ticket("1", "a", "running", slots=2),
+        _ticket("2", "a", "waiting", slots=2),
+        _ticket("3", "b", "waiting", slots=3),
+        _ticket("4", "a", "waiting"),
+    ]
+    # 2 would go over the limit of connection a, 3 over the total, 4 fits
+    assert admission._next_ticket(tickets) == "4"
+
+
+def test_per_connection_limit(monkeypatch):
+    monkeypatch.setattr(config, "admission_max_queries", 0)
+    monkeypatch.setattr(config, "admission_max_queries_per_connection", 1)
+    tickets = [_ticket("1", "a", "running"), _ticket("2", "a", "waiting")]
+    assert admission._next_ticket(tickets) is None
+    assert admission._next_ticket(tickets + [_ticket("3", "b", "waiting")]) == "3"
+
+
+def test_queries_of_web_requests_dont_wait_long(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "shared_state_dir", str(tmp_path))
+    monkeypatch.setattr(config, "admission_max_queries", 1)
+    monkeypatch.setattr(config, "admission_queue_timeout", 300)
+    monkeypatch.setattr(config, "admission_request_timeout", 0.3)
+    monkeypatch.setattr(config, "admission_poll_interval", 0.05)
+    monkeypatch.setattr(config, "database_sources", config.database_sources + ["fake"])
+    monkeypatch.setitem(config.database_execute_functions, "fake", lambda db_config, query, params: ([], []))
+
+    assert admission.execute_query("fake", {}, "SELECT 1") == ([], [])
+    # Another query holds the only slot
+    running = {"identity": "other", "pid": os.getpid(), "state": "running", "slots": 1}
+    with open(os.path.join(admission._admission_dir(), "0-running.json"), "w") as f:
+        json.dump(running, f)
+    start = time.monotonic()
+    with pytest.raises(admission.AdmissionError):
+        admission.execute_query("fake", {}, "SELECT 1")
+    assert time.monotonic() - start < 5
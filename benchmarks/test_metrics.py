@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+import config
+from services import metrics
+
+
+def _write_state(name, rows):
+    state = {"counters": [["database_call_rows_total", [], rows]], "histograms": []}
+    with open(os.path.join(metrics._metrics_dir(), name), "w") as f:
+        json.dump(state, f)
+
+
+def test_files_of_exited_processes_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "shared_state_dir", str(tmp_path))
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    exited_file = f"{exited.stdout.strip()}-00000000.json"
+    _write_state(exited_file, 5)
+    _write_state(f"{os.getpid()}-11111111.json", 7)
+
+    lines = metrics.render().splitlines()
+    assert "database_call_rows_total 7" in lines
+    assert exited_file not in os.listdir(metrics._metrics_dir())
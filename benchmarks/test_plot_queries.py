@@ -0,0 +1,43 @@
+import pytest
+
+import config
+from services import plot_queries
+
+DIALECTS = config.database_sql_dialects
+
+
+def test_source_relation():
+    assert plot_queries.source_relation({"source_table": "my`table"}, "`") == "`my``table`"
+    assert plot_queries.source_relation({"source_query": "SHOW TABLES"}, "`") is None
+    relation = plot_queries.source_relation({"source_query": "SELECT * FROM t; -- all of t"}, '"')
+    assert relation == "(\nSELECT * FROM t\n) AS source_rows"
+
+
+def test_queries_that_end_with_a_comment():
+    duckdb = pytest.importorskip("duckdb")
+    data = {"source_query": "SELECT 1 AS x, 2 AS y -- the comment of the user"}
+    relation = plot_queries.source_relation(data, '"')
+    query, params = plot_queries.build_aggregate_query(relation, "bar", "x", "y", None, "sum", DIALECTS["csv"], 10)
+    assert duckdb.sql(query).fetchall() == [(1, 2)]
+
+
+def test_aggregate_query_parameters():
+    args = ("t", "bar", "x", "y", "g", "sum")
+    query, params = plot_queries.build_aggregate_query(*args, DIALECTS["postgres"], 100)
+    assert params is None
+    assert query.startswith('SELECT "x" AS "x", "g", SUM("y")')
+
+    relation = "(SELECT * FROM t WHERE name LIKE 'a%') AS source"
+    query, params = plot_queries.build_aggregate_query(
+        relation, "histogram", "x", None, None, "count", DIALECTS["mysql"], 100, x_range=(0, 50)
+    )
+    assert params == [0, 50 / config.plot_histogram_bins]
+    # The % of the source query is escaped for the %s placeholders of the driver
+    assert "LIKE 'a%%'" in query
+    assert query.count("%s") == 2
+
+    query, params = plot_queries.build_aggregate_query(
+        relation, "histogram", "x", None, None, "count", DIALECTS["mariadb"], 100, x_range=(0, 50)
+    )
+    assert "LIKE 'a%'" in query
+    assert query.count("?") == 2
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+import config
+from services import plots
+
+
+def test_lttb_keeps_the_ends_and_the_peaks():
+    x = np.arange(1000, dtype=float)
+    y = np.zeros(1000)
+    y[[250, 700]] = [10, -10]
+    positions = plots.lttb(x, y, 50)
+    assert len(positions) == 50
+    assert positions[0] == 0 and positions[-1] == 999
+    assert (np.diff(positions) > 0).all()
+    assert {250, 700} <= set(positions.tolist())
+
+
+def test_lttb_keeps_short_lines():
+    x = np.arange(10, dtype=float)
+    assert plots.lttb(x, x, 20).tolist() == list(range(10))
+    assert plots.lttb(x, x, 2).tolist() == list(range(10))
+
+
+def test_minmax_keeps_the_lowest_and_highest_points():
+    y = np.sin(np.linspace(0, 20 * np.pi, 10_000))
+    y[1234] = 5
+    positions = plots.minmax(y, 100)
+    assert len(positions) <= 100
+    assert (np.diff(positions) > 0).all()
+    assert 1234 in positions
+    assert y[positions].min() == y.min()
+    assert plots.minmax(y[:10], 100).tolist() == list(range(10))
+
+
+def test_downsampled_lines_of_every_group(monkeypatch):
+    monkeypatch.setattr(config, "plot_line_downsampling", "lttb")
+    df = pd.DataFrame({"x": np.tile(np.arange(1000), 2), "y": np.arange(2000.0), "g": ["a"] * 1000 + ["b"] * 1000})
+    sampled = plots._downsample_line(df, "x", "y", "g", 100)
+    assert sampled.groupby("g").size().tolist() == [50, 50]
+    assert sampled.groupby("g")["x"].agg(["min", "max"]).values.tolist() == [[0, 999], [0, 999]]
+
+
+def test_text_lines_are_downsampled_evenly():
+    df = pd.DataFrame({"x": np.arange(1000), "y": [f"label {i % 7}" for i in range(1000)]})
+    sampled = plots._downsample_line(df, "x", "y", None, 11)
+    assert sampled["x"].tolist() == [0, 99, 199, 299, 399, 499, 599, 699, 799, 899, 999]
+    assert len(plots._downsample_line(df.head(5), "x", "y", None, 11)) == 5
+
+
+def test_histogram_of_dates():
+    df = pd.DataFrame({"t": pd.date_range("2024-01-01", periods=100, freq="h")})
+    aggregated = plots.aggregate(df, "histogram", "t", None, None, "count")
+    assert aggregated["count"].sum() == 100
+    assert aggregated["t"].min() == pd.Timestamp("2024-01-01")
+    assert aggregated["t"].max() < pd.Timestamp("2024-01-05 04:00")
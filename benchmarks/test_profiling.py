@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from services import profiling
+
+
+def test_distinct_counts_are_exact_for_few_values():
+    df = pd.DataFrame({"a": np.arange(1000) % 100, "b": ["x", "y"] * 500})
+    profile = profiling.profile_dataframe(df)
+    assert abs(profile["columns"]["a"]["distinct"] - 100) <= 1
+    assert profile["columns"]["b"]["distinct"] == 2
+
+
+def test_distinct_counts_of_many_values_are_estimated():
+    df = pd.DataFrame({"a": np.arange(200_000), "b": np.arange(200_000) // 4})
+    profile = profiling.profile_dataframe(df, chunk_rows=30_000)
+    assert abs(profile["columns"]["a"]["distinct"] - 200_000) / 200_000 < 0.03
+    assert abs(profile["columns"]["b"]["distinct"] - 50_000) / 50_000 < 0.03
+
+
+def test_chunks_dont_change_the_profile():
+    df = pd.DataFrame({"a": np.arange(50_000) % 7_000, "b": np.linspace(0, 1, 50_000)})
+    assert profiling.profile_dataframe(df, chunk_rows=1_000) == profiling.profile_dataframe(df, chunk_rows=50_000)
+
+
+def test_quantiles_and_histogram_without_sampling():
+    df = pd.DataFrame({"a": np.arange(1001, dtype=float)})
+    column = profiling.profile_dataframe(df, sample_size=5_000)["columns"]["a"]
+    assert column["quantiles"] == [50.0, 250.0, 500.0, 750.0, 950.0]
+    assert (column["min"], column["max"]) == (0.0, 1000.0)
+    assert sum(column["histogram"]) == 1001
+
+
+def test_quantiles_of_a_sample_are_close():
+    df = pd.DataFrame({"a": np.arange(100_000, dtype=float), "n": [None] * 50_000 + [1.0] * 50_000})
+    profile = profiling.profile_dataframe(df, sample_size=10_000)
+    column = profile["columns"]["a"]
+    for quantile, value in zip(profiling.QUANTILES, column["quantiles"]):
+        assert abs(value - quantile * 99_999) < 2_000
+    assert sum(column["histogram"]) == 100_000
+    assert profile["columns"]["n"]["null_fraction"] == 0.5
+    # The same rows are sampled every time
+    assert profiling.profile_dataframe(df, sample_size=10_000) == profile
+
+
+def test_datetime_quantiles():
+    df = pd.DataFrame({"t": pd.date_range("2024-01-01", periods=5, freq="D")})
+    column = profiling.profile_dataframe(df)["columns"]["t"]
+    assert column["kind"] == "datetime"
+    assert column["quantiles"][2] == "2024-01-03T00:00:00"
+    assert column["histogram"][0] == 1 and sum(column["histogram"]) == 5
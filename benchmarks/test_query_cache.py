@@ -0,0 +1,57 @@
+import config
+from services import query_cache
+
+DB_CONFIG = {"host": "db", "user": "app", "password": "secret", "database": "app"}
+
+
+def _versions(versions):
+    return lambda db_config, tables: {table: versions.get(table) for table in tables}
+
+
+def test_referenced_tables():
+    assert query_cache.referenced_tables("SELECT * FROM a") == ["a"]
+    assert query_cache.referenced_tables("SELECT * FROM a x, b AS y JOIN c ON x.id = c.id") == ["a", "b", "c"]
+    assert query_cache.referenced_tables("SELECT * FROM db.a, `b`") == ["b", "db.a"]
+
+
+def test_referenced_tables_of_subqueries():
+    query = "SELECT * FROM (SELECT id FROM a, b) s, c WHERE id IN (SELECT id FROM d)"
+    assert query_cache.referenced_tables(query) == ["a", "b", "c", "d"]
+
+
+def test_from_of_function_calls_is_not_a_table():
+    query = "SELECT EXTRACT(YEAR FROM created), TRIM(LEADING 'x' FROM name) FROM a"
+    assert query_cache.referenced_tables(query) == ["a"]
+
+
+def test_unknown_tables():
+    assert query_cache.referenced_tables("SELECT * FROM generate_series(1, 3)") is None
+    assert query_cache.referenced_tables("SELECT * FROM a, LATERAL (SELECT * FROM b WHERE b.id = a.id) c") is None
+
+
+def test_only_selects_of_probed_tables_are_cached(monkeypatch):
+    monkeypatch.setitem(config.database_freshness_functions, "mysql", _versions({"a": 1, "db.b": 2}))
+    assert query_cache.freshness("mysql", DB_CONFIG, "SELECT * FROM a JOIN db.b USING (id)") is not None
+    # A view or a table without an update time
+    assert query_cache.freshness("mysql", DB_CONFIG, "SELECT * FROM a, v") is None
+    for query in ["SELECT NOW()", "SELECT RAND() FROM a", "SELECT * FROM a WHERE day = CURRENT_DATE", "SHOW TABLES"]:
+        assert query_cache.freshness("mysql", DB_CONFIG, query) is None
+    assert query_cache.freshness("mysql", DB_CONFIG, "SELECT 'now' FROM a") is not None
+
+
+def test_results_without_freshness_are_not_cached(monkeypatch):
+    monkeypatch.setattr(query_cache, "_cache", query_cache.QueryCache(ttl=600, max_bytes=1024))
+    data = {"result_id": "r", "bytes": 1}
+    query_cache.store("mysql", DB_CONFIG, "SELECT NOW()", data, None)
+    query_cache.store("mysql", DB_CONFIG, "SELECT * FROM a", data, None)
+    assert query_cache.stats()["entries"] == 0
+    query_cache.store("mysql", DB_CONFIG, "SELECT * FROM a", data, "[]")
+    assert query_cache.stats()["entries"] == 1
+
+
+def test_cache_key_has_the_password():
+    query = "SELECT * FROM a"
+    other_password = {**DB_CONFIG, "password": "wrong"}
+    assert query_cache.cache_key("mysql", DB_CONFIG, query) != query_cache.cache_key("mysql", other_password, query)
+    assert "secret" not in query_cache.cache_key("mysql", DB_CONFIG, query)
+    assert query_cache.cache_key("mysql", DB_CONFIG, query) == query_cache.cache_key("mysql", DB_CONFIG, query + " ;")
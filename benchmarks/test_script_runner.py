@@ -0,0 +1,80 @@
+import sqlite3
+
+import config
+from benchmarks import sqlite
+from services import script_runner
+
+
+def test_split_statements_outside_quotes_and_comments():
+    script = """
+        SELECT 'a;b', "c;d" FROM t; -- comment; here
+        # mysql comment;
+        SELECT `e;f` /* block; comment */ FROM u;;
+        SELECT 'it\\'s;' FROM v
+    """
+    assert script_runner.split_statements(script) == [
+        "SELECT 'a;b', \"c;d\" FROM t",
+        "SELECT `e;f`   FROM u",
+        "SELECT 'it\\'s;' FROM v",
+    ]
+
+
+def test_split_statements_without_mysql_syntax():
+    script = "SELECT 1 # not a comment; SELECT 'a\\'; SELECT 2"
+    assert script_runner.split_statements(script, mysql_syntax=False) == [
+        "SELECT 1 # not a comment",
+        "SELECT 'a\\'",
+        "SELECT 2",
+    ]
+
+
+def _plan(*statements):
+    return [(step["session"], step["depends_on"]) for step in script_runner.plan_statements(list(statements))]
+
+
+def test_independent_reads_run_in_parallel():
+    assert _plan("SELECT * FROM a", "SELECT * FROM b JOIN c ON b.id = c.id") == [(False, []), (False, [])]
+
+
+def test_writes_wait_for_the_reads_of_their_table():
+    plan = _plan(
+        "SELECT * FROM a",
+        "SELECT * FROM b",
+        "UPDATE a SET x = 1",
+        "SELECT * FROM a",
+        "INSERT INTO c SELECT * FROM b",
+        "DELETE FROM b",
+    )
+    assert plan == [(False, []), (False, []), (True, [0]), (True, [2]), (True, [3]), (True, [1, 4])]
+
+
+def test_everything_after_session_changes_runs_in_order():
+    plan = _plan("SELECT * FROM b", "SET @x = 1", "SELECT * FROM a WHERE id = @x", "SELECT * FROM b")
+    assert plan == [(False, []), (True, []), (True, [1]), (True, [2])]
+    assert _plan("USE other", "SELECT * FROM t") == [(True, []), (True, [0])]
+    assert _plan("SET search_path TO analytics", "SELECT * FROM t") == [(True, []), (True, [0])]
+    assert _plan("BEGIN", "SELECT * FROM t", "COMMIT") == [(True, []), (True, [0]), (True, [1])]
+
+
+def test_everything_after_unknown_statements_runs_in_order():
+    plan = _plan("SELECT * FROM a", "CALL refresh()", "SELECT * FROM b")
+    assert plan == [(False, []), (True, [0]), (True, [1])]
+
+
+def test_reads_of_unknown_tables():
+    plan = _plan("SELECT * FROM generate_series(1, 3)", "DELETE FROM a", "SELECT * FROM generate_series(1, 3)")
+    assert plan == [(False, []), (True, [0]), (True, [1])]
+
+
+def test_script_writes_are_committed(tmp_path):
+    sqlite.register(config)
+    db_config = {"database": str(tmp_path / "script.db")}
+    script = "CREATE TABLE t (id INTEGER); INSERT INTO t VALUES (1), (2); SELECT * FROM t"
+    outcomes = script_runner.run_script(sqlite.DATA_SOURCE, db_config, script)
+    assert [outcome["error"] for outcome in outcomes] == [None] * 3
+    assert outcomes[1]["rows"] == 2
+    conn = sqlite3.connect(db_config["database"])
+    try:
+        assert conn.execute("SELECT count(*) FROM t").fetchone() == (2,)
+    finally:
+        conn.close()
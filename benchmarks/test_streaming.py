@@ -0,0 +1,42 @@
+import config
+from database_controllers import streaming
+
+
+class _Cursor:
+    description = [("id",), ("value",)]
+
+    def __init__(self, rows):
+        self.rows = [(i, f"row {i}") for i in range(rows)]
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+def test_reservoir_keeps_small_results(monkeypatch):
+    monkeypatch.setattr(config, "query_fetch_batch_size", 7)
+    df, rows = streaming.reservoir_dataframe(_Cursor(20), 50)
+    assert rows == 20
+    assert list(df.columns) == ["id", "value"]
+    assert df["id"].tolist() == list(range(20))
+
+
+def test_reservoir_sample_is_bounded_and_ordered(monkeypatch):
+    monkeypatch.setattr(config, "query_fetch_batch_size", 64)
+    batches = []
+    df, rows = streaming.reservoir_dataframe(_Cursor(10_000), 100, on_batch=lambda *args: batches.append(args))
+    assert rows == 10_000
+    assert len(df) == 100
+    ids = df["id"].tolist()
+    assert ids == sorted(set(ids))
+    assert (df["value"] == "row " + df["id"].astype(str)).all()
+    assert batches[-1] == (10_000, 100)
+    # Rows past the first batches are kept too
+    assert ids[-1] >= 100
+
+
+def test_reservoir_of_an_empty_result():
+    df, rows = streaming.reservoir_dataframe(_Cursor(0), 10)
+    assert rows == 0
+    assert list(df.columns) == ["id", "value"]
+    assert df.empty
@@ -0,0 +1,69 @@
+import pytest
+
+import config
+from services import table_query
+
+
+def test_split_filter_part():
+    assert table_query.split_filter_part("{price} ge 10") == ("price", "ge", 10.0)
+    assert table_query.split_filter_part("{name} contains 'a b'") == ("name", "contains", "a b")
+    assert table_query.split_filter_part('{name} eq "say \\"hi\\""') == ("name", "eq", 'say "hi"')
+    assert table_query.split_filter_part("{day} datestartswith 2024-01") == ("day", "datestartswith", "2024-01")
+    assert table_query.split_filter_part("{code} contains 12") == ("code", "contains", "12")
+    assert table_query.split_filter_part("{price} = 3") == ("price", "eq", 3.0)
+    assert table_query.split_filter_part("price") == [None] * 3
+    assert table_query.split_filter_part("{name} contains ") == [None] * 3
+
+
+def test_parse_filter_query():
+    assert table_query.parse_filter_query("") == []
+    assert table_query.parse_filter_query("{a} gt 1 && {b} ne x && junk") == [("a", "gt", 1.0), ("b", "ne", "x")]
+
+
+def test_build_page_query():
+    query, params = table_query.build_page_query(
+        "my table",
+        [{"column_id": "price", "direction": "desc"}],
+        "{price} ge 10 && {name} contains ab",
+        2,
+        25,
+        config.database_sql_dialects["mysql"],
+    )
+    assert query == (
+        "SELECT * FROM `my table` WHERE `price` >= %s AND CAST(`name` AS CHAR) LIKE %s ESCAPE '!' "
+        "ORDER BY `price` DESC LIMIT 26 OFFSET 50"
+    )
+    assert params == [10.0, "%ab%"]
+
+
+def test_build_page_query_quotes_identifiers():
+    query, params = table_query.build_page_query(
+        'a"b', [], '{c"d} datestartswith 2024', 0, 10, config.database_sql_dialects["postgres"]
+    )
+    assert query == 'SELECT * FROM "a""b" WHERE CAST("c""d" AS TEXT) LIKE %s ESCAPE \'!\' LIMIT 11 OFFSET 0'
+    assert params == ["2024%"]
+
+
+def test_like_wildcards_of_the_user_are_literal():
+    query, params = table_query.build_page_query(
+        "t", [], "{name} contains 50%_off! && {path} datestartswith C:\\", 0, 10, config.database_sql_dialects["csv"]
+    )
+    assert query.count("ESCAPE '!'") == 2
+    assert params == ["%50!%!_off!!%", "C:\\%"]
+
+
+def test_like_filters_in_the_embedded_engine():
+    duckdb = pytest.importorskip("duckdb")
+    query, params = table_query.build_page_query(
+        "t", [], "{name} contains 5%", 0, 10, config.database_sql_dialects["csv"]
+    )
+    conn = duckdb.connect()
+    try:
+        conn.execute("CREATE TABLE t AS SELECT * FROM (VALUES ('5% off'), ('50 off'), ('a\\b')) AS v(name)")
+        assert conn.execute(query, params).fetchall() == [("5% off",)]
+        query, params = table_query.build_page_query(
+            "t", [], "{name} contains \\", 0, 10, config.database_sql_dialects["csv"]
+        )
+        assert conn.execute(query, params).fetchall() == [("a\\b",)]
+    finally:
+        conn.close()
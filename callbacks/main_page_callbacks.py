@@ -1,23 +1,192 @@
 import base64
-from base64 import b64encode
+import json
+import time
+import uuid
 
 import dash
 from dash import dash_table
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ALL, ClientsideFunction, Input, Output, State
 import dash_bootstrap_components as dbc
+from dash import dcc
+from dash import html
 from dash.exceptions import PreventUpdate
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 
 import config
 from database_controllers import csv_excel
+from database_controllers import running_queries
+from services import admission
+from services import datasets
+from services import figure_cache
+from services import figure_export
+from services import jobs
+from services import metrics
+from services import plot_queries
+from services import plots
+from services import profiling
+from services import query_cache
+from services import result_store
+from services import schema_cache
+from services import snapshots
+from services import table_query
+from services import tasks
+
+
+def alert(message, color):
+    return dbc.Alert(message, id="alert-fade", dismissable=True, is_open=True, color=color)
+
+
+def progress_message(message):
+    return html.Div([dbc.Spinner(size="sm", color="primary"), " ", message], className="text-primary")
+
+
+def poll_query_job(query_job, db_config):
+    """
+    Return the outputs of update_db_data for the current state of a query job
+    """
+    job_id = query_job["job_id"]
+    status = jobs.status(job_id)
+    if status["state"] in ("queued", "running"):
+        message = status.get("progress") or "Running query..."
+        return dash.no_update, dash.no_update, dash.no_update, False, progress_message(message), dash.no_update
+
+    jobs.forget(job_id)
+    if status["state"] == "cancelled":
+        return dash.no_update, alert("Query cancelled", "info"), None, True, [], dash.no_update
+    if status["state"] == "error":
+        return None, alert(status["error"], "danger"), None, True, [], None
+
+    if query_job.get("script"):
+        # The script may have created or dropped tables
+        schema_cache.refresh(query_job["data_source"], db_config)
+        statements = status["result"]["statements"]
+        # Show the rows of the first statement that returned some, the others are in the tabs
+        selected = next((i for i, statement in enumerate(statements) if statement["result"] is not None), None)
+        script_data = {"statements": statements, "selected": selected}
+        if selected is None:
+            return None, [], None, True, [], script_data
+        data = statements[selected]["result"]
+        return data, result_notice(data), None, True, [], script_data
+
+    data = status["result"]["result"]
+    if query_job.get("data_source") in config.database_sources and not query_job.get("sample"):
+        query_cache.store(query_job["data_source"], db_config, query_job["query"], data, status["result"]["freshness"])
+    return data, result_notice(data), None, True, [], None
+
+
+def result_notice(data):
+    """
+    Return the notices about a result that are shown with it: if it was truncated and if it is a sample of a table
+    """
+    notice = []
+    if data.get("truncated"):
+        notice.append(
+            alert(
+                f"The result is too large, only the first {data['rows']:,} rows were loaded "
+                f"(limits: {config.query_max_rows:,} rows, {config.query_max_bytes // (1024 * 1024)} MB)",
+                "warning",
+            )
+        )
+    sample = data.get("sample")
+    if sample:
+        of_rows = f" of about {sample['estimated_rows']:,}" if sample["estimated_rows"] else ""
+        notice.append(
+            html.Small(
+                f"Random sample of {data['rows']:,}{of_rows} rows ({sample['method']}), "
+                "sorting and filtering the table use all its rows",
+                className="text-muted",
+            )
+        )
+    return notice
+
+
+def table_label(name, rows):
+    return name if rows is None else f"{name} (~{rows:,} rows)"
+
+
+def profile_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:,.4g}"
+    return str(value)
+
+
+def sparkline(counts):
+    """
+    Draw a histogram as a line of block characters
+    """
+    if not counts or not max(counts):
+        return ""
+    blocks = "▁▂▃▄▅▆▇█"
+    top = max(counts)
+    return "".join(blocks[round(count / top * (len(blocks) - 1))] for count in counts)
+
+
+def load_result(data):
+    """
+    Return the dataframe of the result that db-data store points to
+    """
+    df = result_store.get(data["result_id"])
+    if df is None:
+        # The result was evicted from the server, the user has to run the query again
+        raise PreventUpdate
+    return df
+
+
+def build_plot(
+    data, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation, x_range, y_range, db_config, data_source
+):
+    """
+    Build the figure of a plot of the result that db-data store points to.
+    Returns:
+        0. The figure, None if the plot could not be aggregated
+        1. The message shown under the plot (or why it could not be aggregated), None if there is nothing to say
+    """
+    if aggregation == "none":
+        df = load_result(data)
+        with metrics.timed("figure"):
+            fig, message = plots.build_figure(df, plot_type, x_axis_col, y_axis_col, group_by_col, x_range, y_range)
+    else:
+        aggregated = None
+        try:
+            query_config = db_config if data_source in config.database_sources else None
+            if data.get("file_config") and data_source in config.database_execute_functions:
+                # Query results of uploaded files and snapshots are aggregated by the embedded engine
+                query_config = data["file_config"]
+            if query_config is not None:
+                # The database aggregates all the rows, only the points of the plot come back
+                aggregated = plot_queries.run_aggregate_query(
+                    data_source, query_config, data, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation
+                )
+            if aggregated is None:
+                df = plots.aggregate(load_result(data), plot_type, x_axis_col, y_axis_col, group_by_col, aggregation)
+                notice = None
+            else:
+                df, truncated = aggregated
+                notice = "Aggregated over all the rows of the query"
+                if truncated:
+                    notice += f", showing the first {len(df):,} points"
+        except Exception as err:
+            return None, f"The plot could not be aggregated: {err}"
+        with metrics.timed("figure"):
+            fig, message = plots.build_aggregate_figure(
+                df, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation
+            )
+        message = ". ".join(part for part in [notice, message] if part) or None
+
+    # Keep the zoom of the user when the zoomed in data replaces the figure
+    fig.update_layout(uirevision=json.dumps([data["result_id"], plot_type, x_axis_col, y_axis_col, group_by_col]))
+    if x_range is not None:
+        fig.update_xaxes(range=list(x_range))
+    if y_range is not None:
+        fig.update_yaxes(range=list(y_range))
+    return fig, message
 
 
 def get_callbacks(app):
     @app.callback(
         Output("db-output-message", "children"),
-        Output("tables-dropdown", "options"),
         Output("tables-dropdown", "value"),
         Output("database-config", "data"),
         Output("db-connect-loading", "children"),
@@ -37,15 +206,15 @@ def get_callbacks(app):
         success = True
         try:
             db_connection_func = config.database_connection_functions[data_source]
-            tables_list, db_config = db_connection_func(**args)
-            tables_options = [{"label": source, "value": source} for source in tables_list]
-            selected_table = tables_list[0]
+            db_config = db_connection_func(**args)
+            # The tables come from the schema cache, the dropdown only gets the ones that match what the user types
+            tables = schema_cache.tables(data_source, db_config)
+            selected_table = tables[0][0] if tables else None
             output_msg = "Connected successfully"
 
         except Exception as err:
             success = False
             output_msg = str(err)
-            tables_options = None
             selected_table = ""
             db_config = None
 
@@ -53,75 +222,531 @@ def get_callbacks(app):
             output_msg, id="alert-fade", dismissable=True, is_open=True, color="success" if success else "danger"
         )
         # Add db-connect-loading component to output
-        return output_msg_component, tables_options, selected_table, db_config, []
+        return output_msg_component, selected_table, db_config, []
 
     @app.callback(
-        Output("db-data", "data"),
-        Output("query-loading", "children"),
-        Output("query-error", "children"),
+        Output("tables-dropdown", "options"),
+        Input("tables-dropdown", "search_value"),
+        Input("database-config", "data"),
+        State("tables-dropdown", "value"),
+        State("data_source", "value"),
+    )
+    def update_tables_options(search_value, db_config, selected_table, data_source):
+        if db_config is None or data_source not in config.database_tables_functions:
+            return []
+
+        try:
+            tables = schema_cache.search(data_source, db_config, search_value, config.schema_search_limit)
+        except Exception:
+            raise PreventUpdate
+        options = [{"label": table_label(name, rows), "value": name} for name, rows in tables]
+        if selected_table and selected_table not in [option["value"] for option in options]:
+            # The dropdown shows nothing for a value that is not in its options
+            options.insert(0, {"label": selected_table, "value": selected_table})
+        return options
+
+    @app.callback(
+        Output("table-info", "children"),
         Input("tables-dropdown", "value"),
-        Input("run_query_btn", "n_clicks"),
+        State("database-config", "data"),
+        State("data_source", "value"),
+        prevent_initial_call=True,
+    )
+    def show_table_info(table_name, db_config, data_source):
+        if not table_name or db_config is None or data_source not in config.database_columns_functions:
+            return []
+
+        try:
+            columns = schema_cache.columns(data_source, db_config, table_name)
+            rows = schema_cache.row_estimate(data_source, db_config, table_name)
+        except Exception as err:
+            return alert(str(err), "danger")
+        summary = f"{len(columns)} columns" if rows is None else f"~{rows:,} rows, {len(columns)} columns"
+        return html.Details(
+            [
+                html.Summary(summary),
+                html.Ul([html.Li(f"{name}: {column_type}") for name, column_type in columns]),
+            ],
+            className="text-muted",
+        )
+
+    @app.callback(
+        Output("upload-dataset", "data"),
+        Output("upload-data", "contents"),
         Input("upload-data", "contents"),
+        Input("large-upload-result", "value"),
         State("upload-data", "filename"),
+        prevent_initial_call=True,
+    )
+    def ingest_upload(file_contents, large_upload_result, filename):
+        ctx = dash.callback_context
+        # A large file was uploaded in chunks and converted to a dataset by the upload routes
+        if ctx.triggered[0]["prop_id"] == "large-upload-result.value":
+            if not large_upload_result:
+                raise PreventUpdate
+            return json.loads(large_upload_result), dash.no_update
+
+        if file_contents is None:
+            raise PreventUpdate
+
+        df, error = csv_excel.parse_contents(file_contents, filename)
+        if error:
+            return {"error": error}, None
+        # The file is parsed once and queried from the dataset from now on,
+        # clear the upload so that its contents don't travel with every callback
+        return datasets.create(df, filename), None
+
+    @app.callback(
+        Output("query-admitted", "data"),
+        Output("query-confirm", "displayed"),
+        Output("query-confirm", "message"),
+        Output("query-admission", "children"),
+        Input("run_query_btn", "n_clicks"),
+        Input("query-confirm", "submit_n_clicks"),
         State("query", "value"),
         State("database-config", "data"),
         State("data_source", "value"),
         prevent_initial_call=True,
     )
-    def update_db_data(table_name, query_btn_clicks, file_contents, filename, query, db_config, data_source):
+    def admit_query(n_clicks, confirm_clicks, query, db_config, data_source):
         ctx = dash.callback_context
-        error = None
-        if data_source in config.database_sources:
-            execute_query_func = config.database_execute_functions[data_source]
+        trigger = ctx.triggered[0]["prop_id"]
+
+        # Every admitted query is a new value of the store, running the same query again triggers update_db_data too
+        admitted = {"query": query, "id": uuid.uuid4().hex}
+        if trigger == "query-confirm.submit_n_clicks":
+            if not confirm_clicks:
+                raise PreventUpdate
+            return admitted, False, dash.no_update, []
+
+        if not n_clicks:
+            raise PreventUpdate
+        if data_source not in config.database_sources:
+            return admitted, False, dash.no_update, []
+
+        decision, message = admission.check(data_source, db_config, query)
+        if decision == "reject":
+            return dash.no_update, False, dash.no_update, alert(message, "danger")
+        if decision == "confirm":
+            return dash.no_update, True, message, []
+        return admitted, False, dash.no_update, []
+
+    @app.callback(
+        Output("db-data", "data"),
+        Output("query-error", "children"),
+        Output("query-job", "data"),
+        Output("query-poll", "disabled"),
+        Output("query-progress", "children"),
+        Output("script-data", "data"),
+        Input("tables-dropdown", "value"),
+        Input("query-admitted", "data"),
+        Input("run_script_btn", "n_clicks"),
+        Input("upload-dataset", "data"),
+        Input("query-poll", "n_intervals"),
+        Input("script-results", "value"),
+        State("query", "value"),
+        State("database-config", "data"),
+        State("data_source", "value"),
+        State("session-id", "data"),
+        State("query-job", "data"),
+        State("script-data", "data"),
+        State("db-data", "data"),
+        State("preview-mode", "value"),
+        State("preview-size", "value"),
+        State("snapshots", "data"),
+        prevent_initial_call=True,
+    )
+    def update_db_data(
+        table_name,
+        admitted_query,
+        script_btn_clicks,
+        upload_dataset,
+        n_intervals,
+        script_tab,
+        query,
+        db_config,
+        data_source,
+        session_id,
+        query_job,
+        script_data,
+        data,
+        preview_mode,
+        preview_size,
+        snapshot_list,
+    ):
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+
+        # User selected the tab of another statement of a script
+        if trigger == "script-results.value":
+            if script_data is None or script_tab is None:
+                raise PreventUpdate
+            selected_data = script_data["statements"][int(script_tab)]["result"]
+            if selected_data is None or (data is not None and data["result_id"] == selected_data["result_id"]):
+                raise PreventUpdate
+            no_update = dash.no_update
+            return selected_data, result_notice(selected_data), no_update, no_update, no_update, no_update
+
+        # The background job of the query was polled
+        if trigger == "query-poll.n_intervals":
+            if query_job is None:
+                raise PreventUpdate
+            return poll_query_job(query_job, db_config)
+
         # If callback function was triggered because user upload a csv/excel file
-        if ctx.triggered[0]["prop_id"] == "upload-data.contents":
-            if file_contents is None:
+        if trigger == "upload-dataset.data":
+            if upload_dataset is None:
                 raise PreventUpdate
-            df, error = csv_excel.parse_contents(file_contents, filename)
+            if "error" in upload_dataset:
+                return None, alert(upload_dataset["error"], "danger"), None, True, [], None
+            if query_job is not None:
+                jobs.cancel(query_job["job_id"])
+            # Large files are never read whole by the web workers, the job stores the file of the dataset
+            job_id = jobs.submit(tasks.store_dataset, upload_dataset["dataset_id"])
+            return dash.no_update, [], {"job_id": job_id}, False, progress_message("Loading the file..."), None
 
-        # If callback function was triggered because user clicked run query button
-        elif ctx.triggered[0]["prop_id"] == "run_query_btn.n_clicks":
-            if query_btn_clicks == 0:
+        # User clicked the run script button, the statements of the query run as a script
+        if trigger == "run_script_btn.n_clicks":
+            if script_btn_clicks == 0:
                 raise PreventUpdate
-            # Run query button was clicked
-            try:
-                if data_source in config.database_sources:
-                    columns, results = execute_query_func(db_config, query)
-                    df = pd.DataFrame(results, columns=columns)
-                else:
-                    df, error = csv_excel.parse_contents(file_contents, filename)
-                    df = df.query(query)
-            except Exception as err:
-                error = str(err)
+            if data_source not in config.database_statement_functions:
+                message = alert("Scripts can only run on databases", "danger")
+                no_update = dash.no_update
+                return no_update, message, no_update, no_update, no_update, no_update
+            if query_job is not None:
+                jobs.cancel(query_job["job_id"])
+            job_id = jobs.submit(tasks.run_script, data_source, db_config, query, session_id)
+            query_job = {"job_id": job_id, "data_source": data_source, "query": query, "script": True}
+            return dash.no_update, [], query_job, False, progress_message("Running script..."), dash.no_update
 
+        # User clicked the run query button and the query was admitted by admit_query
+        if trigger == "query-admitted.data":
+            if admitted_query is None:
+                raise PreventUpdate
+            query = admitted_query["query"]
+            source_table = None
         # Callback function was called because user changed the selected database table
         else:
-            if table_name == "":
+            if not table_name:
                 raise PreventUpdate
             # User selected a table from dropdown menu
-            query = f"SELECT * FROM {table_name} LIMIT 1000"
+            preview_size = min(max(int(preview_size or config.preview_sample_size), 1), config.query_max_rows)
+            query = f"SELECT * FROM {table_name} LIMIT {preview_size}"
+            source_table = table_name
+
+        if query_job is not None:
+            # Only the result of the latest query is shown
+            jobs.cancel(query_job["job_id"])
+
+        if source_table is not None and preview_mode == "sample" and data_source in config.database_sample_functions:
             try:
-                columns, results = execute_query_func(db_config, query)
-                df = pd.DataFrame(results, columns=columns)
-            except Exception as err:
-                error = str(err)
+                row_estimate = schema_cache.row_estimate(data_source, db_config, table_name)
+            except Exception:
+                row_estimate = None  # Without an estimate the table is scanned
+            job_id = jobs.submit(
+                tasks.run_table_sample, data_source, db_config, table_name, preview_size, row_estimate, session_id
+            )
+            query_job = {"job_id": job_id, "data_source": data_source, "sample": True}
+            return dash.no_update, [], query_job, False, progress_message("Sampling the table..."), dash.no_update
 
-        if error:
-            error_alert = dbc.Alert(error, id="alert-fade", dismissable=True, is_open=True, color="danger")
-            return None, [], error_alert
+        if data_source not in config.database_sources:
+            dataset_id = None if upload_dataset is None else upload_dataset.get("dataset_id")
+            # The local data source queries the snapshots, the uploaded file is optional
+            if dataset_id is None and data_source != "local":
+                return dash.no_update, alert("Upload a csv or excel file first", "danger"), None, True, [], None
+            file_config = {
+                "dataset_id": dataset_id,
+                "snapshots": [snapshot["snapshot_id"] for snapshot in snapshot_list or []],
+            }
+            job_id = jobs.submit(tasks.run_file_query, data_source, file_config, query)
+            return dash.no_update, [], {"job_id": job_id}, False, progress_message("Running query..."), dash.no_update
+
+        cached_data = query_cache.lookup(data_source, db_config, query)
+        if cached_data is not None:
+            return cached_data, result_notice(cached_data), None, True, [], None
 
-        return df.to_json(date_format="iso", orient="split"), [], []
+        job_id = jobs.submit(tasks.run_database_query, data_source, db_config, query, session_id, source_table)
+        query_job = {"job_id": job_id, "data_source": data_source, "query": query}
+        return dash.no_update, [], query_job, False, progress_message("Running query..."), dash.no_update
+
+    @app.callback(
+        Output("script-results", "children"),
+        Output("script-results", "value"),
+        Input("script-data", "data"),
+        prevent_initial_call=True,
+    )
+    def show_script_results(script_data):
+        if script_data is None:
+            return [], None
+
+        tabs = []
+        for i, statement in enumerate(script_data["statements"]):
+            connection = "the session connection" if statement["session"] else "its own connection"
+            if statement["error"] is not None:
+                label = f"#{i + 1} failed" if statement["seconds"] is not None else f"#{i + 1} skipped"
+                details = alert(statement["error"], "danger")
+            else:
+                label = f"#{i + 1} ({statement['seconds']:.2f}s)"
+                rows = "rows" if statement["result"] is not None else "rows changed"
+                details = html.Small(
+                    f"{statement['rows']:,} {rows} in {statement['seconds']:.2f}s on {connection}",
+                    className="text-muted",
+                )
+            tabs.append(
+                dcc.Tab(
+                    label=label,
+                    value=str(i),
+                    # Only the statements that returned rows can be shown in the table
+                    disabled=statement["result"] is None,
+                    children=[html.Pre(statement["statement"]), details],
+                )
+            )
+        selected = script_data["selected"]
+        return tabs, None if selected is None else str(selected)
+
+    @app.callback(
+        Output("query-cancel-message", "children"),
+        Input("cancel_query_btn", "n_clicks"),
+        State("session-id", "data"),
+        State("database-config", "data"),
+        State("query-job", "data"),
+        prevent_initial_call=True,
+    )
+    def cancel_query(n_clicks, session_id, db_config, query_job):
+        if n_clicks == 0:
+            raise PreventUpdate
+
+        if query_job is None:
+            return alert("There is no running query to cancel", "info")
+
+        # The job stops when it reads the next batch of rows, killing the query
+        # in the database stops it right away if it is still executing
+        jobs.cancel(query_job["job_id"])
+        try:
+            running_queries.cancel(session_id, db_config)
+        except Exception as err:
+            return alert(str(err), "danger")
+        return []
 
     @app.callback(
         Output(component_id="upload-data-div", component_property="style"),
         Output(component_id="database-info-div", component_property="style"),
+        Output("query", "placeholder"),
+        Output("query-hint", "children"),
         Input("data_source", "value"),
     )
     def update_data_source_options(data_source):
         if data_source in config.database_sources:
-            return {"display": "none"}, {"display": "block"}
+            return {"display": "none"}, {"display": "block"}, "SELECT * FROM table_name", []
+        # Tell the users what the tables of the embedded engine are called
+        if data_source == "local":
+            placeholder = "SELECT * FROM snapshot_name"
+            hint = 'Snapshots are queried by their names and the uploaded file (if any) as the table "data"'
+        elif data_source in config.file_sql_sources:
+            placeholder = "SELECT * FROM data LIMIT 10"
+            hint = (
+                'The uploaded file is queried as the table "data", a query that is not SQL filters its rows '
+                "(e.g price > 10)"
+            )
+        else:
+            placeholder = "price > 10"
+            hint = "The query filters the rows of the uploaded file, e.g price > 10 and region == 'north'"
+        return {"display": "block"}, {"display": "none"}, placeholder, html.Small(hint, className="text-muted")
+
+    @app.callback(
+        Output("snapshot-watermark", "options"),
+        Output("snapshot-keys", "options"),
+        Input("tables-dropdown", "value"),
+        Input("snapshot-source", "value"),
+        Input("db-data", "data"),
+        State("database-config", "data"),
+        State("data_source", "value"),
+        prevent_initial_call=True,
+    )
+    def update_snapshot_columns(table_name, snapshot_source, data, db_config, data_source):
+        if snapshot_source == "query":
+            # The columns of the query are the columns of its last result
+            columns = data["columns"] if data is not None else []
         else:
-            return {"display": "block"}, {"display": "none"}
+            if not table_name or db_config is None or data_source not in config.database_columns_functions:
+                return [], []
+            try:
+                columns = [name for name, _ in schema_cache.columns(data_source, db_config, table_name)]
+            except Exception:
+                return [], []
+        options = [{"label": column, "value": column} for column in columns]
+        return options, options
+
+    @app.callback(
+        Output("snapshots", "data"),
+        Output("snapshot-job", "data"),
+        Output("snapshot-poll", "disabled"),
+        Output("snapshot-message", "children"),
+        Input("snapshot-btn", "n_clicks"),
+        Input({"type": "snapshot-refresh", "index": ALL}, "n_clicks"),
+        Input({"type": "snapshot-remove", "index": ALL}, "n_clicks"),
+        Input("snapshot-poll", "n_intervals"),
+        State("snapshot-name", "value"),
+        State("snapshot-source", "value"),
+        State("tables-dropdown", "value"),
+        State("query", "value"),
+        State("snapshot-watermark", "value"),
+        State("snapshot-keys", "value"),
+        State("snapshots", "data"),
+        State("snapshot-job", "data"),
+        State("database-config", "data"),
+        State("data_source", "value"),
+        State("session-id", "data"),
+        prevent_initial_call=True,
+    )
+    def update_snapshots(
+        n_clicks,
+        refresh_clicks,
+        remove_clicks,
+        n_intervals,
+        name,
+        snapshot_source,
+        table_name,
+        query,
+        watermark_column,
+        key_columns,
+        snapshot_list,
+        snapshot_job,
+        db_config,
+        data_source,
+        session_id,
+    ):
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+        no_update = dash.no_update
+
+        # The background job of the refresh was polled
+        if trigger == "snapshot-poll.n_intervals":
+            if snapshot_job is None:
+                raise PreventUpdate
+            status = jobs.status(snapshot_job["job_id"])
+            if status["state"] in ("queued", "running"):
+                message = status.get("progress") or "Refreshing the snapshot..."
+                return no_update, no_update, False, progress_message(message)
+            jobs.forget(snapshot_job["job_id"])
+            if status["state"] == "cancelled":
+                return no_update, None, True, alert("Snapshot refresh cancelled", "info")
+            if status["state"] == "error":
+                return no_update, None, True, alert(status["error"], "danger")
+            result = status["result"]
+            message = f"{result['rows']:,} rows copied to {result['name']}, it has {result['total_rows']:,} rows"
+            return no_update, None, True, alert(message, "success")
+
+        if trigger == "snapshot-btn.n_clicks":
+            if not n_clicks:
+                raise PreventUpdate
+        # New refresh and remove buttons trigger the callback too, with no clicks
+        elif not ctx.triggered[0]["value"]:
+            raise PreventUpdate
+
+        # User clicked the remove button of a snapshot
+        if trigger != "snapshot-btn.n_clicks":
+            button = json.loads(trigger.rsplit(".", 1)[0])
+            if button["type"] == "snapshot-remove":
+                try:
+                    snapshots.remove(button["index"])
+                except ValueError as err:
+                    return no_update, no_update, no_update, alert(str(err), "danger")
+                removed = [other for other in snapshot_list or [] if other["snapshot_id"] == button["index"]]
+                snapshot_list = [other for other in snapshot_list or [] if other["snapshot_id"] != button["index"]]
+                message = f"Snapshot {removed[0]['name']} removed" if removed else "Snapshot removed"
+                return snapshot_list, no_update, no_update, alert(message, "info")
+
+        if snapshot_job is not None:
+            return no_update, no_update, no_update, alert("Another snapshot is being refreshed", "info")
+        if db_config is None or data_source not in config.database_sources:
+            return no_update, no_update, no_update, alert("Connect to the database of the snapshot first", "danger")
+
+        # User clicked the snapshot button, the snapshot is created and copied
+        if trigger == "snapshot-btn.n_clicks":
+            try:
+                snapshot = snapshots.create(
+                    name,
+                    data_source,
+                    db_config,
+                    table=table_name if snapshot_source == "table" else None,
+                    query=query if snapshot_source == "query" else None,
+                    watermark_column=watermark_column,
+                    key_columns=key_columns,
+                )
+            except ValueError as err:
+                return no_update, no_update, no_update, alert(str(err), "danger")
+            snapshot_id = snapshot["snapshot_id"]
+            # A snapshot replaces the one with the same name
+            for other in snapshot_list or []:
+                if other["name"] == name:
+                    try:
+                        snapshots.remove(other["snapshot_id"])
+                    except ValueError:
+                        # It is being refreshed, it is pruned once no browser uses it anymore
+                        pass
+            snapshot_list = [other for other in snapshot_list or [] if other["name"] != name] + [snapshot]
+        # User clicked the refresh button of a snapshot
+        else:
+            snapshot_id = button["index"]
+            snapshot_list = no_update
+
+        job_id = jobs.submit(tasks.refresh_snapshot, snapshot_id, data_source, db_config, session_id)
+        return snapshot_list, {"job_id": job_id}, False, progress_message("Refreshing the snapshot...")
+
+    @app.callback(
+        Output("snapshot-list", "children"),
+        Input("snapshots", "data"),
+        Input("snapshot-job", "data"),
+    )
+    def show_snapshots(snapshot_list, snapshot_job):
+        if snapshot_job is not None:
+            # The list is shown again when the refresh finishes
+            raise PreventUpdate
+
+        # The snapshots are listed when the page is loaded, the ones no browser lists anymore are pruned
+        snapshots.mark_used([snapshot["snapshot_id"] for snapshot in snapshot_list or []])
+        items = []
+        for snapshot in snapshot_list or []:
+            try:
+                manifest = snapshots.manifest(snapshot["snapshot_id"])
+            except ValueError:
+                continue
+            source = manifest["table"] or "a query"
+            if manifest["refreshed_at"] is None:
+                state = "not copied yet"
+            else:
+                refreshed_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest["refreshed_at"]))
+                state = f"{manifest['rows']:,} rows, refreshed {refreshed_at}"
+                if manifest["truncated"]:
+                    state += ", only the first rows of the source"
+            items.append(
+                html.Li(
+                    [
+                        html.Code(manifest["name"]),
+                        f" of {source} ({manifest['data_source']}): {state} ",
+                        html.Button(
+                            id={"type": "snapshot-refresh", "index": snapshot["snapshot_id"]},
+                            n_clicks=0,
+                            children="Refresh",
+                            className="btn btn-outline-secondary btn-sm",
+                        ),
+                        " ",
+                        html.Button(
+                            id={"type": "snapshot-remove", "index": snapshot["snapshot_id"]},
+                            n_clicks=0,
+                            children="Remove",
+                            className="btn btn-outline-danger btn-sm",
+                        ),
+                    ]
+                )
+            )
+        if not items:
+            return []
+        return [
+            dcc.Markdown("##### Snapshots, query them with the local data source", className="text-primary"),
+            html.Ul(items),
+        ]
 
     @app.callback(
         Output("datatable", "children"),
@@ -132,14 +757,68 @@ def get_callbacks(app):
         if data is None:
             raise PreventUpdate
 
-        df = pd.read_json(data, orient="split")
+        # Rows are filled in page by page by update_datatable_page
         datatable = dash_table.DataTable(
-            data=df.to_dict("records"),
-            columns=[{"name": i, "id": i} for i in df.columns],
+            id="results-table",
+            columns=[{"name": i, "id": str(i)} for i in data["columns"]],
+            page_current=0,
             page_size=10,
+            page_action="custom",
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
+            filter_action="custom",
+            filter_query="",
         )
         return datatable
 
+    @app.callback(
+        Output("results-table", "data"),
+        Output("results-table", "page_count"),
+        Output("datatable-message", "children"),
+        Input("results-table", "page_current"),
+        Input("results-table", "page_size"),
+        Input("results-table", "sort_by"),
+        Input("results-table", "filter_query"),
+        State("db-data", "data"),
+        State("database-config", "data"),
+        State("data_source", "value"),
+    )
+    def update_datatable_page(page_current, page_size, sort_by, filter_query, data, db_config, data_source):
+        if data is None:
+            raise PreventUpdate
+
+        page_current = page_current or 0
+        page = None
+        message = []
+        if data.get("source_table") and (sort_by or filter_query):
+            query, params = table_query.build_page_query(
+                data["source_table"],
+                sort_by,
+                filter_query,
+                page_current,
+                page_size,
+                config.database_sql_dialects[data_source],
+            )
+            try:
+                # Sorting or filtering a whole table is estimated and queued like the queries the users type
+                columns, results = admission.execute_query(data_source, db_config, query, params)
+            except Exception as err:
+                # e.g a filter value whose type doesn't match the column, the loaded rows can still be shown
+                message = alert(f"The table could not be sorted or filtered in the database: {err}", "warning")
+            else:
+                page = pd.DataFrame(results[:page_size], columns=columns)
+                # The number of rows is unknown, only allow going to the next page if there is one
+                page_count = page_current + 2 if len(results) > page_size else page_current + 1
+        if page is None:
+            df = load_result(data)
+            page, page_count = table_query.get_page(
+                df, data["result_id"], page_current, page_size, sort_by, filter_query
+            )
+
+        page.columns = [str(col) for col in page.columns]
+        return page.to_dict("records"), page_count, message
+
     @app.callback(
         Output("plot_x_axis", "options"),
         Output("plot_y_axis", "options"),
@@ -151,58 +830,211 @@ def get_callbacks(app):
         if data is None:
             raise PreventUpdate
 
-        df = pd.read_json(data, orient="split")
-        options = [{"label": source, "value": source} for source in list(df.columns)]
+        # The types tell which columns can be measured and which ones group the rows
+        dtypes = data.get("dtypes") or [None] * len(data["columns"])
+        options = [
+            {"label": source if dtype is None else f"{source} ({dtype})", "value": source}
+            for source, dtype in zip(data["columns"], dtypes)
+        ]
         return options, options, options
 
     @app.callback(
-        Output("data_graph", "figure"),
+        Output("column-profile", "children"),
+        Output("plot-suggestions", "children"),
+        Output("plot-suggestions-data", "data"),
+        Input("db-data", "data"),
+        prevent_initial_call=True,
+    )
+    def show_column_profile(data):
+        if data is None:
+            return None, None, None
+
+        profile = profiling.result_profile(data["result_id"])
+        if profile is None:
+            raise PreventUpdate
+
+        rows = []
+        for column, stats in profile["columns"].items():
+            if stats["quantiles"] is not None:
+                summary = " / ".join(profile_value(value) for value in stats["quantiles"][1:4])
+            else:
+                summary = ", ".join(f"{value} ({count:,})" for value, count in stats["top_values"] or [])
+            rows.append(
+                {
+                    "column": column,
+                    "type": stats["dtype"],
+                    "nulls": f"{stats['null_fraction']:.1%}",
+                    "distinct": f"~{stats['distinct']:,}",
+                    "min": profile_value(stats["min"]),
+                    "max": profile_value(stats["max"]),
+                    "quartiles / top values": summary,
+                    "histogram": sparkline(stats["histogram"]),
+                }
+            )
+        table = dash_table.DataTable(
+            columns=[{"name": name, "id": name} for name in rows[0]] if rows else [],
+            data=rows,
+            page_size=20,
+            style_cell={"textAlign": "left"},
+        )
+        panel = html.Details(
+            [html.Summary(f"Column profile of the {profile['rows']:,} loaded rows", className="text-primary"), table]
+        )
+
+        suggestions = profiling.suggest_plots(profile)
+        buttons = [
+            html.Button(
+                suggestion["label"],
+                id={"type": "plot-suggestion", "index": i},
+                n_clicks=0,
+                className="btn btn-outline-secondary btn-sm",
+            )
+            for i, suggestion in enumerate(suggestions)
+        ]
+        return panel, buttons, suggestions
+
+    @app.callback(
+        Output("plot_type", "value"),
+        Output("plot_x_axis", "value"),
+        Output("plot_y_axis", "value"),
+        Output("plot_group_by_col", "value"),
+        Output("plot-aggregation", "value"),
+        Input({"type": "plot-suggestion", "index": ALL}, "n_clicks"),
+        State("plot-suggestions-data", "data"),
+        prevent_initial_call=True,
+    )
+    def apply_plot_suggestion(n_clicks, suggestions):
+        ctx = dash.callback_context
+        # New suggestion buttons trigger the callback too, with no clicks
+        if not suggestions or not ctx.triggered or not ctx.triggered[0]["value"]:
+            raise PreventUpdate
+
+        index = json.loads(ctx.triggered[0]["prop_id"].rsplit(".", 1)[0])["index"]
+        suggestion = suggestions[index]
+        return (
+            suggestion["plot_type"],
+            suggestion["x"],
+            suggestion["y"],
+            suggestion["group"],
+            suggestion["aggregation"],
+        )
+
+    @app.callback(
+        Output("query-cache-stats", "children"),
+        Input("db-data", "data"),
+        prevent_initial_call=True,
+    )
+    def update_query_cache_stats(data):
+        stats = query_cache.stats()
+        return f"Query cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} cached results"
+
+    @app.callback(
+        Output("figure-update", "data"),
+        Output("plot-notice", "children"),
+        Output("plot-params", "data"),
         Input("plot_btn", "n_clicks"),
+        Input("data_graph", "relayoutData"),
         State("db-data", "data"),
         State("plot_type", "value"),
         State("plot_x_axis", "value"),
         State("plot_y_axis", "value"),
         State("plot_group_by_col", "value"),
+        State("plot-aggregation", "value"),
+        State("plot-params", "data"),
+        State("figure-client-cache", "data"),
+        State("database-config", "data"),
+        State("data_source", "value"),
         prevent_initial_call=True,
     )
-    def visualize_data(n_clicks, data, plot_type, x_axis_col, y_axis_col, group_by_col):
-        if n_clicks == 0:
+    def visualize_data(
+        n_clicks,
+        relayout_data,
+        data,
+        plot_type,
+        x_axis_col,
+        y_axis_col,
+        group_by_col,
+        aggregation,
+        plot_params,
+        client_figures,
+        db_config,
+        data_source,
+    ):
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+
+        x_range = y_range = None
+        if trigger == "data_graph.relayoutData":
+            # Only plots that don't show every point need finer detail when zooming
+            ranges = plots.zoom_ranges(relayout_data)
+            if ranges is None or plot_params is None or not plot_params["reduced"]:
+                raise PreventUpdate
+            x_range, y_range = ranges
+            data = plot_params["data"]
+            plot_type = plot_params["plot_type"]
+            x_axis_col = plot_params["x_axis_col"]
+            y_axis_col = plot_params["y_axis_col"]
+            group_by_col = plot_params["group_by_col"]
+            aggregation = "none"
+        elif n_clicks == 0 or data is None:
             raise PreventUpdate
 
-        df = pd.read_json(data, orient="split")
-        if x_axis_col not in df.columns:
+        if plot_type == "histogram" and aggregation == "none":
+            aggregation = "count"
+
+        if x_axis_col not in data["columns"]:
             raise PreventUpdate  # Maybe show an error for this case
 
-        if y_axis_col not in df.columns:
-            raise PreventUpdate
+        if y_axis_col not in data["columns"]:
+            # Counting rows doesn't need a y column
+            if aggregation != "count" or plot_type == "pie":
+                raise PreventUpdate
+            y_axis_col = None
 
-        if group_by_col not in df.columns:
+        if group_by_col not in data["columns"]:
             group_by_col = None
 
-        if plot_type == "scatter":
-            fig = px.scatter(
-                df,
-                x=x_axis_col,
-                y=y_axis_col,
-                color=group_by_col,
-            )
-        elif plot_type == "line":
-            fig = px.line(
-                df,
-                x=x_axis_col,
-                y=y_axis_col,
-                color=group_by_col,
-            )
-        elif plot_type == "bar":
-            fig = px.bar(
-                df,
-                x=x_axis_col,
-                y=y_axis_col,
-                color=group_by_col,
+        key = figure_cache.figure_key(
+            data["result_id"], plot_type, x_axis_col, y_axis_col, group_by_col, aggregation, x_range, y_range
+        )
+        cached = figure_cache.get(key)
+        # A plot that was built before (e.g the user went back to a plot type or grouping they viewed)
+        # is not built again
+        if cached is None:
+            fig, message = build_plot(
+                data,
+                plot_type,
+                x_axis_col,
+                y_axis_col,
+                group_by_col,
+                aggregation,
+                x_range,
+                y_range,
+                db_config,
+                data_source,
             )
-        elif plot_type == "pie":
-            fig = px.pie(df, values=x_axis_col, names=y_axis_col)
-        return fig
+            if fig is None:
+                return dash.no_update, message, dash.no_update
+            cached = figure_cache.put(key, fig, message, message is not None and aggregation == "none")
+        _, message, reduced, _ = cached
+
+        client_keys = (client_figures or {}).get("keys", [])
+        base_key = plot_params.get("figure_key") if plot_params else None
+        update = figure_cache.figure_update(key, cached, base_key, client_keys)
+
+        if trigger == "data_graph.relayoutData":
+            return update, message, dash.no_update
+
+        plot_params = {
+            "data": data,
+            "plot_type": plot_type,
+            "x_axis_col": x_axis_col,
+            "y_axis_col": y_axis_col,
+            "group_by_col": group_by_col,
+            "reduced": reduced,
+            "figure_key": key,
+        }
+        return update, message, plot_params
 
     @app.callback(Output("query", "value"), Input("upload-script", "contents"))
     def update_query(file_contents):
@@ -223,19 +1055,85 @@ def get_callbacks(app):
             return values_md, names_md
 
     @app.callback(
-        Output("download-figure-png", "data"),
+        Output("export-url", "data"),
+        Output("export-job", "data"),
+        Output("export-poll", "disabled"),
+        Output("export-progress", "children"),
         Input("download-btn", "n_clicks"),
+        Input("export-poll", "n_intervals"),
+        Input("cancel-export-btn", "n_clicks"),
         State("data_graph", "figure"),
+        State("export-formats", "value"),
+        State("export-width", "value"),
+        State("export-height", "value"),
+        State("export-job", "data"),
         prevent_initial_call=True,
     )
-    def download_figure(n_clicks, figure):
-        if n_clicks == 0 or figure is None:
+    def download_figure(n_clicks, n_intervals, cancel_clicks, figure, export_formats, width, height, export_job):
+        ctx = dash.callback_context
+        trigger = ctx.triggered[0]["prop_id"]
+
+        if trigger == "cancel-export-btn.n_clicks":
+            if export_job is None:
+                raise PreventUpdate
+            # The next poll reports the job as cancelled
+            jobs.cancel(export_job["job_id"])
+            raise PreventUpdate
+
+        if trigger == "export-poll.n_intervals":
+            if export_job is None:
+                raise PreventUpdate
+            job_id = export_job["job_id"]
+            status = jobs.status(job_id)
+            if status["state"] in ("queued", "running"):
+                return dash.no_update, dash.no_update, False, progress_message("Rendering figure...")
+
+            jobs.forget(job_id)
+            if status["state"] == "cancelled":
+                return dash.no_update, None, True, alert("Export cancelled", "info")
+            if status["state"] == "error":
+                return dash.no_update, None, True, alert(status["error"], "danger")
+
+            return app.get_relative_path(f"/exports/{status['result']}"), None, True, []
+
+        if n_clicks == 0 or figure is None or not export_formats:
             raise PreventUpdate
 
-        fig = go.Figure(data=figure["data"], layout=figure["layout"])
+        exports = [
+            {"figure": figure, "export_format": export_format, "width": width, "height": height}
+            for export_format in export_formats
+        ]
+        if len(exports) == 1:
+            # The same figure was exported before, it is downloaded without rendering it again
+            name = figure_export.file_name(**exports[0])
+            if figure_export.cached(name):
+                return app.get_relative_path(f"/exports/{name}"), dash.no_update, dash.no_update, []
 
-        img_bytes = fig.to_image(format="png")
-        encoding = b64encode(img_bytes).decode()
+        job_id = jobs.submit(tasks.export_figures, exports)
+        return dash.no_update, {"job_id": job_id}, False, progress_message("Rendering figure...")
 
-        data = {"base64": True, "content": encoding, "filename": "figure.png", "type": None}
-        return data
+    # The figure-update of visualize_data is applied in the browser by assets/figure_updates.js,
+    # it keeps the last figures so that going back to one of them doesn't send it again
+    app.clientside_callback(
+        ClientsideFunction(namespace="figures", function_name="apply"),
+        Output("data_graph", "figure"),
+        Output("figure-client-cache", "data"),
+        Input("figure-update", "data"),
+        State("figure-client-cache", "data"),
+        prevent_initial_call=True,
+    )
+
+    app.clientside_callback(
+        """
+        function(url) {
+            if (url) {
+                // The file is sent as an attachment so the page stays where it is
+                window.location.assign(url);
+            }
+            return window.dash_clientside.no_update;
+        }
+        """,
+        Output("export-download", "children"),
+        Input("export-url", "data"),
+        prevent_initial_call=True,
+    )
@@ -1,16 +1,168 @@
-import database_controllers.mysql as mysql
-#import database_controllers.mariadb as mariadb
-#import database_controllers.postgres as postgres
+import os
+import tempfile
 
-database_sources = ["mysql"]#, "mariadb", "postgres"]
+from database_controllers import registry
 
-data_sources = database_sources + ["csv", "excel"]
-plot_types = ["scatter", "line", "bar", "pie"]
+# The databases that can be selected, the ones whose driver is not installed are left out.
+# Their controllers (and drivers) are imported the first time they are used, see database_controllers.registry
+database_sources = registry.installed(os.environ.get("DATABASE_SOURCES", "mysql,mariadb,postgres").split(","))
 
-# Create these dynamically
-database_connection_functions = {"mysql": mysql.connect}#,"mariadb": mariadb.connect ,"postgres": postgres.connect}
-database_execute_functions = {
-    #"mariadb": mariadb.execute_query,
-    "mysql": mysql.execute_query,
-    #"postgres": postgres.execute_query,
+# Uploaded csv/excel files are queried with SQL by an embedded DuckDB database,
+# without DuckDB the queries are pandas DataFrame.query filters.
+# "local" queries the snapshots of database tables (see services.snapshots) with the uploaded file, it needs DuckDB
+file_sql_sources = registry.installed(["csv", "excel", "local"])
+
+data_sources = database_sources + ["csv", "excel"] + [source for source in file_sql_sources if source == "local"]
+plot_types = ["scatter", "line", "bar", "pie", "histogram"]
+
+database_connection_functions = registry.FunctionMap("connect", database_sources)
+database_execute_functions = registry.FunctionMap("execute_query", database_sources + file_sql_sources)
+database_stream_functions = registry.FunctionMap("stream_query", database_sources + file_sql_sources)
+database_cancel_functions = registry.FunctionMap("cancel_query", database_sources)
+database_freshness_functions = registry.FunctionMap("table_versions", database_sources)
+# The statements of a script that share session state run on one pooled connection
+database_session_functions = registry.FunctionMap("session_connection", database_sources)
+database_statement_functions = registry.FunctionMap("execute_statement", database_sources)
+# The tables (with their row estimates) and the columns of a table, read from the catalog and cached by schema_cache
+database_tables_functions = registry.FunctionMap("list_tables", database_sources)
+database_columns_functions = registry.FunctionMap("table_columns", database_sources)
+# Random samples of tables for the previews
+database_sample_functions = registry.FunctionMap("sample_table", database_sources)
+# Row and cost estimates of the queries the users type, for the admission control of services.admission
+database_explain_functions = registry.FunctionMap("explain_query", database_sources)
+
+# How to quote identifiers and write parameter placeholders in the sql we generate
+database_sql_dialects = {
+    "mysql": {"quote": "`", "placeholder": "%s", "text_type": "CHAR"},
+    "mariadb": {"quote": "`", "placeholder": "?", "text_type": "CHAR"},
+    "postgres": {"quote": '"', "placeholder": "%s", "text_type": "TEXT"},
+    "csv": {"quote": '"', "placeholder": "?", "text_type": "VARCHAR"},
+    "excel": {"quote": '"', "placeholder": "?", "text_type": "VARCHAR"},
+    "local": {"quote": '"', "placeholder": "?", "text_type": "VARCHAR"},
 }
+
+# Directory for state that all gunicorn workers share (e.g the running queries)
+shared_state_dir = os.environ.get("SHARED_STATE_DIR", os.path.join(tempfile.gettempdir(), "dashproject"))
+
+# Server-side result store, the browser only keeps the id and the schema of a result
+result_store_max_bytes = int(os.environ.get("RESULT_STORE_MAX_BYTES", 512 * 1024 * 1024))
+# Directory shared by all gunicorn workers (and background jobs) to spill results to,
+# an empty value keeps results in memory only which needs JOB_EXECUTOR=thread and a single worker
+result_store_spill_dir = os.environ.get("RESULT_STORE_SPILL_DIR", os.path.join(shared_state_dir, "results")) or None
+result_store_spill_max_bytes = int(os.environ.get("RESULT_STORE_SPILL_MAX_BYTES", 4 * 1024 * 1024 * 1024))
+# The uploaded files are kept as Arrow datasets in the shared directory, the least recently used ones
+# are removed when they take more than this
+datasets_max_bytes = int(os.environ.get("DATASETS_MAX_BYTES", 4 * 1024 * 1024 * 1024))
+# Format of the spilled results: "arrow" (Arrow IPC, memory-mapped when read), "parquet" or "json"
+result_serializer = os.environ.get("RESULT_SERIALIZER", "arrow")
+# Compression codec of the spilled results (e.g zstd), compressed arrow files can't be read without a copy
+result_compression = os.environ.get("RESULT_COMPRESSION") or None
+
+# Database connection pools, one per (host, user, database) in each worker
+pool_max_size = int(os.environ.get("POOL_MAX_SIZE", 5))
+# Idle connections older than this (in seconds) are closed instead of reused
+pool_idle_timeout = int(os.environ.get("POOL_IDLE_TIMEOUT", 300))
+# Ping idle connections before handing them out
+pool_pre_ping = os.environ.get("POOL_PRE_PING", "1") == "1"
+# Seconds to wait for a free connection when the pool is full
+pool_wait_timeout = int(os.environ.get("POOL_WAIT_TIMEOUT", 30))
+
+# Limits for loading a query result, larger results are truncated
+query_max_rows = int(os.environ.get("QUERY_MAX_ROWS", 1_000_000))
+query_max_bytes = int(os.environ.get("QUERY_MAX_BYTES", 256 * 1024 * 1024))
+query_fetch_batch_size = int(os.environ.get("QUERY_FETCH_BATCH_SIZE", 10_000))
+# Every statement on a pooled database connection is stopped by the database after this many seconds, 0 disables it
+statement_timeout = float(os.environ.get("STATEMENT_TIMEOUT", 300))
+
+# Queries that the users type are estimated with EXPLAIN before they run. Above the confirm limits the user
+# has to confirm that the query should run, above the reject limits it doesn't run. Rows are the most rows a step
+# of the plan processes, costs are in the units of each database. 0 disables a limit
+admission_confirm_rows = int(os.environ.get("ADMISSION_CONFIRM_ROWS", 10_000_000))
+admission_reject_rows = int(os.environ.get("ADMISSION_REJECT_ROWS", 1_000_000_000))
+admission_confirm_cost = float(os.environ.get("ADMISSION_CONFIRM_COST", 0))
+admission_reject_cost = float(os.environ.get("ADMISSION_REJECT_COST", 0))
+# Most database queries that run at the same time across all the workers, and per connection identity (database
+# and user), the others wait in a queue for at most admission_queue_timeout seconds. 0 disables a limit.
+# A script takes one slot for every connection it runs statements on, table pages and plot aggregations take one
+admission_max_queries = int(os.environ.get("ADMISSION_MAX_QUERIES", 8))
+admission_max_queries_per_connection = int(os.environ.get("ADMISSION_MAX_QUERIES_PER_CONNECTION", 2))
+admission_queue_timeout = int(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 300))
+# The queries that run inside web requests (table pages, plot aggregations) wait at most this long,
+# the web workers must not be held by the queue
+admission_request_timeout = float(os.environ.get("ADMISSION_REQUEST_TIMEOUT", 5))
+# How often (in seconds) a waiting query checks for a free slot
+admission_poll_interval = float(os.environ.get("ADMISSION_POLL_INTERVAL", 0.2))
+
+# Queries and figure exports run as background jobs, in a "process" or a "thread" pool
+job_executor = os.environ.get("JOB_EXECUTOR", "process")
+job_workers = int(os.environ.get("JOB_WORKERS", 2))
+# How often (in milliseconds) the browser polls a running job
+job_poll_interval = int(os.environ.get("JOB_POLL_INTERVAL", 500))
+
+# Cache of query results, entries expire after a ttl (in seconds) or when the tables they read change
+query_cache_ttl = int(os.environ.get("QUERY_CACHE_TTL", 600))
+query_cache_max_bytes = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Block size (in bytes) that large uploaded csv files are converted to datasets with
+upload_block_size = int(os.environ.get("UPLOAD_BLOCK_SIZE", 16 * 1024 * 1024))
+
+# Render budget of the plots, above plot_max_points scatter plots switch to WebGL, lines are downsampled
+# and bars/pies are aggregated, above plot_max_webgl_points scatter plots become a density heatmap
+plot_max_points = int(os.environ.get("PLOT_MAX_POINTS", 5000))
+plot_max_webgl_points = int(os.environ.get("PLOT_MAX_WEBGL_POINTS", 200_000))
+plot_density_bins = int(os.environ.get("PLOT_DENSITY_BINS", 200))
+# "lttb" or "minmax"
+plot_line_downsampling = os.environ.get("PLOT_LINE_DOWNSAMPLING", "lttb")
+# Number of bins of histograms, and the most points an aggregated plot can have
+plot_histogram_bins = int(os.environ.get("PLOT_HISTOGRAM_BINS", 50))
+plot_aggregate_max_rows = int(os.environ.get("PLOT_AGGREGATE_MAX_ROWS", 100_000))
+
+# Most independent statements of a script that run at the same time, each on its own pooled connection.
+# The statements that share session state use one more connection, keep it below POOL_MAX_SIZE
+script_max_parallel = int(os.environ.get("SCRIPT_MAX_PARALLEL", 4))
+
+# Exported figures are cached on disk by the hash of their spec, format and size
+export_cache_max_bytes = int(os.environ.get("EXPORT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Start the kaleido renderer of every job process when it starts instead of on the first export
+export_warm_up = os.environ.get("EXPORT_WARM_UP", "1") == "1"
+
+# Callbacks slower than this (in seconds) are logged with the input that triggered them, 0 disables the log
+slow_callback_seconds = float(os.environ.get("SLOW_CALLBACK_SECONDS", 2))
+# How often (in seconds) a web worker writes its metrics for /metrics at most
+metrics_flush_interval = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+
+# The tables and columns of every database are cached per connection identity and shared by its users,
+# entries older than schema_cache_ttl (in seconds) are served while they are reloaded in the background
+schema_cache_ttl = int(os.environ.get("SCHEMA_CACHE_TTL", 300))
+schema_cache_max_entries = int(os.environ.get("SCHEMA_CACHE_MAX_ENTRIES", 1000))
+# Most tables the tables dropdown shows for what the user types
+schema_search_limit = int(os.environ.get("SCHEMA_SEARCH_LIMIT", 100))
+
+# Selecting a table shows a preview of preview_sample_size rows (the user can change it): "sample" is a random sample
+# of the table, "first" its first rows. Tables above preview_scan_max_rows estimated rows are sampled by the database
+# (TABLESAMPLE, random key ranges), smaller ones are read whole and sampled as they stream in
+preview_mode = os.environ.get("PREVIEW_MODE", "sample")
+preview_sample_size = int(os.environ.get("PREVIEW_SAMPLE_SIZE", 1000))
+preview_scan_max_rows = int(os.environ.get("PREVIEW_SCAN_MAX_ROWS", 100_000))
+
+# Figures of plots are cached by (result, plot type, columns, aggregation, zoom), the least recently used are evicted
+# above figure_cache_max_bytes (of their JSON). The browser keeps the last figure_client_cache_size figures it was sent
+figure_cache_max_bytes = int(os.environ.get("FIGURE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+figure_client_cache_size = int(os.environ.get("FIGURE_CLIENT_CACHE_SIZE", 5))
+
+# Every loaded result is profiled (nulls, distinct values, quantiles, histograms) in one pass over
+# chunks of profile_chunk_rows rows, quantiles and histograms come from a sample of profile_sample_size rows
+profile_chunk_rows = int(os.environ.get("PROFILE_CHUNK_ROWS", 1_000_000))
+profile_sample_size = int(os.environ.get("PROFILE_SAMPLE_SIZE", 10_000))
+
+# Snapshots of database tables are copied in Parquet partitions of at most snapshot_partition_rows rows
+# (and QUERY_MAX_BYTES bytes), above snapshot_max_partitions partitions a refresh compacts them into one
+snapshot_dir = os.environ.get("SNAPSHOT_DIR", os.path.join(shared_state_dir, "snapshots"))
+snapshot_partition_rows = int(os.environ.get("SNAPSHOT_PARTITION_ROWS", 1_000_000))
+snapshot_max_partitions = int(os.environ.get("SNAPSHOT_MAX_PARTITIONS", 16))
+# The browsers keep the ids of their snapshots, the snapshots that no browser listed or queried
+# for SNAPSHOT_MAX_IDLE_AGE seconds are removed
+snapshot_max_idle_age = int(os.environ.get("SNAPSHOT_MAX_IDLE_AGE", 30 * 24 * 60 * 60))
+
+# Level of the logs of the app (e.g the startup time report and the slow callbacks)
+log_level = os.environ.get("LOG_LEVEL", "INFO")
@@ -0,0 +1,60 @@
+import duckdb
+
+from database_controllers import streaming
+from services import datasets
+from services import snapshots
+
+# Queries read the uploaded file from this table
+TABLE_NAME = "data"
+
+
+def get_connection(config):
+    """
+    Open an in-memory DuckDB database where the dataset in config (if any) is the "data" table
+    and every snapshot in config["snapshots"] (a list of snapshot ids) is a view with the name of the snapshot.
+    DuckDB scans the memory-mapped Arrow file of the dataset and the Parquet partitions of the snapshots directly,
+    so only the columns a query uses are read and nothing is copied to pandas first.
+    """
+    conn = duckdb.connect(database=":memory:")
+    if config.get("dataset_id") is not None:
+        conn.register(TABLE_NAME, datasets.load_table(config["dataset_id"]))
+    for name, view_sql in snapshots.views(config.get("snapshots", [])):
+        conn.execute(f'CREATE OR REPLACE VIEW "{name}" AS {view_sql}')
+    return conn
+
+
+def execute_query(config, query, params=None):
+    """
+    Function to execute an sql query on an uploaded file and the local snapshots,
+    config is a dictionary with the dataset_id of the file and the ids of the snapshots
+    Returns a tuple that contains:
+    0. A list with the column names of the result
+    1. A list of the tuples with the rows of the result
+    params are passed to the driver for the placeholders of the query
+    """
+    conn = get_connection(config)
+    try:
+        cursor = conn.execute(query, params)
+        columns = [i[0] for i in cursor.description]
+        results = cursor.fetchall()
+    finally:
+        conn.close()
+
+    return columns, results
+
+
+def stream_query(config, query, max_rows, max_bytes, query_token=None, on_batch=None):
+    """
+    Function to execute an sql query on an uploaded file and the local snapshots and read its result in Arrow batches,
+    it stops reading after max_rows rows or max_bytes bytes.
+    The query runs in this process, it is cancelled between batches by on_batch so query_token is not used.
+    Returns a tuple that contains:
+    0. A dataframe with the result
+    1. True if the result was truncated
+    """
+    conn = get_connection(config)
+    try:
+        result = conn.execute(query)
+        return streaming.fetch_arrow_dataframe(result, max_rows, max_bytes, on_batch)
+    finally:
+        conn.close()
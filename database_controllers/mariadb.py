@@ -1,24 +1,60 @@
+import random
+from contextlib import contextmanager
+
 import mariadb
 
+from database_controllers import pool
+from database_controllers import running_queries
+from database_controllers import streaming
+
+# Number of random key ranges a sample of a big table is read from
+SAMPLE_RANGES = 50
+
 
 def get_connection(host, user, password, database):
     return mariadb.connect(user=user, password=password, host=host, database=database, port=3306)
 
 
-def connect(host, user, password, database):
+def _ping(conn):
+    conn.ping()
+
+
+def _open(config):
+    conn = mariadb.connect(**config)
+    timeout = pool.statement_timeout()
+    if timeout:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET SESSION max_statement_time = {float(timeout)}")
+    return conn
+
+
+def connection(config):
     """
-    Function to connect to MariaDB database.
-    It returns a tuple that contains:
-    0. The tables of the database in a list
-    1. MariaDB configuration dictionary
+    Context manager that borrows a connection to the database in config from the connection pool
     """
-    conn = get_connection(host, user, password, database)
-    with conn.cursor() as cursor:
-        cursor.execute("SHOW TABLES")
-        tables = [x[0] for x in cursor]
+    return pool.get_pool("mariadb", config, lambda: _open(config), _ping).connection()
 
-    conn.close()
 
+@contextmanager
+def session_connection(config):
+    """
+    Context manager that borrows a connection for the statements of a script that share session state.
+    Every statement is committed when it finishes, like in the MariaDB client, BEGIN still starts a transaction.
+    The connection is closed afterwards so its temporary tables and variables don't leak to the next user of the pool.
+    """
+    with connection(config) as conn:
+        try:
+            conn.autocommit = True
+            yield conn
+        finally:
+            conn.close()
+
+
+def connect(host, user, password, database):
+    """
+    Function to connect to MariaDB database, it checks that the database accepts the credentials
+    and returns the MariaDB configuration dictionary. The tables are listed with list_tables.
+    """
     # Mariadb information to store in browser memory for future use
     mariadb_info = {
         "user": user,
@@ -27,21 +63,249 @@ def connect(host, user, password, database):
         "database": database,
     }
 
-    return tables, mariadb_info
+    with connection(mariadb_info) as conn:
+        _ping(conn)
+
+    return mariadb_info
 
 
-def execute_query(config, query):
+def list_tables(config):
+    """
+    Function to list the tables of the database with their estimated number of rows,
+    the estimates come from the table statistics so no table is scanned.
+    Returns a list of (table name, estimated rows) tuples, the estimate is None when it is unknown
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.tables "
+                "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME"
+            )
+            return [(name, None if rows is None else int(rows)) for name, rows in cursor]
+
+
+def table_columns(config, table):
+    """
+    Function to get the columns of a table, it returns a list of (column name, column type) tuples
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT COLUMN_NAME, COLUMN_TYPE FROM information_schema.columns "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? ORDER BY ORDINAL_POSITION",
+                (table,),
+            )
+            return cursor.fetchall()
+
+
+def execute_query(config, query, params=None):
     """
     Function to execure an sql query,config is a dictionary with connection information to connect to the database
     Returns a tuple that contains:
     0. A list with the column names of the result
     1. A list of the tuples with the rows of the result
+    params are passed to the driver for the placeholders of the query
     """
-    conn = mariadb.connect(**config)
-    with conn.cursor() as cursor:
-        cursor.execute(query)
-        columns = [i[0] for i in cursor.description]
-        results = cursor.fetchall()
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params or ())
+            columns = [i[0] for i in cursor.description]
+            results = cursor.fetchall()
 
-    conn.close()
     return columns, results
+
+
+def stream_query(config, query, max_rows, max_bytes, query_token=None, on_batch=None):
+    """
+    Function to execute an sql query and read its result in batches,
+    it stops reading after max_rows rows or max_bytes bytes.
+    If query_token is given the query can be cancelled with cancel_query while it runs.
+    Returns a tuple that contains:
+    0. A dataframe with the result
+    1. True if the result was truncated
+    """
+    with connection(config) as conn:
+        cursor = conn.cursor(buffered=False)
+        with running_queries.running(query_token, "mariadb", conn.connection_id):
+            cursor.execute(query)
+            df, truncated = streaming.fetch_dataframe(cursor, max_rows, max_bytes, on_batch)
+
+        if truncated:
+            # Closing the cursor would read the rest of the result,
+            # stop the query on the server and drop the connection instead
+            cancel_query(config, conn.connection_id)
+            conn.close()
+        else:
+            cursor.close()
+
+    return df, truncated
+
+
+def _plan_rows(columns, plan):
+    """
+    Return the most rows a step of a tabular EXPLAIN processes. The tables of a select are joined in
+    nested loops, every row that the previous tables produce is matched with the rows of the next table.
+    """
+    largest = None
+    produced = {}  # select id -> rows the tables of the select so far produce
+    for row in plan:
+        row = dict(zip([column.lower() for column in columns], row))
+        if row.get("rows") is None:
+            continue
+        processed = produced.get(row["id"], 1) * float(row["rows"])
+        produced[row["id"]] = processed * float(row.get("filtered") or 100) / 100
+        largest = processed if largest is None else max(largest, processed)
+    return largest
+
+
+def explain_query(config, query, params=None):
+    """
+    Function to estimate what a query costs without running it, from the plan of the optimizer.
+    params are passed to the driver for the placeholders of the query
+    Returns a tuple that contains:
+    0. The most rows a step of the plan processes, None if it is unknown
+    1. The cost of the plan, always None as MariaDB doesn't report it
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {query}", params or ())
+            rows = _plan_rows([column[0] for column in cursor.description], cursor.fetchall())
+
+    return rows, None
+
+
+def _quote(identifier):
+    return "`" + str(identifier).replace("`", "``") + "`"
+
+
+def _key_range(cursor, table):
+    """
+    Return the name, the smallest and the largest value of the primary key of a table
+    if it is one integer column, None otherwise
+    """
+    cursor.execute(
+        "SELECT k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k "
+        "JOIN information_schema.COLUMNS c ON c.TABLE_SCHEMA = k.TABLE_SCHEMA "
+        "AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME "
+        "WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = ? AND k.CONSTRAINT_NAME = 'PRIMARY'",
+        (table,),
+    )
+    columns = cursor.fetchall()
+    if len(columns) != 1 or columns[0][1].lower() not in ("tinyint", "smallint", "mediumint", "int", "bigint"):
+        return None
+
+    primary_key = columns[0][0]
+    cursor.execute(f"SELECT MIN({_quote(primary_key)}), MAX({_quote(primary_key)}) FROM {_quote(table)}")
+    low, high = cursor.fetchall()[0]
+    if low is None:
+        return None
+    return primary_key, low, high
+
+
+def sample_table(config, table, sample_size, row_estimate, scan_max_rows, query_token=None, on_batch=None):
+    """
+    Function to read a random sample of sample_size rows of a table.
+    Tables with more than scan_max_rows estimated rows are sampled on the server: with index range scans
+    that start at random keys if the table has an integer primary key (gaps in the keys make the rows after them
+    a bit more likely), otherwise with a RAND() filter. Smaller tables, and tables without a row estimate,
+    are read whole and sampled as they stream in.
+    If query_token is given the sampling can be cancelled with cancel_query while it runs.
+    on_batch, if given, is called with the rows read and the rows kept so far after every batch.
+    Returns a tuple that contains:
+    0. A dataframe with the sample
+    1. The sampling method
+    """
+    with connection(config) as conn:
+        cursor = conn.cursor(buffered=False)
+        query = f"SELECT * FROM {_quote(table)}"
+        params = ()
+        method = "reservoir sampling of a full scan"
+        key_range = None
+        if row_estimate is not None and row_estimate > scan_max_rows:
+            key_range = _key_range(cursor, table)
+            if key_range is not None:
+                primary_key, low, high = key_range
+                ranges = min(SAMPLE_RANGES, sample_size)
+                rows_per_range = -(-sample_size // ranges)
+                part = (
+                    f"(SELECT * FROM {_quote(table)} WHERE {_quote(primary_key)} >= ? "
+                    f"ORDER BY {_quote(primary_key)} LIMIT {rows_per_range})"
+                )
+                query = " UNION ALL ".join([part] * ranges)
+                params = sorted(random.randint(low, high) for _ in range(ranges))
+                method = "random primary key ranges"
+            else:
+                # Twice the rows that are needed, in case the estimate is too high
+                query += " WHERE RAND() < ?"
+                params = (min(1.0, 2 * sample_size / row_estimate),)
+                method = "random filter"
+
+        with running_queries.running(query_token, "mariadb", conn.connection_id):
+            cursor.execute(query, params)
+            df, _ = streaming.reservoir_dataframe(cursor, sample_size, on_batch)
+        cursor.close()
+
+    if key_range is not None:
+        # Ranges that start close to each other overlap
+        df = df.drop_duplicates(subset=primary_key, ignore_index=True)
+    return df, method
+
+
+def execute_statement(conn, query, max_rows, max_bytes, query_token=None):
+    """
+    Function to execute one statement of a script on a connection that was borrowed with connection(),
+    the statements that share session state (temporary tables, variables) run one after the other on it.
+    If query_token is given the statement can be cancelled with cancel_query while it runs.
+    Returns a tuple that contains:
+    0. A dataframe with the result, None if the statement doesn't return rows
+    1. True if the result was truncated
+    2. The number of rows that the statement returned or changed
+    """
+    # Closing the cursor reads the rest of a truncated result, the connection is needed for the next statements
+    with conn.cursor(buffered=False) as cursor:
+        with running_queries.running(query_token, "mariadb", conn.connection_id):
+            cursor.execute(query)
+            if cursor.description is None:
+                return None, False, cursor.rowcount
+            df, truncated = streaming.fetch_dataframe(cursor, max_rows, max_bytes)
+
+    return df, truncated, len(df)
+
+
+def cancel_query(config, backend_id):
+    """
+    Function to cancel the query that runs in the connection with id backend_id
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"KILL QUERY {int(backend_id)}")
+
+
+def table_versions(config, tables):
+    """
+    Function to probe if tables changed, tables are names that can be schema qualified (e.g db.a).
+    It returns a dictionary with the update time and the row estimate of each table, None for the ones
+    whose changes can't be told (views, tables that don't exist, and tables without an update time)
+    """
+    names = [table.rpartition(".") for table in tables]
+    conditions = " OR ".join(["(TABLE_SCHEMA = COALESCE(?, DATABASE()) AND TABLE_NAME = ?)"] * len(names))
+    params = [value for schema, _, name in names for value in (schema or None, name)]
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT DATABASE(), TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE, UPDATE_TIME, TABLE_ROWS "
+                f"FROM information_schema.tables WHERE {conditions}",
+                params,
+            )
+            rows = cursor.fetchall()
+
+    # Names without a schema are in the database of the connection
+    database = rows[0][0] if rows else None
+    found = {}
+    for _, schema, name, table_type, update_time, table_rows in rows:
+        if table_type == "BASE TABLE" and update_time is not None:
+            found[(schema.lower(), name.lower())] = (update_time, table_rows)
+    return {
+        table: found.get(((schema or database or "").lower(), name.lower()))
+        for table, (schema, _, name) in zip(tables, names)
+    }
@@ -0,0 +1,207 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    A pool of connections to one database.
+    Connections are checked out with connection(), idle connections older than
+    idle_timeout are closed and, if pre_ping is set, every idle connection is
+    pinged before it is handed out again.
+    """
+
+    def __init__(self, connect_func, ping_func, max_size, idle_timeout, pre_ping, wait_timeout):
+        self.connect_func = connect_func
+        self.ping_func = ping_func
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pre_ping = pre_ping
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+        self._idle = []  # (connection, time it was released), most recently used last
+        self._size = 0  # Number of open connections, idle or checked out
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def stats(self):
+        self._check_fork()
+        with self._cond:
+            return {"hits": self.hits, "misses": self.misses, "size": self._size, "idle": len(self._idle)}
+
+    def _acquire(self):
+        self._check_fork()
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            candidate = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        candidate = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        self.misses += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"No database connection available after {self.wait_timeout} seconds")
+                    self._cond.wait(remaining)
+
+            if candidate is None:
+                return self._open()
+
+            conn, released_at = candidate
+            if self._is_healthy(conn, released_at):
+                with self._cond:
+                    self.hits += 1
+                return conn
+            self._discard(conn)
+
+    def _release(self, conn):
+        try:
+            # Don't leave an open transaction (or unread results) behind for the next user
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            if os.getpid() != self._pid:
+                return
+            self._idle.append((conn, now))
+            expired = [entry for entry in self._idle if now - entry[1] > self.idle_timeout]
+            self._idle = [entry for entry in self._idle if now - entry[1] <= self.idle_timeout]
+            self._cond.notify()
+
+        for expired_conn, _ in expired:
+            self._discard(expired_conn)
+
+    def _open(self):
+        try:
+            return self.connect_func()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _is_healthy(self, conn, released_at):
+        if time.monotonic() - released_at > self.idle_timeout:
+            return False
+        if not self.pre_ping:
+            return True
+        try:
+            self.ping_func(conn)
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _check_fork(self):
+        """
+        Connections opened before a fork (e.g. by the gunicorn master) can't be shared with the child
+        """
+        if os.getpid() == self._pid:
+            return
+        with self._cond:
+            if os.getpid() != self._pid:
+                self._idle = []
+                self._size = 0
+                # The counters of the parent are reported by the parent
+                self.hits = 0
+                self.misses = 0
+                self._pid = os.getpid()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool_key(driver, db_config):
+    """
+    Return the key of the pool for a database configuration.
+    The password is part of the key (hashed) so that a wrong password
+    can't borrow a connection that someone else opened.
+    """
+    password_hash = hashlib.sha256(str(db_config.get("password")).encode()).hexdigest()[:16]
+    database = db_config.get("database", db_config.get("dbname"))
+    return (driver, db_config.get("host"), db_config.get("port"), db_config.get("user"), database, password_hash)
+
+
+def statement_timeout():
+    """
+    Return the timeout (in seconds) that the controllers set on the connections of their pools, 0 if there is none
+    """
+    return config.statement_timeout
+
+
+def get_pool(driver, db_config, connect_func, ping_func):
+    """
+    Return the pool of this worker for the database in db_config, creating it if needed
+    """
+    key = pool_key(driver, db_config)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                connect_func,
+                ping_func,
+                max_size=config.pool_max_size,
+                idle_timeout=config.pool_idle_timeout,
+                pre_ping=config.pool_pre_ping,
+                wait_timeout=config.pool_wait_timeout,
+            )
+            _pools[key] = pool
+    return pool
+
+
+def pool_stats():
+    """
+    Return the hit and miss counters of all the pools of this worker.
+    It returns a dictionary with:
+    0. hits: Connections that were reused from a pool
+    1. misses: Connections that had to be opened
+    2. pools: The stats of each pool keyed by "driver://user@host/database",
+       the pools of the same address with different passwords are added up
+    """
+    with _pools_lock:
+        pools = dict(_pools)
+
+    stats = {"hits": 0, "misses": 0, "pools": {}}
+    for (driver, host, port, user, database, _), pool in pools.items():
+        pool_stats = pool.stats()
+        stats["hits"] += pool_stats["hits"]
+        stats["misses"] += pool_stats["misses"]
+        address = f"{host}:{port}" if port else host
+        name = f"{driver}://{user}@{address}/{database}"
+        if name in stats["pools"]:
+            pool_stats = {key: value + pool_stats[key] for key, value in stats["pools"][name].items()}
+        stats["pools"][name] = pool_stats
+    return stats
@@ -1,24 +1,59 @@
+import uuid
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+
+from database_controllers import pool
+from database_controllers import running_queries
+from database_controllers import streaming
 
 
 def get_connection(host, user, password, database):
     return psycopg2.connect(user=user, password=password, host=host, dbname=database)
 
 
-def connect(host, user, password, database):
+def _ping(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1")
+
+
+def _open(config):
+    timeout = pool.statement_timeout()
+    if timeout:
+        return psycopg2.connect(**config, options=f"-c statement_timeout={int(timeout * 1000)}")
+    return psycopg2.connect(**config)
+
+
+def connection(config):
     """
-    Function to connect to Postgres database.
-    It returns a tuple that contains:
-    0. The tables of the database in a list
-    1. Postgres configuration dictionary
+    Context manager that borrows a connection to the database in config from the connection pool
     """
-    conn = get_connection(host, user, password, database)
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
-        tables = [x[0] for x in cursor]
+    return pool.get_pool("postgres", config, lambda: _open(config), _ping).connection()
+
+
+@contextmanager
+def session_connection(config):
+    """
+    Context manager that borrows a connection for the statements of a script that share session state.
+    Every statement is committed when it finishes, like in the Postgres client, BEGIN still starts a transaction.
+    The connection is closed afterwards so its temporary tables and variables don't leak to the next user of the pool.
+    """
+    with connection(config) as conn:
+        try:
+            # The ping of the pool started a transaction, autocommit can't be turned on inside it
+            conn.rollback()
+            conn.autocommit = True
+            yield conn
+        finally:
+            conn.close()
 
-    conn.close()
 
+def connect(host, user, password, database):
+    """
+    Function to connect to Postgres database, it checks that the database accepts the credentials
+    and returns the Postgres configuration dictionary. The tables are listed with list_tables.
+    """
     # Postgres information to store in browser memory for future use
     postgres_info = {
         "user": user,
@@ -27,21 +62,181 @@ def connect(host, user, password, database):
         "dbname": database,
     }
 
-    return tables, postgres_info
+    with connection(postgres_info) as conn:
+        _ping(conn)
 
+    return postgres_info
 
-def execute_query(config, query):
+
+def list_tables(config):
+    """
+    Function to list the tables of the database with their estimated number of rows,
+    the estimates come from the planner statistics (pg_class.reltuples) so no table is scanned.
+    Returns a list of (table name, estimated rows) tuples, the estimate is None when it is unknown
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname, c.reltuples::bigint FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'm', 'f') ORDER BY c.relname"
+            )
+            # Tables that were never analyzed have -1 (0 before Postgres 14) rows
+            return [(name, rows if rows > 0 else None) for name, rows in cursor]
+
+
+def table_columns(config, table):
+    """
+    Function to get the columns of a table, it returns a list of (column name, column type) tuples
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position",
+                (table,),
+            )
+            return cursor.fetchall()
+
+
+def execute_query(config, query, params=None):
     """
     Function to execure an sql query,config is a dictionary with connection information to connect to the database
     Returns a tuple that contains:
     0. A list with the column names of the result
     1. A list of the tuples with the rows of the result
+    params are passed to the driver for the placeholders of the query
     """
-    conn = psycopg2.connect(**config)
-    with conn.cursor() as cursor:
-        cursor.execute(query)
-        columns = [i[0] for i in cursor.description]
-        results = cursor.fetchall()
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            columns = [i[0] for i in cursor.description]
+            results = cursor.fetchall()
 
-    conn.close()
     return columns, results
+
+
+def stream_query(config, query, max_rows, max_bytes, query_token=None, on_batch=None):
+    """
+    Function to execute an sql query and read its result in batches,
+    it stops reading after max_rows rows or max_bytes bytes.
+    If query_token is given the query can be cancelled with cancel_query while it runs.
+    Returns a tuple that contains:
+    0. A dataframe with the result
+    1. True if the result was truncated
+    """
+    with connection(config) as conn:
+        if query.lstrip().lower().startswith(("select", "with")):
+            # Named cursors are server-side, rows are only sent to us when they are fetched
+            cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        else:
+            cursor = conn.cursor()
+        with running_queries.running(query_token, "postgres", conn.get_backend_pid()):
+            with cursor:
+                cursor.execute(query)
+                df, truncated = streaming.fetch_dataframe(cursor, max_rows, max_bytes, on_batch)
+
+    return df, truncated
+
+
+def _plan_rows(plan):
+    # Every node of the plan has its own estimate, the largest one is the step that processes the most rows
+    return max([plan["Plan Rows"]] + [_plan_rows(child) for child in plan.get("Plans", [])])
+
+
+def explain_query(config, query, params=None):
+    """
+    Function to estimate what a query costs without running it, from the plan of the planner.
+    params are passed to the driver for the placeholders of the query
+    Returns a tuple that contains:
+    0. The most rows a node of the plan processes
+    1. The total cost of the plan in the units of the Postgres planner
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cursor.fetchone()[0][0]["Plan"]
+
+    return float(_plan_rows(plan)), float(plan["Total Cost"])
+
+
+def _quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def sample_table(config, table, sample_size, row_estimate, scan_max_rows, query_token=None, on_batch=None):
+    """
+    Function to read a random sample of sample_size rows of a table.
+    Tables with more than scan_max_rows estimated rows are sampled on the server with TABLESAMPLE SYSTEM,
+    that reads random pages of the table (rows that are stored together are sampled together).
+    Smaller tables, tables without a row estimate and views are read whole and sampled as they stream in.
+    If query_token is given the sampling can be cancelled with cancel_query while it runs.
+    on_batch, if given, is called with the rows read and the rows kept so far after every batch.
+    Returns a tuple that contains:
+    0. A dataframe with the sample
+    1. The sampling method
+    """
+    with connection(config) as conn:
+        with running_queries.running(query_token, "postgres", conn.get_backend_pid()):
+            if row_estimate is not None and row_estimate > scan_max_rows:
+                # Twice the pages that are needed, the number of rows per page varies
+                percent = min(100.0, 200.0 * sample_size / row_estimate)
+                try:
+                    with conn.cursor(name=f"sample_{uuid.uuid4().hex}") as cursor:
+                        cursor.execute(f"SELECT * FROM {_quote(table)} TABLESAMPLE SYSTEM (%s)", (percent,))
+                        df, _ = streaming.reservoir_dataframe(cursor, sample_size, on_batch)
+                    return df, "TABLESAMPLE SYSTEM"
+                except psycopg2.errors.WrongObjectType:
+                    conn.rollback()  # Views can't be sampled
+
+            with conn.cursor(name=f"sample_{uuid.uuid4().hex}") as cursor:
+                cursor.execute(f"SELECT * FROM {_quote(table)}")
+                df, _ = streaming.reservoir_dataframe(cursor, sample_size, on_batch)
+    return df, "reservoir sampling of a full scan"
+
+
+def execute_statement(conn, query, max_rows, max_bytes, query_token=None):
+    """
+    Function to execute one statement of a script on a connection that was borrowed with connection(),
+    the statements that share session state (temporary tables, variables) run one after the other on it.
+    If query_token is given the statement can be cancelled with cancel_query while it runs.
+    Returns a tuple that contains:
+    0. A dataframe with the result, None if the statement doesn't return rows
+    1. True if the result was truncated
+    2. The number of rows that the statement returned or changed
+    """
+    with conn.cursor() as cursor:
+        with running_queries.running(query_token, "postgres", conn.get_backend_pid()):
+            cursor.execute(query)
+            if cursor.description is None:
+                return None, False, cursor.rowcount
+            df, truncated = streaming.fetch_dataframe(cursor, max_rows, max_bytes)
+
+    return df, truncated, len(df)
+
+
+def cancel_query(config, backend_id):
+    """
+    Function to cancel the query that runs in the connection with backend pid backend_id
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_cancel_backend(%s)", (int(backend_id),))
+
+
+def table_versions(config, tables):
+    """
+    Function to probe if tables changed, tables are names that can be schema qualified (e.g analytics.a)
+    and are found on the search_path otherwise. It returns a dictionary with the write counters of each table,
+    None for the ones whose changes can't be told (views and tables that don't exist)
+    """
+    with connection(config) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT names.name, stats.n_tup_ins, stats.n_tup_upd, stats.n_tup_del "
+                "FROM unnest(%s::text[]) AS names(name) "
+                "JOIN pg_stat_user_tables AS stats ON stats.relid = to_regclass(names.name)",
+                (list(tables),),
+            )
+            found = {name: counters for name, *counters in cursor.fetchall()}
+    return {table: found.get(table) for table in tables}
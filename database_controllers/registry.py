@@ -0,0 +1,126 @@
+import collections.abc
+import importlib
+import importlib.util
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# data source -> (module of its controller, the package of the driver that the controller imports)
+CONTROLLERS = {
+    "mysql": ("database_controllers.mysql", "mysql.connector"),
+    "mariadb": ("database_controllers.mariadb", "mariadb"),
+    "postgres": ("database_controllers.postgres", "psycopg2"),
+    # Uploaded csv/excel files are queried with SQL by an embedded DuckDB database
+    "csv": ("database_controllers.duckdb", "duckdb"),
+    "excel": ("database_controllers.duckdb", "duckdb"),
+    # Local snapshots of database tables, queried with the uploaded file
+    "local": ("database_controllers.duckdb", "duckdb"),
+}
+
+_controllers = {}  # data source -> imported module
+_load_times = {}  # data source -> seconds it took to import its controller
+_lock = threading.Lock()
+
+
+def installed(data_sources):
+    """
+    Return the data sources whose driver is installed, without importing any driver
+    """
+    available = []
+    for data_source in data_sources:
+        driver = CONTROLLERS[data_source][1]
+        try:
+            found = importlib.util.find_spec(driver) is not None
+        except ModuleNotFoundError:
+            found = False  # The parent package of the driver is missing
+        if found:
+            available.append(data_source)
+    return available
+
+
+def controller(data_source):
+    """
+    Return the controller module of a data source, it (and its driver) is imported the first time it is used
+    """
+    module = _controllers.get(data_source)
+    if module is not None:
+        return module
+
+    with _lock:
+        if data_source not in _controllers:
+            start = time.perf_counter()
+            _controllers[data_source] = importlib.import_module(CONTROLLERS[data_source][0])
+            _load_times[data_source] = time.perf_counter() - start
+            logger.info("Loaded the %s controller in %.3fs", data_source, _load_times[data_source])
+        return _controllers[data_source]
+
+
+def load_times():
+    """
+    Return how long (in seconds) the import of each controller that was used took
+    """
+    with _lock:
+        return dict(_load_times)
+
+
+class FunctionMap(collections.abc.MutableMapping):
+    """
+    A dictionary of data source -> function_name of its controller, for the data sources of config.
+    A controller is only imported when one of its functions is looked up, checking if a data source
+    is in the map doesn't import anything.
+    Functions that are set explicitly (e.g a stand-in database of the benchmarks) are used as they are,
+    wrappers added with wrap() are applied to every function when it is looked up.
+    """
+
+    def __init__(self, function_name, data_sources):
+        self.function_name = function_name
+        self._data_sources = list(data_sources)
+        self._functions = {}  # data source -> function set explicitly
+        self._wrappers = []
+        self._resolved = {}  # data source -> function with the wrappers applied
+
+    def __getitem__(self, data_source):
+        func = self._resolved.get(data_source)
+        if func is not None:
+            return func
+
+        if data_source in self._functions:
+            func = self._functions[data_source]
+        elif data_source in self._data_sources:
+            func = getattr(controller(data_source), self.function_name)
+        else:
+            raise KeyError(data_source)
+        for wrapper in self._wrappers:
+            func = wrapper(data_source, func)
+        self._resolved[data_source] = func
+        return func
+
+    def __setitem__(self, data_source, func):
+        self._functions[data_source] = func
+        self._resolved.pop(data_source, None)
+
+    def __delitem__(self, data_source):
+        if data_source not in self:
+            raise KeyError(data_source)
+        self._functions.pop(data_source, None)
+        if data_source in self._data_sources:
+            self._data_sources.remove(data_source)
+        self._resolved.pop(data_source, None)
+
+    def __contains__(self, data_source):
+        return data_source in self._functions or data_source in self._data_sources
+
+    def __iter__(self):
+        return iter(self._data_sources + [source for source in self._functions if source not in self._data_sources])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def wrap(self, wrapper):
+        """
+        Apply wrapper(data_source, func) to the functions of the map, the ones that were looked up already included
+        """
+        self._wrappers.append(wrapper)
+        self._resolved = {}
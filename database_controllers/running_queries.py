@@ -0,0 +1,65 @@
+import json
+import os
+import re
+import uuid
+from contextlib import contextmanager
+
+import config
+
+
+def _running_dir(query_token):
+    """
+    The running queries are kept on disk so that any gunicorn worker can cancel them,
+    there is one file per query and a token can have several queries running (e.g the statements of a script)
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", query_token):
+        raise ValueError(f"Invalid query token {query_token!r}")
+    running_dir = os.path.join(config.shared_state_dir, "running_queries")
+    os.makedirs(running_dir, exist_ok=True)
+    return running_dir
+
+
+@contextmanager
+def running(query_token, data_source, backend_id):
+    """
+    Context manager that registers the query that runs in the database
+    connection with backend_id under query_token while it runs
+    """
+    if query_token is None:
+        yield
+        return
+
+    path = os.path.join(_running_dir(query_token), f"{query_token}.{uuid.uuid4().hex}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"data_source": data_source, "backend_id": backend_id}, f)
+    os.replace(tmp_path, path)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def cancel(query_token, db_config):
+    """
+    Cancel the queries that run under query_token.
+    Returns False if there is no such query running.
+    """
+    running_dir = _running_dir(query_token)
+    cancelled = False
+    for name in os.listdir(running_dir):
+        if not (name.startswith(f"{query_token}.") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(running_dir, name)) as f:
+                running_query = json.load(f)
+        except FileNotFoundError:
+            continue  # The query finished in the meantime
+
+        cancel_query_func = config.database_cancel_functions[running_query["data_source"]]
+        cancel_query_func(db_config, running_query["backend_id"])
+        cancelled = True
+    return cancelled
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import config
+from services import metrics
+
+
+def fetch_dataframe(cursor, max_rows, max_bytes, on_batch=None):
+    """
+    Read the result of an executed cursor with fetchmany, converting every
+    batch of rows to typed columns right away instead of keeping python tuples around.
+    Reading stops once max_rows rows or max_bytes bytes have been loaded.
+    on_batch, if given, is called with the rows and bytes loaded so far after every batch.
+    Returns a tuple that contains:
+    0. A dataframe with the rows that were read
+    1. True if the result has more rows than the ones that were read
+    """
+    batches = []
+    rows = 0
+    size = 0
+    columns = None
+    truncated = False
+    while True:
+        # Ask for one row more than the limit to know if the result is truncated
+        results = cursor.fetchmany(min(config.query_fetch_batch_size, max_rows - rows + 1))
+        if columns is None:
+            # Server-side cursors only know their columns after the first fetch
+            columns = [i[0] for i in cursor.description]
+        if not results:
+            break
+
+        if rows + len(results) > max_rows:
+            results = results[: max_rows - rows]
+            truncated = True
+
+        batch = pd.DataFrame.from_records(results, columns=columns)
+        batches.append(batch)
+        rows += len(batch)
+        size += int(batch.memory_usage(index=False, deep=True).sum())
+        if on_batch is not None:
+            on_batch(rows, size)
+
+        if truncated:
+            break
+        if size >= max_bytes:
+            truncated = bool(cursor.fetchmany(1))
+            break
+
+    if not batches:
+        return pd.DataFrame(columns=columns), False
+    with metrics.timed("dataframe"):
+        return pd.concat(batches, ignore_index=True, copy=False), truncated
+
+
+def reservoir_dataframe(cursor, sample_size, on_batch=None):
+    """
+    Read the whole result of an executed cursor with fetchmany and keep a uniform random sample
+    of sample_size of its rows (reservoir sampling), so memory use stays bounded whatever the size of the result.
+    on_batch, if given, is called with the rows read and the rows kept so far after every batch.
+    Returns a tuple that contains:
+    0. A dataframe with the sampled rows, in the order they were read
+    1. The number of rows that were read
+    """
+    rng = np.random.default_rng()
+    reservoir = []
+    positions = []  # Position of every kept row in the result
+    rows = 0
+    columns = None
+    while True:
+        results = cursor.fetchmany(config.query_fetch_batch_size)
+        if columns is None:
+            columns = [i[0] for i in cursor.description]
+        if not results:
+            break
+
+        free = sample_size - len(reservoir)
+        reservoir.extend(results[:free])
+        positions.extend(range(rows, rows + len(results[:free])))
+        rest = results[free:]
+        if rest:
+            # Row i of the result replaces a random kept row with probability sample_size / (i + 1)
+            first = rows + len(results) - len(rest)
+            slots = rng.integers(0, np.arange(first, first + len(rest)) + 1)
+            for offset in np.flatnonzero(slots < sample_size):
+                reservoir[slots[offset]] = rest[offset]
+                positions[slots[offset]] = first + offset
+
+        rows += len(results)
+        if on_batch is not None:
+            on_batch(rows, len(reservoir))
+
+    order = np.argsort(positions, kind="stable")
+    return pd.DataFrame.from_records([reservoir[i] for i in order], columns=columns), rows
+
+
+def fetch_arrow_dataframe(result, max_rows, max_bytes, on_batch=None):
+    """
+    Same as fetch_dataframe for engines (DuckDB) whose result can be read as pyarrow record batches,
+    the batches stay columnar until the result is converted to a dataframe once at the end.
+    """
+    reader = result.fetch_record_batch(config.query_fetch_batch_size)
+    batches = []
+    rows = 0
+    size = 0
+    truncated = False
+    while True:
+        try:
+            batch = reader.read_next_batch()
+        except StopIteration:
+            break
+
+        if rows + batch.num_rows > max_rows:
+            batch = batch.slice(0, max_rows - rows)
+            truncated = True
+
+        batches.append(batch)
+        rows += batch.num_rows
+        size += batch.nbytes
+        if on_batch is not None:
+            on_batch(rows, size)
+
+        if truncated:
+            break
+        if size >= max_bytes:
+            try:
+                truncated = reader.read_next_batch().num_rows > 0
+            except StopIteration:
+                pass
+            break
+
+    with metrics.timed("dataframe"):
+        table = pa.Table.from_batches(batches, schema=reader.schema)
+        return table.to_pandas(split_blocks=True), truncated
@@ -1,3 +1,5 @@
+import uuid
+
 from dash import dcc
 from dash import html
 
@@ -7,6 +9,8 @@ import config
 def get_layout():
     return html.Div(
         [
+            # Identifies the browser tab, e.g to cancel the query that it runs
+            dcc.Store(id="session-id", data=uuid.uuid4().hex),
             dcc.Markdown("# Visualization App", className="text-primary"),
             html.Br(),
             dcc.Markdown("#### Select your data source", className="text-primary"),
@@ -37,6 +41,14 @@ def get_layout():
                         # Don't allow multiple files to be uploaded
                         multiple=False,
                     ),
+                    html.Br(),
+                    # Large files are uploaded in chunks by assets/chunked_upload.js
+                    dcc.Markdown("##### Or upload a large file", className="text-primary"),
+                    html.Button(id="large-upload-btn", children="Select file", className="btn btn-outline-primary"),
+                    html.Div(id="large-upload-status", className="text-primary"),
+                    dcc.Input(id="large-upload-result", type="text", style={"display": "none"}),
+                    # The id of the dataset the uploaded file was parsed into
+                    dcc.Store(id="upload-dataset"),
                 ],
                 style={"display": "none"},
             ),
@@ -71,10 +83,75 @@ def get_layout():
                     html.Div(id="db-output-message"),
                     html.Br(),
                     dcc.Markdown("##### Tables", className="text-primary"),
-                    dcc.Dropdown(id="tables-dropdown", className="text-primary"),
+                    dcc.Dropdown(
+                        id="tables-dropdown", placeholder="Type to search the tables", className="text-primary"
+                    ),
+                    # Columns and estimated rows of the selected table
+                    html.Div(id="table-info"),
+                    html.Div(
+                        [
+                            dcc.RadioItems(
+                                id="preview-mode",
+                                options=[
+                                    {"label": " Random sample", "value": "sample"},
+                                    {"label": " First rows", "value": "first"},
+                                ],
+                                value=config.preview_mode,
+                                labelStyle={"display": "inline-block", "marginRight": "10px"},
+                            ),
+                            dcc.Input(
+                                id="preview-size",
+                                type="number",
+                                min=1,
+                                max=config.query_max_rows,
+                                value=config.preview_sample_size,
+                                placeholder="rows",
+                            ),
+                            html.Small(" rows in the table preview", className="text-muted"),
+                        ]
+                    ),
+                    html.Br(),
+                    # Local copies of tables (or query results) that are queried with the uploaded file,
+                    # see services.snapshots
+                    dcc.Markdown("##### Snapshot to query locally", className="text-primary"),
+                    html.Div(
+                        [
+                            dcc.Input(id="snapshot-name", type="text", placeholder="snapshot name"),
+                            dcc.RadioItems(
+                                id="snapshot-source",
+                                options=[
+                                    {"label": " The selected table", "value": "table"},
+                                    {"label": " The result of the query", "value": "query"},
+                                ],
+                                value="table",
+                                labelStyle={"display": "inline-block", "marginRight": "10px"},
+                            ),
+                            dcc.Dropdown(
+                                id="snapshot-watermark",
+                                placeholder="Watermark column, refreshes only copy the rows where it increased",
+                                className="text-primary",
+                            ),
+                            dcc.Dropdown(
+                                id="snapshot-keys",
+                                placeholder="Key columns, changed rows replace their older copies",
+                                multi=True,
+                                className="text-primary",
+                            ),
+                            html.Button(
+                                id="snapshot-btn", n_clicks=0, children="Snapshot", className="btn btn-outline-primary"
+                            ),
+                        ],
+                        style={"width": "50%"},
+                    ),
                 ],
                 style={"display": "none"},
             ),
+            # The snapshots of this browser, they are the tables of the "local" data source
+            dcc.Store(id="snapshots", storage_type="local"),
+            dcc.Store(id="snapshot-job"),
+            dcc.Interval(id="snapshot-poll", interval=config.job_poll_interval, disabled=True),
+            html.Div(id="snapshot-message"),
+            html.Div(id="snapshot-list"),
             html.Br(),
             dcc.Markdown("##### Upload a script", className="text-primary"),
             html.Br(),
@@ -95,19 +172,43 @@ def get_layout():
             html.Br(),
             dcc.Markdown("#### Or Write your query in the textbox below", className="text-primary"),
             dcc.Textarea(id="query", value="", style={"width": "100%", "height": 100}, className="text-primary"),
+            # What the tables of the selected data source are called
+            html.Div(id="query-hint"),
             html.Button(id="run_query_btn", n_clicks=0, children="Run query", className="btn btn-outline-primary"),
+            html.Button(id="run_script_btn", n_clicks=0, children="Run as script", className="btn btn-outline-primary"),
+            html.Button(
+                id="cancel_query_btn", n_clicks=0, children="Cancel query", className="btn btn-outline-primary"
+            ),
+            html.Div(id="query-cancel-message"),
+            # Queries are estimated before they run, the expensive ones have to be confirmed (see services.admission)
+            dcc.ConfirmDialog(id="query-confirm"),
+            dcc.Store(id="query-admitted"),
+            html.Div(id="query-admission"),
             html.Div(id="query-error"),
-            dcc.Loading(id="query-loading"),
+            # Queries run as background jobs that are polled until they finish
+            dcc.Store(id="query-job"),
+            dcc.Interval(id="query-poll", interval=config.job_poll_interval, disabled=True),
+            html.Div(id="query-progress"),
+            html.Small(id="query-cache-stats", className="text-muted"),
+            # The result of every statement of a script, the selected tab is shown in the table
+            dcc.Store(id="script-data"),
+            dcc.Tabs(id="script-results"),
             html.Div(id="datatable"),
+            # Why the table shows the loaded rows instead of sorting or filtering the whole table
+            html.Div(id="datatable-message"),
+            html.Div(id="column-profile"),
             html.Br(),
             dcc.Markdown("### Visualize the results", className="text-primary"),
             html.Div(
                 [
+                    # Plots that fit the types and distributions of the columns, a click fills in the inputs below
+                    html.Div(id="plot-suggestions"),
+                    dcc.Store(id="plot-suggestions-data"),
                     dcc.Markdown("#### Plot type", className="text-primary"),
                     dcc.Dropdown(
                         id="plot_type",
-                        options=[{"label": source, "value": source} for source in ["scatter", "line", "bar", "pie"]],
-                        value="scatter",
+                        options=[{"label": plot_type, "value": plot_type} for plot_type in config.plot_types],
+                        value=config.plot_types[0],
                         className="text-primary",
                     ),
                     html.Br(),
@@ -120,12 +221,53 @@ def get_layout():
                     dcc.Markdown("#### Group by column", className="text-primary"),
                     dcc.Dropdown(id="plot_group_by_col", className="text-primary"),
                     html.Br(),
+                    dcc.Markdown("#### Aggregation", className="text-primary"),
+                    dcc.Dropdown(
+                        id="plot-aggregation",
+                        options=[{"label": "None (plot the loaded rows)", "value": "none"}]
+                        + [
+                            {"label": aggregation, "value": aggregation}
+                            for aggregation in ["sum", "avg", "count", "min", "max"]
+                        ],
+                        value="none",
+                        clearable=False,
+                        className="text-primary",
+                    ),
+                    html.Br(),
                     html.Button(id="plot_btn", n_clicks=0, children="Plot", className="btn btn-outline-primary"),
                     dcc.Graph(id="data_graph"),
+                    html.Small(id="plot-notice", className="text-muted"),
+                    dcc.Store(id="plot-params"),
+                    # Figures are sent as updates that assets/figure_updates.js applies, the keys of the
+                    # figures it keeps are sent back so that the server only sends what the browser doesn't have
+                    dcc.Store(id="figure-update"),
+                    dcc.Store(id="figure-client-cache", data={"size": config.figure_client_cache_size, "keys": []}),
+                    html.Div(
+                        [
+                            dcc.Dropdown(
+                                id="export-formats",
+                                options=[{"label": fmt.upper(), "value": fmt} for fmt in ["png", "svg", "pdf", "html"]],
+                                value=["png"],
+                                multi=True,
+                                className="text-primary",
+                            ),
+                            dcc.Input(id="export-width", type="number", min=1, placeholder="width (px)"),
+                            dcc.Input(id="export-height", type="number", min=1, placeholder="height (px)"),
+                        ],
+                        style={"width": "30%"},
+                    ),
                     html.Button(
                         id="download-btn", n_clicks=0, children="Download figure", className="btn btn-outline-primary"
                     ),
-                    dcc.Download(id="download-figure-png"),
+                    html.Button(
+                        id="cancel-export-btn", n_clicks=0, children="Cancel", className="btn btn-outline-primary"
+                    ),
+                    # The url of the exported file, the browser downloads it from there
+                    dcc.Store(id="export-url"),
+                    html.Div(id="export-download"),
+                    dcc.Store(id="export-job"),
+                    dcc.Interval(id="export-poll", interval=config.job_poll_interval, disabled=True),
+                    html.Div(id="export-progress"),
                 ],
             ),
         ],
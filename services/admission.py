@@ -0,0 +1,202 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+
+import config
+from database_controllers import pool
+from services import jobs
+
+_EXPLAINABLE_QUERY = re.compile(r"\s*(select|with)\b", re.IGNORECASE)
+
+
+class AdmissionError(Exception):
+    pass
+
+
+def _over(value, limit):
+    # A limit of 0 is no limit, an unknown estimate is never over it
+    return bool(limit) and value is not None and value > limit
+
+
+def check(data_source, db_config, query, params=None):
+    """
+    Estimate what a query that the user typed costs with EXPLAIN, before it runs.
+    params are the parameters of the placeholders of the query, if it has some.
+    Returns a tuple that contains:
+    0. "run", "confirm" (the user has to confirm that it should run) or "reject"
+    1. The message that is shown to the user, None when the query can run
+    """
+    explain_query_func = config.database_explain_functions.get(data_source)
+    if explain_query_func is None or not _EXPLAINABLE_QUERY.match(query or ""):
+        return "run", None
+    try:
+        rows, cost = explain_query_func(db_config, query, params)
+    except Exception:
+        return "run", None  # The query reports what is wrong with it when it runs
+
+    estimate = f"about {rows:,.0f} rows" if rows is not None else "an unknown number of rows"
+    if cost is not None:
+        estimate += f" at a cost of {cost:,.0f}"
+    if _over(rows, config.admission_reject_rows) or _over(cost, config.admission_reject_cost):
+        return "reject", f"The query was not run, the database estimates that it processes {estimate}"
+    if _over(rows, config.admission_confirm_rows) or _over(cost, config.admission_confirm_cost):
+        return "confirm", f"The database estimates that the query processes {estimate}. Run it anyway?"
+    return "run", None
+
+
+def _admission_dir():
+    """
+    The queries that run or wait are kept on disk so that the limits hold across the web workers and job processes,
+    there is one ticket file per query
+    """
+    admission_dir = os.path.join(config.shared_state_dir, "admission")
+    os.makedirs(admission_dir, exist_ok=True)
+    return admission_dir
+
+
+@contextmanager
+def _locked():
+    with open(os.path.join(_admission_dir(), "lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_tickets():
+    """
+    Return the tickets of the queries that run or wait, ordered by arrival.
+    Tickets of processes that died (e.g a job process that was killed) are removed.
+    """
+    tickets = []
+    admission_dir = _admission_dir()
+    for name in sorted(os.listdir(admission_dir)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(admission_dir, name)
+        try:
+            with open(path) as f:
+                ticket = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        if not _is_alive(ticket["pid"]):
+            os.remove(path)
+            continue
+        ticket["path"] = path
+        tickets.append(ticket)
+    return tickets
+
+
+def _write_ticket(path, ticket):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(ticket, f)
+    os.replace(tmp_path, path)
+
+
+def _next_ticket(tickets):
+    """
+    Return the path of the waiting ticket that gets the next free slots, None if none of them fits.
+    Every ticket takes the slots of the connections it uses (e.g a script that runs statements in parallel).
+    Connections with fewer running queries go first, so one user's queue doesn't hold back everyone else.
+    """
+    running = {}
+    for ticket in tickets:
+        if ticket["state"] == "running":
+            running[ticket["identity"]] = running.get(ticket["identity"], 0) + ticket.get("slots", 1)
+    total = sum(running.values())
+
+    waiting = [ticket for ticket in tickets if ticket["state"] == "waiting"]
+    for ticket in sorted(waiting, key=lambda ticket: running.get(ticket["identity"], 0)):
+        slots = ticket.get("slots", 1)
+        if config.admission_max_queries and total + slots > config.admission_max_queries:
+            continue
+        per_connection_limit = config.admission_max_queries_per_connection
+        if not per_connection_limit or running.get(ticket["identity"], 0) + slots <= per_connection_limit:
+            return ticket["path"]
+    return None
+
+
+@contextmanager
+def slot(job_id, data_source, db_config, connections=1, timeout=None):
+    """
+    Context manager that waits for free query slots of the database of db_config and holds them,
+    one for every connection the query (or script) opens.
+    At most config.admission_max_queries connections run queries at the same time, at most
+    config.admission_max_queries_per_connection of them with the same connection identity.
+    A query can't take more slots than the limits allow, it yields the number of connections it can use.
+    The job job_id (None outside of jobs) reports its place in the queue while it waits,
+    it raises AdmissionError after timeout seconds (config.admission_queue_timeout by default).
+    """
+    limits = [limit for limit in (config.admission_max_queries, config.admission_max_queries_per_connection) if limit]
+    if not limits:
+        yield connections
+        return
+
+    slots = max(1, min([connections] + limits))
+    identity = hashlib.sha1(json.dumps(pool.pool_key(data_source, db_config)).encode()).hexdigest()[:16]
+    # The names sort in the order the queries arrived
+    path = os.path.join(_admission_dir(), f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json")
+    ticket = {"identity": identity, "pid": os.getpid(), "state": "waiting", "slots": slots}
+    with _locked():
+        _write_ticket(path, ticket)
+
+    if timeout is None:
+        timeout = config.admission_queue_timeout
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            with _locked():
+                tickets = _read_tickets()
+                if _next_ticket(tickets) == path:
+                    _write_ticket(path, {**ticket, "state": "running"})
+                    break
+            ahead = sum(1 for other in tickets if other["state"] == "waiting" and other["path"] < path)
+            if time.monotonic() > deadline:
+                raise AdmissionError(f"The database is busy, the query waited {timeout:g} seconds for its turn")
+            if job_id is not None:
+                jobs.report_progress(job_id, f"Waiting for the database, {ahead} queries ahead")
+            time.sleep(config.admission_poll_interval)
+        yield slots
+    finally:
+        with _locked():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def execute_query(data_source, db_config, query, params=None):
+    """
+    Run a query that the app builds for the user (e.g a sorted page of a table or the aggregation of a plot)
+    with config.database_execute_functions, after the same estimate and in the same slots as the queries
+    the users type. Nobody can confirm such a query, it runs unless it is over the reject limits.
+    Queries of the embedded engine run in this process and are not admitted.
+    They run inside web requests, so they wait at most config.admission_request_timeout seconds for a slot.
+    Raises AdmissionError if the query is rejected or waits too long for a slot.
+    """
+    execute_query_func = config.database_execute_functions[data_source]
+    if data_source not in config.database_sources:
+        return execute_query_func(db_config, query, params)
+
+    decision, message = check(data_source, db_config, query, params)
+    if decision == "reject":
+        raise AdmissionError(message)
+    with slot(None, data_source, db_config, timeout=config.admission_request_timeout):
+        return execute_query_func(db_config, query, params)
@@ -0,0 +1,218 @@
+import functools
+import json
+import os
+import re
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+import config
+
+# String columns with at most this fraction of distinct values are stored as categoricals
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+DATE_SAMPLE_SIZE = 1000
+
+
+def _datasets_dir():
+    datasets_dir = os.path.join(config.shared_state_dir, "datasets")
+    os.makedirs(datasets_dir, exist_ok=True)
+    return datasets_dir
+
+
+def _path(dataset_id, extension):
+    """
+    Datasets are Arrow IPC (feather) files in the shared directory, so every worker and job can memory-map them
+    """
+    if not re.fullmatch(r"[a-f0-9]+", dataset_id):
+        raise ValueError(f"Invalid dataset id {dataset_id!r}")
+    return os.path.join(_datasets_dir(), f"{dataset_id}.{extension}")
+
+
+def _prune(keep_path):
+    """
+    Remove the least recently used datasets until they fit in config.datasets_max_bytes, keep_path is never removed.
+    Workers that memory-mapped a removed dataset can still read it, the next load asks for the file again.
+    """
+    files = []
+    for entry in os.scandir(_datasets_dir()):
+        if entry.name.endswith(".arrow"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= config.datasets_max_bytes:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Another worker removed it already
+        total_size -= size
+
+
+def optimize_dtypes(df):
+    """
+    Convert the text columns of a parsed file to better dtypes:
+    dates become datetime64 and low cardinality strings become categoricals
+    """
+    df = df.reset_index(drop=True)
+    df.columns = [str(col) for col in df.columns]
+    for col in df.select_dtypes(include="object").columns:
+        values = df[col].dropna()
+        if values.empty:
+            continue
+
+        sample = values.iloc[:DATE_SAMPLE_SIZE]
+        if sample.map(type).eq(str).all() and pd.to_datetime(sample, errors="coerce").notna().all():
+            try:
+                df[col] = pd.to_datetime(df[col])
+                continue
+            except (ValueError, TypeError):
+                pass
+
+        if values.nunique() <= CATEGORICAL_MAX_UNIQUE_RATIO * len(values):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def create(df, filename):
+    """
+    Store a parsed file as a dataset and return the data to keep in the browser for it, a dictionary with:
+    0. dataset_id: The id to load the dataset with load()
+    1. filename: The name of the uploaded file
+    2. rows: The number of rows of the dataset
+    """
+    dataset_id = uuid.uuid4().hex
+    df = optimize_dtypes(df)
+    path = _path(dataset_id, "arrow")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_feather(tmp_path)
+    os.replace(tmp_path, path)
+    _prune(path)
+    return {"dataset_id": dataset_id, "filename": filename, "rows": len(df)}
+
+
+def ingest_csv(path, filename):
+    """
+    Convert a csv file on disk to a dataset block by block with pyarrow's streaming csv reader,
+    so memory use stays flat whatever the size of the file.
+    Returns the same data as create().
+    """
+    dataset_id = uuid.uuid4().hex
+    dataset_path = _path(dataset_id, "arrow")
+    tmp_path = f"{dataset_path}.{os.getpid()}.tmp"
+    column_types = {}
+    while True:
+        try:
+            rows = _write_csv_blocks(path, tmp_path, column_types)
+            break
+        except pa.ArrowInvalid as err:
+            # The types are inferred from the first block, a later block can contain values that don't fit them
+            if not _widen_column_type(err, column_types, path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise ValueError("There was an error processing this file.")
+
+    os.replace(tmp_path, dataset_path)
+    _prune(dataset_path)
+    return {"dataset_id": dataset_id, "filename": filename, "rows": rows}
+
+
+def _write_csv_blocks(path, dataset_path, column_types):
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=config.upload_block_size),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types),
+    )
+    rows = 0
+    categorical_columns = None
+    writer = None
+    try:
+        for batch in reader:
+            if writer is None:
+                # Pick the categorical columns from the first block, the dictionaries are built when loading
+                categorical_columns = [
+                    field.name
+                    for field, column in zip(batch.schema, batch.columns)
+                    if pa.types.is_string(field.type)
+                    and len(column) > 0
+                    and len(column.unique()) <= CATEGORICAL_MAX_UNIQUE_RATIO * len(column)
+                ]
+                metadata = {b"categorical_columns": json.dumps(categorical_columns).encode()}
+                writer = ipc.new_file(dataset_path, batch.schema.with_metadata(metadata))
+            writer.write_batch(batch)
+            rows += batch.num_rows
+        if writer is None:
+            writer = ipc.new_file(dataset_path, reader.schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _widen_column_type(err, column_types, path):
+    """
+    Make the type of the column that failed to convert more general (int -> float -> string)
+    and return False if it can't be made more general
+    """
+    match = re.search(r"CSV column #(\d+).*conversion error to (\w+)", str(err))
+    if match is None:
+        return False
+
+    with open(path, "rb") as f:
+        header = f.readline()
+    column_names = pa_csv.read_csv(pa.py_buffer(header)).column_names
+    column = column_names[int(match.group(1))]
+    failed_type = match.group(2)
+    if failed_type == "int64":
+        column_types[column] = pa.float64()
+    elif failed_type != "string":
+        column_types[column] = pa.string()
+    else:
+        return False
+    return True
+
+
+def file_path(dataset_id):
+    """
+    Return the path of the Arrow IPC file of a dataset
+    """
+    path = _path(dataset_id, "arrow")
+    if not os.path.exists(path):
+        raise ValueError("The uploaded file does not exist anymore, please upload it again")
+    return path
+
+
+def load_table(dataset_id):
+    """
+    Return the memory-mapped Arrow table of a dataset, its columns are only read from disk when they are used
+    """
+    path = _path(dataset_id, "arrow")
+    try:
+        # The datasets that are not used anymore are removed first
+        os.utime(path)
+        return feather.read_table(path, memory_map=True)
+    except FileNotFoundError:
+        raise ValueError("The uploaded file does not exist anymore, please upload it again")
+
+
+@functools.lru_cache(maxsize=2)
+def load(dataset_id):
+    """
+    Return the dataframe of a dataset. The file is memory-mapped and the
+    last datasets are kept in memory, so repeated queries only cost the query itself.
+    The returned dataframe is shared, it must not be modified in place.
+    """
+    table = load_table(dataset_id)
+    metadata = table.schema.metadata or {}
+    categorical_columns = json.loads(metadata.get(b"categorical_columns", b"[]"))
+    return table.to_pandas(split_blocks=True, categories=categorical_columns)
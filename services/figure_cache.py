@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import config
+
+
+class FigureCache:
+    """
+    LRU cache of the figures of the plots, keyed by figure_key().
+    Figures are kept as JSON ready dictionaries, the least recently used ones are evicted
+    when their JSON takes more than max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (figure, message, reduced, size in bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, figure, message, reduced, size):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[3]
+            self._entries[key] = (figure, message, reduced, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, _, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_cache = FigureCache(max_bytes=config.figure_cache_max_bytes)
+
+
+def figure_key(result_id, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation, x_range=None, y_range=None):
+    """
+    Return the key of the figure of a plot of a result, it is also how the browser knows the figures it has
+    """
+    params = [result_id, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation, x_range, y_range]
+    return hashlib.sha1(json.dumps(params, default=str).encode()).hexdigest()[:16]
+
+
+def get(key):
+    """
+    Return (figure, message, reduced, size of its JSON) of a cached figure, None if it is not cached
+    """
+    return _cache.get(key)
+
+
+def put(key, fig, message, reduced):
+    """
+    Cache a plotly figure and return its entry, the same tuple as get() with the figure as a JSON ready dictionary
+    """
+    # plotly is imported with the first plot, see database_controllers.registry
+    import plotly.io as pio
+
+    figure_json = pio.to_json(fig, validate=False)
+    entry = (json.loads(figure_json), message, reduced, len(figure_json))
+    _cache.put(key, *entry)
+    return entry
+
+
+def clear():
+    """
+    Drop every cached figure
+    """
+    _cache.clear()
+
+
+def diff(old, new):
+    """
+    Return the changes from figure old to figure new, as {"traces": [...], "layout": ...}.
+    Every trace is {"base": index of the trace of old it starts from, "set": {key: value}, "unset": [key]},
+    keys whose value is the same as in the base trace (e.g the x/y arrays) are not repeated.
+    layout is None when it didn't change.
+    """
+    old_traces = old.get("data", [])
+    by_name = {}
+    for i, trace in enumerate(old_traces):
+        by_name.setdefault((trace.get("type"), trace.get("name")), i)
+
+    traces = []
+    for i, trace in enumerate(new.get("data", [])):
+        # The trace of the same group is the best base, the one at the same position is the next best
+        base = by_name.get((trace.get("type"), trace.get("name")), i if i < len(old_traces) else None)
+        if base is None:
+            traces.append({"base": None, "set": trace, "unset": []})
+            continue
+        base_trace = old_traces[base]
+        traces.append(
+            {
+                "base": base,
+                "set": {key: value for key, value in trace.items() if base_trace.get(key) != value},
+                "unset": [key for key in base_trace if key not in trace],
+            }
+        )
+    layout = new.get("layout", {})
+    return {"traces": traces, "layout": None if layout == old.get("layout", {}) else layout}
+
+
+def figure_update(key, entry, base_key, client_keys):
+    """
+    Return the update of the figure-update store that shows the figure of key (entry is its cache entry) in the browser:
+    {"key": key, "cached": True} when the browser has the figure already, {"key": key, "diff": ..., "base": base_key}
+    when the figure the browser shows (base_key) is cached here and the diff is smaller than the figure,
+    {"key": key, "full": figure} otherwise.
+    """
+    if key in client_keys:
+        return {"key": key, "cached": True}
+
+    figure, _, _, size = entry
+    base = get(base_key) if base_key in client_keys else None
+    if base is not None:
+        changes = diff(base[0], figure)
+        # The diff is sent only when it saves something, a new grouping of the rows changes every array anyway
+        if len(json.dumps(changes)) < 0.5 * size:
+            return {"key": key, "diff": changes, "base": base_key}
+    return {"key": key, "full": figure}
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import re
+import zipfile
+
+import flask
+
+import config
+from services import jobs
+from services import metrics
+
+# Export format -> mimetype of the exported file
+FORMATS = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+    "html": "text/html",
+}
+
+
+def _exports_dir():
+    exports_dir = os.path.join(config.shared_state_dir, "exports")
+    os.makedirs(exports_dir, exist_ok=True)
+    return exports_dir
+
+
+def _path(file_name):
+    """
+    Exported figures are cached in the shared directory, named after the hash of what they were rendered from
+    """
+    if not re.fullmatch(r"[a-f0-9]{64}\.(png|svg|pdf|html|zip)", file_name):
+        raise ValueError(f"Invalid export {file_name!r}")
+    return os.path.join(_exports_dir(), file_name)
+
+
+def file_name(figure, export_format, width=None, height=None):
+    """
+    Return the name of the cached file of a figure, the hash of its spec, format and size
+    """
+    spec = json.dumps([figure, export_format, width, height], sort_keys=True, separators=(",", ":"), default=str)
+    return f"{hashlib.sha256(spec.encode()).hexdigest()}.{export_format}"
+
+
+def cached(name):
+    """
+    True if an export is in the cache
+    """
+    path = _path(name)
+    try:
+        # The least recently downloaded exports are removed first
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _write(path, content):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def render(figure, export_format, width=None, height=None):
+    """
+    Render a figure (the dictionary of a dcc.Graph figure) to a file unless it is cached already.
+    png, svg and pdf are rendered by the kaleido process of this worker, that stays up between exports.
+    Returns the name of the file.
+    """
+    name = file_name(figure, export_format, width, height)
+    if cached(name):
+        return name
+
+    import plotly.graph_objects as go
+
+    fig = go.Figure(data=figure["data"], layout=figure["layout"])
+    with metrics.timed("export"):
+        if export_format == "html":
+            content = fig.to_html(
+                include_plotlyjs="cdn", default_width=width or "100%", default_height=height or "100%"
+            )
+            content = content.encode()
+        else:
+            content = fig.to_image(format=export_format, width=width, height=height)
+    _write(_path(name), content)
+    _prune()
+    return name
+
+
+def render_batch(exports):
+    """
+    Render several figures (dictionaries with the arguments of render()) and zip them together.
+    Returns the name of the zip file.
+    """
+    names = [render(**export) for export in exports]
+    name = f"{hashlib.sha256(' '.join(names).encode()).hexdigest()}.zip"
+    if cached(name):
+        return name
+
+    path = _path(name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(tmp_path, "w") as zip_file:
+        for i, export_name in enumerate(names, start=1):
+            extension = export_name.rsplit(".", 1)[1]
+            zip_file.write(_path(export_name), f"figure-{i}.{extension}")
+    os.replace(tmp_path, path)
+    return name
+
+
+def _prune():
+    """
+    Remove the least recently used exports until the cache fits in config.export_cache_max_bytes
+    """
+    files = []
+    for entry in os.scandir(_exports_dir()):
+        if not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= config.export_cache_max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Another worker removed it already
+        total_size -= size
+
+
+def warm_up():
+    """
+    Start the kaleido process of a job process, so the first export doesn't wait for chromium to start
+    """
+    if not config.export_warm_up:
+        return
+    import plotly.graph_objects as go
+
+    try:
+        go.Figure().to_image(format="png", width=10, height=10)
+    except Exception:
+        pass  # The exports report the error
+
+
+jobs.register_process_initializer(warm_up)
+
+
+def download(name):
+    """
+    Stream an exported file to the browser
+    """
+    try:
+        path = _path(name)
+    except ValueError:
+        flask.abort(404)
+    if not os.path.exists(path):
+        flask.abort(404)
+
+    extension = name.rsplit(".", 1)[1]
+    download_name = "figures.zip" if extension == "zip" else f"figure.{extension}"
+    mimetype = FORMATS.get(extension, "application/zip")
+    return flask.send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+
+def register_routes(server):
+    server.add_url_rule("/exports/<name>", "download_export", download, methods=["GET"])
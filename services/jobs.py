@@ -0,0 +1,185 @@
+import concurrent.futures
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import config
+
+
+# The state files of jobs older than this (in seconds) are removed, e.g the jobs that a newer query superseded
+# and that nobody polls anymore
+STALE_JOB_AGE = 24 * 60 * 60
+
+
+class JobCancelled(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_job_process = False
+_process_initializers = []
+
+
+def register_process_initializer(func):
+    """
+    Run func in every process of the job process pool when it starts, e.g to warm up something the jobs use.
+    func must be a module level function, it has to be registered before the first job is submitted.
+    """
+    _process_initializers.append(func)
+
+
+def _init_job_process(initializers):
+    global _in_job_process
+    _in_job_process = True
+    for func in initializers:
+        func()
+
+
+def in_job_process():
+    """
+    True in the processes of the job process pool, nothing that is kept in their memory is seen by the web workers
+    """
+    return _in_job_process
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if config.job_executor == "process":
+                _executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=config.job_workers,
+                    initializer=_init_job_process,
+                    initargs=(tuple(_process_initializers),),
+                )
+            else:
+                _executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.job_workers)
+        return _executor
+
+
+def _jobs_dir():
+    jobs_dir = os.path.join(config.shared_state_dir, "jobs")
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+
+def _path(job_id, extension):
+    """
+    The state of the jobs is kept on disk so that any gunicorn worker can poll it
+    """
+    if not re.fullmatch(r"[a-f0-9]+", job_id):
+        raise ValueError(f"Invalid job id {job_id!r}")
+    return os.path.join(_jobs_dir(), f"{job_id}.{extension}")
+
+
+def _remove_stale_jobs():
+    now = time.time()
+    for entry in os.scandir(_jobs_dir()):
+        try:
+            if now - entry.stat().st_mtime > STALE_JOB_AGE:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_state(job_id, **state):
+    path = _path(job_id, "json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def submit(func, *args):
+    """
+    Run func(job_id, *args) in the background and return the job id.
+    func must be a module level function when jobs run in a process pool,
+    its return value must be json serializable.
+    """
+    _remove_stale_jobs()
+    job_id = uuid.uuid4().hex
+    _write_state(job_id, state="queued", progress=None)
+    future = _get_executor().submit(_run, job_id, func, args)
+    future.add_done_callback(lambda future: _check_crashed(job_id, future))
+    return job_id
+
+
+def _run(job_id, func, args):
+    if is_cancelled(job_id):
+        return
+    _write_state(job_id, state="running", progress=None)
+    try:
+        result = func(job_id, *args)
+    except JobCancelled:
+        return
+    except Exception as err:
+        _write_state(job_id, state="error", error=str(err))
+    else:
+        _write_state(job_id, state="done", result=result)
+
+
+def _check_crashed(job_id, future):
+    """
+    A job whose process was killed (e.g out of memory) never writes its final state
+    """
+    global _executor
+    if future.cancelled() or future.exception() is None:
+        return
+    _write_state(job_id, state="error", error=f"The job failed: {future.exception()}")
+    if isinstance(future.exception(), concurrent.futures.BrokenExecutor):
+        with _executor_lock:
+            _executor = None
+
+
+def report_progress(job_id, progress):
+    """
+    Called by a running job to report its progress, raises JobCancelled if the job was cancelled
+    """
+    if is_cancelled(job_id):
+        raise JobCancelled()
+    _write_state(job_id, state="running", progress=progress)
+
+
+def status(job_id):
+    """
+    Return the state of a job, a dictionary with:
+    0. state: One of queued, running, done, error or cancelled
+    1. progress: The last progress the job reported (queued and running jobs)
+    2. result: The return value of the job (done jobs)
+    3. error: The error message (failed jobs)
+    """
+    if is_cancelled(job_id):
+        return {"state": "cancelled"}
+    try:
+        with open(_path(job_id, "json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"state": "error", "error": "The job does not exist anymore"}
+
+
+def cancel(job_id):
+    """
+    Cancel a job, it stops the next time it reports progress and its result is discarded
+    """
+    with open(_path(job_id, "cancel"), "w"):
+        pass
+
+
+def is_cancelled(job_id):
+    return os.path.exists(_path(job_id, "cancel"))
+
+
+def forget(job_id):
+    """
+    Remove the state of a finished job. The state of the jobs that are not forgotten
+    (e.g cancelled because a newer query replaced them) is removed after STALE_JOB_AGE seconds.
+    """
+    for extension in ["json", "cancel"]:
+        try:
+            os.remove(_path(job_id, extension))
+        except FileNotFoundError:
+            pass
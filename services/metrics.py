@@ -0,0 +1,323 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import dash
+import flask
+import pandas as pd
+
+import config
+from database_controllers import pool
+from services import jobs
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024**2, 10 * 1024**2, 100 * 1024**2)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "dash_callback_duration_seconds": ("histogram", "Time spent in Dash callbacks", DURATION_BUCKETS),
+    "dash_callback_errors_total": ("counter", "Dash callbacks that raised an error", None),
+    "dash_callback_payload_bytes": ("histogram", "Size of the callback requests and responses", BYTES_BUCKETS),
+    "database_call_duration_seconds": ("histogram", "Time spent in database controller calls", DURATION_BUCKETS),
+    "database_call_rows_total": ("counter", "Rows returned by database controller calls", None),
+    "database_call_errors_total": ("counter", "Database controller calls that raised an error", None),
+    "database_pool_hits_total": ("counter", "Database connections that were reused from a pool", None),
+    "database_pool_misses_total": ("counter", "Database connections that a pool had to open", None),
+    "stage_duration_seconds": (
+        "histogram",
+        "Time spent starting workers, building dataframes, serializing and profiling results, "
+        "building and exporting figures",
+        DURATION_BUCKETS,
+    ),
+}
+
+
+class Registry:
+    """
+    The metrics of one process. Every process (web workers and job processes) writes its
+    metrics to its own file in the shared directory, /metrics adds up the files of all processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._file_id = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self._last_flush = 0
+
+    def _check_fork(self):
+        # A forked process starts with a copy of the metrics of its parent, that are counted by the parent already
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._check_fork()
+            key = (name, tuple(sorted(labels.items())))
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._check_fork()
+            key = (name, tuple(sorted(labels.items())))
+            histogram = self._histograms.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        # Job processes can stay idle for a long time after a job, their metrics are written right away
+        if jobs.in_job_process() or time.monotonic() - self._last_flush > config.metrics_flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._check_fork()
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            state = {
+                "counters": counters + _pool_counters(),
+                "histograms": [[name, list(labels), values] for (name, labels), values in self._histograms.items()],
+            }
+            self._last_flush = time.monotonic()
+            path = os.path.join(_metrics_dir(), f"{self._file_id}.json")
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+
+def _pool_counters():
+    """
+    The hit and miss counters of the connection pools of this process, the pools keep their own totals
+    """
+    counters = []
+    for name, stats in pool.pool_stats()["pools"].items():
+        counters.append(["database_pool_hits_total", [["pool", name]], stats["hits"]])
+        counters.append(["database_pool_misses_total", [["pool", name]], stats["misses"]])
+    return counters
+
+
+_registry = Registry()
+
+
+def _metrics_dir():
+    metrics_dir = os.path.join(config.shared_state_dir, "metrics")
+    os.makedirs(metrics_dir, exist_ok=True)
+    return metrics_dir
+
+
+def observe_stage(stage, seconds):
+    """
+    Record how long a stage (e.g the startup of a worker) took
+    """
+    _registry.observe("stage_duration_seconds", {"stage": stage}, seconds)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Context manager that records how long a stage of a request took
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render():
+    """
+    Return the metrics of all the processes in the Prometheus text format.
+    The files of the processes that exited (e.g workers that were restarted) are removed,
+    their counters drop out of the totals like the counters of a restarted server.
+    """
+    _registry.flush()
+    counters = {}
+    histograms = {}
+    for entry in os.scandir(_metrics_dir()):
+        if not entry.name.endswith(".json"):
+            continue
+        pid = entry.name.split("-", 1)[0]
+        if pid.isdigit() and not _is_alive(int(pid)):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(entry.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        for name, labels, value in state["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in state["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            histograms[key] = [a + b for a, b in zip(total, values)]
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "counter":
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        for (metric_name, labels), values in sorted(histograms.items()):
+            if metric_name != name:
+                continue
+            for bound, count in zip(buckets, values):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def _rows(result):
+    """
+    Number of rows in the return value of a controller function, None if it doesn't return rows
+    """
+    if not isinstance(result, tuple) or not result:
+        return None
+    if isinstance(result[0], pd.DataFrame):
+        return len(result[0])
+    if len(result) == 2 and isinstance(result[1], list):
+        return len(result[1])
+    return None
+
+
+def instrument_database_function(data_source, func):
+    """
+    Wrap a database controller function to record its duration, the rows it returns and its errors
+    """
+    if getattr(func, "instrumented", False):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        labels = {"data_source": data_source, "function": func.__name__}
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _registry.inc("database_call_errors_total", labels)
+            raise
+        finally:
+            _registry.observe("database_call_duration_seconds", labels, time.perf_counter() - start)
+        rows = _rows(result)
+        if rows is not None:
+            _registry.inc("database_call_rows_total", labels, rows)
+        return result
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_database_functions():
+    """
+    Wrap every function of the database_*_functions maps of config, in this process and the job processes.
+    The functions are wrapped when they are looked up, so the controllers are still imported on first use.
+    """
+    for name in dir(config):
+        if name.startswith("database_") and name.endswith("_functions"):
+            getattr(config, name).wrap(instrument_database_function)
+
+
+def _instrument_callback(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        flask.g.callback_name = func.__name__
+        labels = {"callback": func.__name__}
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except dash.exceptions.PreventUpdate:
+            raise
+        except Exception:
+            _registry.inc("dash_callback_errors_total", labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _registry.observe("dash_callback_duration_seconds", labels, elapsed)
+            if config.slow_callback_seconds and elapsed >= config.slow_callback_seconds:
+                triggered = [trigger["prop_id"] for trigger in dash.callback_context.triggered]
+                logger.warning("Slow callback %s took %.2fs, triggered by %s", func.__name__, elapsed, triggered)
+
+    return wrapper
+
+
+def _record_payload(response):
+    callback = flask.g.get("callback_name")
+    if callback is not None:
+        labels = {"callback": callback}
+        request_bytes = flask.request.content_length or 0
+        response_bytes = response.content_length
+        if response_bytes is None:
+            response_bytes = 0 if response.direct_passthrough else len(response.get_data())
+        _registry.observe("dash_callback_payload_bytes", {**labels, "direction": "request"}, request_bytes)
+        _registry.observe("dash_callback_payload_bytes", {**labels, "direction": "response"}, response_bytes)
+    return response
+
+
+def _metrics_view():
+    return flask.Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def instrument_app(app):
+    """
+    Time every callback that is registered on app from now on and every database controller call,
+    record the size of the callback payloads and serve all of it on /metrics.
+    It has to be called before the callbacks are registered.
+    """
+    register_callback = app.callback
+
+    @functools.wraps(register_callback)
+    def callback(*args, **kwargs):
+        decorator = register_callback(*args, **kwargs)
+        return lambda func: decorator(_instrument_callback(func))
+
+    app.callback = callback
+    app.server.after_request(_record_payload)
+    app.server.add_url_rule("/metrics", "metrics", _metrics_view)
+    instrument_database_functions()
+    # The job processes import config again when they are not forked from this one
+    jobs.register_process_initializer(instrument_database_functions)
@@ -0,0 +1,150 @@
+import re
+
+import pandas as pd
+
+import config
+from services import admission
+from services.table_query import quote_identifier
+from services.table_query import subquery
+
+SQL_AGGREGATIONS = {"sum": "SUM", "avg": "AVG", "count": "COUNT", "min": "MIN", "max": "MAX"}
+
+_SELECT_QUERY = re.compile(r"\s*(select|with)\b", re.IGNORECASE)
+# Stands for the parameter placeholders while the query is built, it can't be in the sql of the source query
+_PARAMETER = "\0"
+
+
+def source_relation(data, quote):
+    """
+    Return what to select the rows of a result from in an aggregate query: the table it previews
+    or the query that produced it as a subquery. None if the result can't be recomputed in the database.
+    """
+    if data.get("source_table"):
+        return quote_identifier(data["source_table"], quote)
+    query = data.get("source_query")
+    if query and _SELECT_QUERY.match(query):
+        return subquery(query, "source_rows")
+    return None
+
+
+def value_column(y_axis_col, aggregation):
+    """
+    Name of the column with the aggregated values in the result of an aggregate query
+    """
+    if aggregation == "count" or y_axis_col is None:
+        return "count"
+    return y_axis_col
+
+
+def plot_columns(plot_type, x_axis_col, y_axis_col):
+    """
+    Return the column to group by and the column to aggregate of a plot.
+    Pie charts sum their values (x) by name (y), the other plots aggregate y by x.
+    """
+    if plot_type == "pie":
+        return y_axis_col, x_axis_col
+    return x_axis_col, y_axis_col
+
+
+def build_range_query(relation, x_axis_col, dialect):
+    """
+    Build the query that returns the lowest and highest value of a column, to compute the bins of a histogram
+    """
+    column = quote_identifier(x_axis_col, dialect["quote"])
+    return f"SELECT MIN({column}), MAX({column}) FROM {relation}"
+
+
+def build_aggregate_query(
+    relation, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation, dialect, max_rows, x_range=None
+):
+    """
+    Build the GROUP BY query that computes the points of a plot in the database.
+    Histograms group the x values in config.plot_histogram_bins bins of x_range (the lowest and highest x),
+    their x column is the number of the bin.
+    One more row than max_rows is requested to know if the result was truncated.
+    Returns a tuple with the query and its parameters, None when there are no parameters.
+    """
+    quote = dialect["quote"]
+    key_col, aggregated_col = plot_columns(plot_type, x_axis_col, y_axis_col)
+    params = []
+
+    if aggregation == "count" or aggregated_col is None:
+        value = "COUNT(*)"
+    else:
+        value = f"{SQL_AGGREGATIONS[aggregation]}({quote_identifier(aggregated_col, quote)})"
+    value = f"{value} AS {quote_identifier(value_column(aggregated_col, aggregation), quote)}"
+
+    key = quote_identifier(key_col, quote)
+    if plot_type == "histogram":
+        low, high = x_range
+        bins = config.plot_histogram_bins
+        width = (high - low) / bins or 1
+        key = f"LEAST(FLOOR(({key} - {_PARAMETER}) / {_PARAMETER}), {bins - 1})"
+        params.extend([low, width])
+    columns = [f"{key} AS {quote_identifier(key_col, quote)}"]
+    if group_by_col is not None and plot_type != "pie":
+        columns.append(quote_identifier(group_by_col, quote))
+    # Grouping by position, the bin expression has parameters and its alias is the name of the column
+    positions = ", ".join(str(position) for position in range(1, len(columns) + 1))
+
+    query = f"SELECT {', '.join(columns)}, {value} FROM {relation}"
+    query += f" WHERE {quote_identifier(key_col, quote)} IS NOT NULL"
+    query += f" GROUP BY {positions} ORDER BY {positions}"
+    query += f" LIMIT {int(max_rows) + 1}"
+    if not params:
+        # Drivers with %s placeholders only %-format a query that has parameters
+        return query, None
+    if dialect["placeholder"] == "%s":
+        # The % of the source query (e.g LIKE 'a%') are literal
+        query = query.replace("%", "%%")
+    return query.replace(_PARAMETER, dialect["placeholder"]), params
+
+
+def run_aggregate_query(data_source, db_config, data, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation):
+    """
+    Compute the points of a plot over all the rows of a database result, not only the ones that were loaded.
+    Returns a tuple that contains:
+    0. A dataframe with the group by columns and the aggregated values (see value_column())
+    1. True if there were more points than config.plot_aggregate_max_rows
+    Returns None if the result doesn't come from a table or a select query.
+    """
+    dialect = config.database_sql_dialects[data_source]
+    relation = source_relation(data, dialect["quote"])
+    if relation is None:
+        return None
+
+    # The aggregations go through the admission control of the queries the users type
+    x_range = None
+    if plot_type == "histogram":
+        _, results = admission.execute_query(data_source, db_config, build_range_query(relation, x_axis_col, dialect))
+        low, high = results[0]
+        if low is None:
+            return pd.DataFrame(columns=[x_axis_col, value_column(y_axis_col, aggregation)]), False
+        try:
+            x_range = (float(low), float(high))
+        except (TypeError, ValueError):
+            raise ValueError("Histograms of database tables need a numeric x axis column")
+
+    query, params = build_aggregate_query(
+        relation,
+        plot_type,
+        x_axis_col,
+        y_axis_col,
+        group_by_col,
+        aggregation,
+        dialect,
+        config.plot_aggregate_max_rows,
+        x_range,
+    )
+    columns, results = admission.execute_query(data_source, db_config, query, params)
+    truncated = len(results) > config.plot_aggregate_max_rows
+    df = pd.DataFrame(results[: config.plot_aggregate_max_rows], columns=columns)
+    # SUM and AVG return decimals on MySQL
+    value = columns[-1]
+    df[value] = pd.to_numeric(df[value])
+    if plot_type == "histogram":
+        # The bins are numbered, plot them at the value they start from
+        low, high = x_range
+        width = (high - low) / config.plot_histogram_bins or 1
+        df[x_axis_col] = low + df[x_axis_col].astype(float) * width
+    return df, truncated
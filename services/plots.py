@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+import config
+from services import plot_queries
+
+PANDAS_AGGREGATIONS = {"sum": "sum", "avg": "mean", "min": "min", "max": "max"}
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a line sorted by x.
+    Returns the positions of the n_out points that keep the shape of the line.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The first and last points are always kept, the rest is split in n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i == n_out - 3:
+            next_x, next_y = x[n - 1], y[n - 1]
+        else:
+            next_x = x[edges[i + 1] : edges[i + 2]].mean()
+            next_y = y[edges[i + 1] : edges[i + 2]].mean()
+
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        areas = np.abs(
+            (x[selected] - next_x) * (bucket_y - y[selected]) - (x[selected] - bucket_x) * (next_y - y[selected])
+        )
+        selected = start + int(np.argmax(areas))
+        indices[i + 1] = selected
+    return indices
+
+
+def minmax(y, n_out):
+    """
+    Min/max bucketing of a line sorted by x, it keeps the lowest and highest point of n_out / 2 buckets.
+    Returns the positions of the points to keep.
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    buckets = np.arange(n) * (n_out // 2) // n
+    values = pd.Series(y)
+    grouped = values.groupby(buckets)
+    return np.unique(np.concatenate([grouped.idxmin().to_numpy(), grouped.idxmax().to_numpy()]))
+
+
+def _numeric(values):
+    """
+    Return the values of a column as floats (datetimes as nanoseconds) or None if they are not numeric
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        index = pd.DatetimeIndex(values)
+        # pandas 2 and later can keep datetimes in other units than nanoseconds
+        if hasattr(index, "as_unit"):
+            index = index.as_unit("ns")
+        return index.asi8.astype(float)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.to_numpy(dtype=float)
+    return None
+
+
+def _density_heatmap(df, x_axis_col, y_axis_col, bins):
+    """
+    Bin the points on the server, so only the counts of the bins are sent to the browser
+    """
+    x = _numeric(df[x_axis_col])
+    y = _numeric(df[y_axis_col])
+    valid = ~(np.isnan(x) | np.isnan(y))
+    counts, x_edges, y_edges = np.histogram2d(x[valid], y[valid], bins=bins)
+    axes = []
+    for col, edges in [(x_axis_col, x_edges), (y_axis_col, y_edges)]:
+        centers = (edges[:-1] + edges[1:]) / 2
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            centers = pd.to_datetime(centers.astype("int64"))
+        axes.append(centers)
+    import plotly.graph_objects as go
+
+    fig = go.Figure(go.Heatmap(x=axes[0], y=axes[1], z=counts.T, colorbar={"title": "count"}))
+    fig.update_layout(xaxis_title=x_axis_col, yaxis_title=y_axis_col)
+    return fig
+
+
+def _downsample_line(df, x_axis_col, y_axis_col, group_by_col, max_points):
+    groups = [group for _, group in df.groupby(group_by_col, sort=False, observed=True)] if group_by_col else [df]
+    points_per_group = max(max_points // len(groups), 3)
+    sampled = []
+    for group in groups:
+        group = group.dropna(subset=[y_axis_col]).sort_values(x_axis_col, kind="mergesort")
+        x = _numeric(group[x_axis_col])
+        y = _numeric(group[y_axis_col])
+        if y is None:
+            # Text or categories have no shape to keep, take evenly spaced points
+            positions = np.unique(np.linspace(0, len(group) - 1, min(points_per_group, len(group))).astype(np.int64))
+        elif config.plot_line_downsampling == "minmax" or x is None:
+            positions = minmax(y, points_per_group)
+        else:
+            positions = lttb(x, y, points_per_group)
+        sampled.append(group.iloc[positions])
+    return pd.concat(sampled)
+
+
+def _in_range(df, col, value_range):
+    low, high = value_range
+    values = df[col]
+    if pd.api.types.is_datetime64_any_dtype(values):
+        low, high = pd.Timestamp(low), pd.Timestamp(high)
+    elif not pd.api.types.is_numeric_dtype(values):
+        # Categorical axes are zoomed by position, we can't filter them by value
+        return df
+    return df[(values >= low) & (values <= high)]
+
+
+def build_figure(df, plot_type, x_axis_col, y_axis_col, group_by_col, x_range=None, y_range=None):
+    """
+    Build the figure of a plot, keeping the number of points that are sent to the browser within the render budget:
+    scatter plots switch to WebGL and then to a density heatmap, lines are downsampled
+    and bars and pies are aggregated before plotting.
+    x_range and y_range restrict the data to the part of the plot the user zoomed in.
+    Returns a tuple that contains:
+    0. The figure
+    1. A message for the user if the plot doesn't show every point, None otherwise
+    """
+    if x_range is not None and plot_type in ("scatter", "line"):
+        df = _in_range(df, x_axis_col, x_range)
+    if y_range is not None and plot_type == "scatter":
+        df = _in_range(df, y_axis_col, y_range)
+
+    # plotly.express is one of the slowest imports of the app, workers import it with their first plot
+    import plotly.express as px
+
+    total_points = len(df)
+    message = None
+    if plot_type == "scatter":
+        if total_points <= config.plot_max_points:
+            fig = px.scatter(df, x=x_axis_col, y=y_axis_col, color=group_by_col)
+        elif total_points <= config.plot_max_webgl_points:
+            fig = px.scatter(df, x=x_axis_col, y=y_axis_col, color=group_by_col, render_mode="webgl")
+        elif group_by_col is None and _numeric(df[x_axis_col]) is not None and _numeric(df[y_axis_col]) is not None:
+            fig = _density_heatmap(df, x_axis_col, y_axis_col, config.plot_density_bins)
+            message = f"Showing the density of {total_points:,} points, zoom in for the individual points"
+        else:
+            sample = df.sample(config.plot_max_webgl_points, random_state=0).sort_index()
+            fig = px.scatter(sample, x=x_axis_col, y=y_axis_col, color=group_by_col, render_mode="webgl")
+            message = f"Showing a random sample of {len(sample):,} of {total_points:,} points, zoom in for more detail"
+    elif plot_type == "line":
+        if total_points > config.plot_max_points:
+            df = _downsample_line(df, x_axis_col, y_axis_col, group_by_col, config.plot_max_points)
+            message = f"Showing {len(df):,} of {total_points:,} points, zoom in for more detail"
+        fig = px.line(df, x=x_axis_col, y=y_axis_col, color=group_by_col)
+    elif plot_type == "bar":
+        if total_points > config.plot_max_points and pd.api.types.is_numeric_dtype(df[y_axis_col]):
+            # Stacked bars of the same x and group look the same as one bar with their sum
+            keys = [x_axis_col] if group_by_col is None else [x_axis_col, group_by_col]
+            df = df.groupby(keys, sort=False, observed=True)[y_axis_col].sum().reset_index()
+        fig = px.bar(df, x=x_axis_col, y=y_axis_col, color=group_by_col)
+    elif plot_type == "pie":
+        if total_points > config.plot_max_points and pd.api.types.is_numeric_dtype(df[x_axis_col]):
+            # The pie sums the values of the same name anyway
+            df = df.groupby(y_axis_col, sort=False, observed=True)[x_axis_col].sum().reset_index()
+        fig = px.pie(df, values=x_axis_col, names=y_axis_col)
+
+    return fig, message
+
+
+def aggregate(df, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation):
+    """
+    Aggregate the loaded rows of a result the same way plot_queries.run_aggregate_query() does in the database
+    """
+    key_col, aggregated_col = plot_queries.plot_columns(plot_type, x_axis_col, y_axis_col)
+    value = plot_queries.value_column(aggregated_col, aggregation)
+    df = df.dropna(subset=[key_col])
+
+    keys = [df[key_col]]
+    if plot_type == "histogram":
+        x = _numeric(df[key_col])
+        if x is None:
+            raise ValueError("Histograms need a numeric or date x axis column")
+        bins = config.plot_histogram_bins
+        low = x.min() if len(x) else 0
+        width = ((x.max() - low) / bins if len(x) else 0) or 1
+        starts = low + np.minimum(np.floor((x - low) / width), bins - 1) * width
+        if pd.api.types.is_datetime64_any_dtype(df[key_col]):
+            starts = pd.to_datetime(starts.astype("int64"))
+        keys = [pd.Series(starts, index=df.index, name=key_col)]
+    if group_by_col is not None and plot_type != "pie":
+        keys.append(df[group_by_col])
+
+    if aggregation == "count" or aggregated_col is None:
+        aggregated = df.groupby(keys, observed=True).size()
+    else:
+        aggregated = df.groupby(keys, observed=True)[aggregated_col].agg(PANDAS_AGGREGATIONS[aggregation])
+    return aggregated.rename(value).reset_index()
+
+
+def build_aggregate_figure(df, plot_type, x_axis_col, y_axis_col, group_by_col, aggregation):
+    """
+    Build the figure of the result of aggregate() or plot_queries.run_aggregate_query().
+    Returns the same tuple as build_figure().
+    """
+    import plotly.express as px
+
+    key_col, aggregated_col = plot_queries.plot_columns(plot_type, x_axis_col, y_axis_col)
+    value = plot_queries.value_column(aggregated_col, aggregation)
+    if plot_type == "histogram":
+        fig = px.bar(df, x=key_col, y=value, color=group_by_col)
+        fig.update_layout(bargap=0)
+        return fig, None
+    if plot_type == "pie":
+        return build_figure(df, plot_type, value, key_col, None)
+    return build_figure(df, plot_type, key_col, value, group_by_col)
+
+
+def zoom_ranges(relayout_data):
+    """
+    Return the x and y ranges of a relayoutData event (None for an axis that was not zoomed),
+    or None if the event is not a zoom or a zoom reset
+    """
+    if not relayout_data:
+        return None
+    if relayout_data.get("xaxis.autorange") or relayout_data.get("yaxis.autorange"):
+        return None, None
+
+    ranges = []
+    for axis in ("xaxis", "yaxis"):
+        if f"{axis}.range[0]" in relayout_data:
+            ranges.append((relayout_data[f"{axis}.range[0]"], relayout_data[f"{axis}.range[1]"]))
+        elif f"{axis}.range" in relayout_data:
+            ranges.append(tuple(relayout_data[f"{axis}.range"]))
+        else:
+            ranges.append(None)
+
+    if ranges == [None, None]:
+        return None
+    return tuple(ranges)
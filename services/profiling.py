@@ -0,0 +1,236 @@
+import numpy as np
+import pandas as pd
+
+import config
+from services import metrics
+from services import result_store
+
+# HyperLogLog registers are indexed by the first HLL_PRECISION bits of the hashes (error ~ 1.04 / sqrt(2**14) = 0.8%)
+HLL_PRECISION = 14
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+HISTOGRAM_BINS = 10
+TOP_VALUES = 5
+# Text columns with at most this many distinct values are treated as categories by the plot suggestions
+CATEGORY_MAX_DISTINCT = 20
+PIE_MAX_DISTINCT = 8
+
+
+def _kind(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    return "text"
+
+
+def _hll_update(registers, hashes):
+    """
+    Add the 64 bit hashes of a chunk to the HyperLogLog registers of a column
+    """
+    index = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+    # The rank is the position of the first 1 bit after the index bits, looking at the next 32 bits
+    rest = (hashes << np.uint64(HLL_PRECISION)) >> np.uint64(32)
+    _, bit_length = np.frexp(rest.astype(np.float64))  # Exact, rest < 2**32
+    np.maximum.at(registers, index, (33 - bit_length).astype(np.uint8))
+
+
+def _hll_estimate(registers):
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)  # Linear counting is more accurate for small cardinalities
+    return int(round(estimate))
+
+
+def _nanoseconds(values):
+    """
+    Return datetimes as nanoseconds since the epoch, pandas 2 and later can keep them in other units
+    """
+    index = pd.DatetimeIndex(values)
+    if hasattr(index, "as_unit"):
+        index = index.as_unit("ns")
+    return index.asi8
+
+
+def _json_value(value, kind):
+    if value is None or pd.isna(value):
+        return None
+    if kind == "datetime":
+        return pd.Timestamp(value).isoformat()
+    return float(value)
+
+
+class _ColumnProfiler:
+    """
+    Statistics of one column that are updated chunk by chunk
+    """
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.kind = _kind(dtype)
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.registers = np.zeros(2**HLL_PRECISION, dtype=np.uint8)
+        self.samples = []
+
+    def update(self, values, sample_positions):
+        sampled = values.iloc[sample_positions]
+        self.samples.append(sampled[sampled.notna().to_numpy()])
+        not_null = values.notna().to_numpy()
+        self.nulls += len(values) - int(not_null.sum())
+        values = values[not_null]
+        self.count += len(values)
+        if not len(values):
+            return
+
+        _hll_update(self.registers, pd.util.hash_pandas_object(values, index=False).to_numpy())
+        if self.kind in ("numeric", "datetime"):
+            chunk_min, chunk_max = values.min(), values.max()
+            self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+            self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+    def result(self):
+        profile = {
+            "dtype": str(self.dtype),
+            "kind": self.kind,
+            "count": self.count,
+            "null_fraction": self.nulls / (self.count + self.nulls) if self.count + self.nulls else 0,
+            "distinct": min(_hll_estimate(self.registers), self.count),
+            "min": _json_value(self.min, self.kind),
+            "max": _json_value(self.max, self.kind),
+            "quantiles": None,
+            "histogram": None,
+            "top_values": None,
+        }
+        sample = pd.concat(self.samples) if self.samples else pd.Series([], dtype=self.dtype)
+        if not len(sample):
+            return profile
+
+        if self.kind in ("numeric", "datetime"):
+            # Datetimes are profiled as nanoseconds since the epoch
+            if self.kind == "datetime":
+                numbers = _nanoseconds(sample).astype(np.float64)
+                low, high = pd.Timestamp(self.min).value, pd.Timestamp(self.max).value
+            else:
+                numbers = sample.to_numpy(dtype=np.float64)
+                low, high = float(self.min), float(self.max)
+            profile["quantiles"] = [
+                _json_value(pd.Timestamp(int(q)) if self.kind == "datetime" else q, self.kind)
+                for q in np.quantile(numbers, QUANTILES)
+            ]
+            counts, _ = np.histogram(numbers, bins=HISTOGRAM_BINS, range=(low, high) if high > low else None)
+            # The sample is uniform, its counts are scaled to the whole column
+            profile["histogram"] = [int(round(c)) for c in counts * (self.count / len(sample))]
+        else:
+            top_values = sample.astype(str).value_counts().head(TOP_VALUES)
+            profile["top_values"] = [
+                [value, int(round(count * self.count / len(sample)))] for value, count in top_values.items()
+            ]
+        return profile
+
+
+def profile_dataframe(df, chunk_rows=None, sample_size=None):
+    """
+    Profile every column of a dataframe in one pass over chunks of its rows.
+    Returns {"rows": number of rows, "columns": {column: statistics}}, the statistics of a column are its dtype,
+    kind ("numeric", "datetime", "boolean" or "text"), count of non null values, null fraction, estimated distinct
+    values (HyperLogLog), min, max, QUANTILES and a histogram of HISTOGRAM_BINS bins (numeric and datetime columns)
+    or its TOP_VALUES most frequent values with their estimated counts (the other columns).
+    The quantiles, histograms and top values come from a uniform sample of sample_size rows.
+    """
+    chunk_rows = chunk_rows or config.profile_chunk_rows
+    sample_size = sample_size or config.profile_sample_size
+    rows = len(df)
+    # The same rows are sampled every time, a result always has the same profile
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(rows, sample_size, replace=False)) if rows > sample_size else np.arange(rows)
+
+    profilers = [_ColumnProfiler(dtype) for dtype in df.dtypes]
+    for start in range(0, rows, chunk_rows):
+        chunk = df.iloc[start : start + chunk_rows]
+        sample_positions = sample[np.searchsorted(sample, start) : np.searchsorted(sample, start + len(chunk))] - start
+        for i, profiler in enumerate(profilers):
+            profiler.update(chunk.iloc[:, i], sample_positions)
+
+    return {"rows": rows, "columns": {str(column): p.result() for column, p in zip(df.columns, profilers)}}
+
+
+def result_profile(result_id):
+    """
+    Return the profile (see profile_dataframe) of a stored result, it is computed the first time
+    and stored with the result. None if the result is not stored anymore.
+    """
+    profile = result_store.get_attachment(result_id, "profile")
+    if profile is not None:
+        return profile
+
+    df = result_store.get(result_id)
+    if df is None:
+        return None
+    with metrics.timed("profile"):
+        profile = profile_dataframe(df)
+    result_store.put_attachment(result_id, "profile", profile)
+    return profile
+
+
+def _is_key(stats):
+    # Integer columns with a distinct value on (almost) every row are ids, not measures
+    return stats["dtype"].lower().startswith(("int", "uint")) and stats["distinct"] >= 0.95 * stats["count"] > 100
+
+
+def suggest_plots(profile):
+    """
+    Return plots that fit the columns of a profile, as a list of dictionaries with a label,
+    plot_type, x, y, group and aggregation (the values of the plot inputs)
+    """
+    columns = profile["columns"]
+    # Columns with fewer nulls first
+    ordered = sorted(columns, key=lambda column: columns[column]["null_fraction"])
+    measures = [
+        c for c in ordered if columns[c]["kind"] == "numeric" and not _is_key(columns[c]) and columns[c]["count"]
+    ]
+    times = [c for c in ordered if columns[c]["kind"] == "datetime" and columns[c]["count"]]
+    categories = [
+        c
+        for c in ordered
+        if columns[c]["kind"] in ("text", "boolean") and 1 < columns[c]["distinct"] <= CATEGORY_MAX_DISTINCT
+    ]
+
+    def suggestion(label, plot_type, x, y=None, group=None, aggregation="none"):
+        return {"label": label, "plot_type": plot_type, "x": x, "y": y, "group": group, "aggregation": aggregation}
+
+    suggestions = []
+    if times and measures:
+        suggestions.append(suggestion(f"{measures[0]} over {times[0]}", "line", times[0], measures[0]))
+    if categories and measures:
+        suggestions.append(
+            suggestion(
+                f"Average {measures[0]} by {categories[0]}", "bar", categories[0], measures[0], aggregation="avg"
+            )
+        )
+    if len(measures) >= 2:
+        group = next((c for c in categories if columns[c]["distinct"] <= PIE_MAX_DISTINCT), None)
+        suggestions.append(
+            suggestion(f"{measures[1]} against {measures[0]}", "scatter", measures[0], measures[1], group)
+        )
+    if measures:
+        suggestions.append(suggestion(f"Distribution of {measures[0]}", "histogram", measures[0], aggregation="count"))
+    # A pie plots the sum of x (its values) per y (its names)
+    pie_categories = [c for c in categories if columns[c]["distinct"] <= PIE_MAX_DISTINCT]
+    if pie_categories and measures:
+        suggestions.append(
+            suggestion(
+                f"Share of {measures[0]} by {pie_categories[0]}",
+                "pie",
+                measures[0],
+                pie_categories[0],
+                aggregation="sum",
+            )
+        )
+    return suggestions
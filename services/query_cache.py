@@ -0,0 +1,273 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from database_controllers import pool
+from services import result_store
+
+_CACHEABLE_QUERY = re.compile(r"\s*(select|with|show|describe|desc|explain)\b", re.IGNORECASE)
+# SHOW, DESCRIBE and EXPLAIN read the catalog or the server state, their tables can't be probed
+_SELECT_QUERY = re.compile(r"\s*(select|with)\b", re.IGNORECASE)
+_WRITING_CLAUSE = re.compile(r"\b(into|for\s+update|for\s+share|lock\s+in\s+share\s+mode)\b", re.IGNORECASE)
+# Comments, strings, quoted identifiers, words and single characters of a query
+_TOKEN = re.compile(
+    r"--[^\n]*|#[^\n]*|/\*.*?\*/|'(?:[^'\\]|\\.)*'|\"(?:[^\"]|\"\")*\"|`(?:[^`]|``)*`|[\w$]+|\S", re.DOTALL
+)
+_IDENTIFIER = re.compile(r"[^\W\d][\w$]*|\"(?:[^\"]|\"\")*\"|`(?:[^`]|``)*`")
+# Words that can follow a table reference and are not its alias
+_NOT_ALIAS = set(
+    "where join inner left right full cross natural straight_join on using group order having limit offset fetch "
+    "union except intersect window qualify for lock into tablesample partition use force ignore returning".split()
+)
+# Functions and values that change from one run of a query to the next, queries that use them are not cached
+_VOLATILE = set(
+    "now rand random uuid uuid_short gen_random_uuid sysdate curdate curtime current_date current_time "
+    "current_timestamp localtime localtimestamp unix_timestamp utc_date utc_time utc_timestamp clock_timestamp "
+    "statement_timestamp transaction_timestamp timeofday connection_id pg_backend_pid last_insert_id found_rows "
+    "row_count txid_current".split()
+)
+
+
+class QueryCache:
+    """
+    Cache of query results keyed by (connection identity, normalized query).
+    Entries expire after ttl seconds, the least recently used ones are evicted when the
+    results they point to take more than max_bytes, and an entry is dropped as soon as
+    the freshness probe of the tables it reads returns something different.
+    Only results with a freshness token are cached.
+    """
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (result_store data, freshness, created at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, freshness_func):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or not self._is_valid(entry, freshness_func):
+            with self._lock:
+                if entry is not None and self._entries.get(key) is entry:
+                    self._remove(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+        return entry[0]
+
+    def put(self, key, data, freshness):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, freshness, time.monotonic())
+            self._bytes += data["bytes"]
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+    def _is_valid(self, entry, freshness_func):
+        data, freshness, created_at = entry
+        if time.monotonic() - created_at > self.ttl:
+            return False
+        if not result_store.contains(data["result_id"]):
+            return False
+        if freshness is None:
+            return False
+        try:
+            return freshness_func() == freshness
+        except Exception:
+            return False
+
+    def _remove(self, key):
+        data, _, _ = self._entries.pop(key)
+        self._bytes -= data["bytes"]
+
+
+_cache = QueryCache(ttl=config.query_cache_ttl, max_bytes=config.query_cache_max_bytes)
+
+
+def normalize_query(query):
+    """
+    Collapse the whitespace of a query (outside of quoted strings) and remove the trailing semicolon
+    """
+    normalized = []
+    quote = None
+    pending_space = False
+    for char in query.strip().rstrip(";").strip():
+        if quote is not None:
+            normalized.append(char)
+            if char == quote:
+                quote = None
+        elif char.isspace():
+            pending_space = True
+        else:
+            if pending_space:
+                normalized.append(" ")
+                pending_space = False
+            normalized.append(char)
+            if char in ("'", '"', "`"):
+                quote = char
+    return "".join(normalized)
+
+
+def is_cacheable(query):
+    """
+    Only read-only queries are cached
+    """
+    return bool(_CACHEABLE_QUERY.match(query)) and not _WRITING_CLAUSE.search(query)
+
+
+def _tokens(query):
+    return [token for token in _TOKEN.findall(query) if not token.startswith(("--", "#", "/*"))]
+
+
+def _name(tokens, i):
+    """
+    Return the table name of the (maybe schema qualified, e.g db.a) identifier at tokens[i] without its quotes
+    and the position after it, None if there is no identifier at tokens[i]
+    """
+    if i >= len(tokens) or not _IDENTIFIER.fullmatch(tokens[i]):
+        return None
+    parts = [tokens[i].strip('`"')]
+    while i + 2 < len(tokens) and tokens[i + 1] == "." and _IDENTIFIER.fullmatch(tokens[i + 2]):
+        i += 2
+        parts.append(tokens[i].strip('`"'))
+    return ".".join(parts), i + 1
+
+
+def _table_list(tokens, i, tables, comma_list, after_table=False):
+    """
+    Add the tables referenced from tokens[i] on (after a FROM or a JOIN) to tables.
+    after_table is True when tokens[i] follows a derived table, only its alias is left.
+    Returns the position after the references, the position of the parenthesis of a derived table,
+    or None if a reference is not a table name.
+    """
+    while True:
+        if not after_table:
+            if i < len(tokens) and tokens[i] == "(":
+                return i
+            name = _name(tokens, i)
+            if name is None or name[0].lower() == "lateral":
+                return None
+            table, i = name
+            if i < len(tokens) and tokens[i] == "(":
+                return None  # A table function, we don't know what it reads
+            tables.add(table)
+        after_table = False
+        if i < len(tokens) and tokens[i].lower() == "as":
+            i += 2
+        elif i < len(tokens) and _IDENTIFIER.fullmatch(tokens[i]) and tokens[i].lower() not in _NOT_ALIAS:
+            i += 1
+        if not comma_list or i >= len(tokens) or tokens[i] != ",":
+            return i
+        i += 1
+
+
+def _starts_subquery(tokens, i):
+    return i < len(tokens) and tokens[i].lower() in ("select", "with")
+
+
+def referenced_tables(query):
+    """
+    Return the names of the tables that a query reads: the ones after JOIN and the comma separated ones after FROM,
+    in the query and in its subqueries. Schema qualified names keep their schema (e.g db.a).
+    The FROM of function calls (e.g EXTRACT(year FROM col)) is not a table.
+    Returns None when the tables can't be told (e.g table functions or LATERAL).
+    """
+    tokens = _tokens(query)
+    tables = set()
+    # For every open parenthesis: (True if it starts a subquery, True if a FROM list goes on after it)
+    nested = []
+    i = 0
+    while i < len(tokens):
+        keyword = tokens[i].lower()
+        i += 1
+        if keyword == "(":
+            nested.append((_starts_subquery(tokens, i), False))
+            continue
+        if keyword == ")":
+            if not nested or not nested.pop()[1]:
+                continue
+            i = _table_list(tokens, i, tables, comma_list=True, after_table=True)
+        elif keyword in ("from", "join") and (not nested or nested[-1][0]):
+            i = _table_list(tokens, i, tables, comma_list=keyword == "from")
+        else:
+            continue
+        if i is None:
+            return None
+        if i < len(tokens) and tokens[i] == "(":
+            # A derived table, its own tables are read when its subquery is scanned
+            nested.append((_starts_subquery(tokens, i + 1), keyword != "join"))
+            i += 1
+    return sorted(tables)
+
+
+def _cached_tables(query):
+    """
+    Return the tables of a query whose result can be cached, None if it can't be: queries that are not
+    SELECTs, that use volatile functions (e.g NOW()) or whose tables can't be told or are none
+    """
+    if not _SELECT_QUERY.match(query) or not is_cacheable(query):
+        return None
+    if any(token.lower() in _VOLATILE for token in _tokens(query)):
+        return None
+    return referenced_tables(query) or None
+
+
+def cache_key(data_source, db_config, query):
+    # The password is part of the pool key (hashed), a wrong password doesn't get the results of the right one
+    return json.dumps([pool.pool_key(data_source, db_config), normalize_query(query)])
+
+
+def freshness(data_source, db_config, query):
+    """
+    Return the current freshness token of the tables a query reads,
+    None if the result can't be cached or the database can't tell if one of the tables changed (e.g a view).
+    """
+    tables = _cached_tables(query)
+    freshness_func = config.database_freshness_functions.get(data_source)
+    if tables is None or freshness_func is None:
+        return None
+    versions = freshness_func(db_config, tables)
+    if any(versions.get(table) is None for table in tables):
+        return None
+    return json.dumps([[table, versions[table]] for table in tables], default=str)
+
+
+def lookup(data_source, db_config, query):
+    """
+    Return the result_store data of the cached result of a query or None
+    """
+    if _cached_tables(query) is None:
+        return None
+    key = cache_key(data_source, db_config, query)
+    return _cache.get(key, lambda: freshness(data_source, db_config, query))
+
+
+def store(data_source, db_config, query, data, query_freshness):
+    """
+    Cache the result of a query, query_freshness is the freshness token from before the query ran.
+    Results without a freshness token are not cached, they could be stale for the whole ttl.
+    """
+    if query_freshness is not None and _cached_tables(query) is not None:
+        _cache.put(cache_key(data_source, db_config, query), data, query_freshness)
+
+
+def stats():
+    """
+    Return the hit and miss counters of the query cache of this worker
+    """
+    return _cache.stats()
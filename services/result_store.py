@@ -0,0 +1,283 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+import config
+from services import metrics
+from services import serializers
+
+
+class ResultStore:
+    """
+    Server-side store for query results.
+    Results are kept in an in-memory LRU that is bounded by bytes and,
+    if spill_dir is set, also written to disk so that every gunicorn
+    worker (and the memory tier after an eviction) can read them back.
+    Spilled results are written with one of the serializers of the serializers module.
+    Small JSON attachments (e.g the profile of a result) can be stored with a result, they are
+    written next to the spilled result and removed with it.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=None, serializer="arrow", compression=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.serializer = serializer
+        self.compression = compression
+        self._results = OrderedDict()  # result_id -> (df, size in bytes)
+        self._attachments = {}  # (result_id, name) -> value, when there is no spill directory
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def put(self, df, size, keep_in_memory=True):
+        """
+        Store a dataframe of size bytes and return the id of the result
+        """
+        result_id = uuid.uuid4().hex[:16]
+        if keep_in_memory:
+            self._remember(result_id, df, size)
+        if self.spill_dir:
+            self._spill(result_id, df)
+        elif not keep_in_memory:
+            raise ValueError("A result that is not kept in memory needs a spill directory")
+        return result_id
+
+    def stores_files(self):
+        """
+        True if Arrow IPC files can be stored as results as they are, see put_file()
+        """
+        return bool(self.spill_dir) and self.serializer == "arrow"
+
+    def put_file(self, path):
+        """
+        Store an Arrow IPC file as a result without reading it and return the id of the result.
+        The file is linked into the spill directory (copied if it is on another file system).
+        """
+        if not self.stores_files():
+            raise ValueError("Files can only be stored as results when they are spilled with the arrow serializer")
+        result_id = uuid.uuid4().hex[:16]
+        spill_path = self._spill_path(result_id)
+        try:
+            os.link(path, spill_path)
+        except OSError:
+            tmp_path = f"{spill_path}.{os.getpid()}.tmp"
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, spill_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        # A linked file keeps the modification time of the original, it is the newest result
+        os.utime(spill_path)
+
+        if self.spill_max_bytes:
+            self._prune_spilled()
+        return result_id
+
+    def get(self, result_id):
+        """
+        Return the dataframe of a result or None if it is not stored anymore
+        """
+        with self._lock:
+            entry = self._results.get(result_id)
+            if entry is not None:
+                self._results.move_to_end(result_id)
+                return entry[0]
+
+        df = self._read_spilled(result_id)
+        if df is not None:
+            self._remember(result_id, df, _size(df))
+        return df
+
+    def contains(self, result_id):
+        with self._lock:
+            if result_id in self._results:
+                return True
+        return bool(self.spill_dir) and os.path.exists(self._spill_path(result_id))
+
+    def put_attachment(self, result_id, name, value):
+        if not self.spill_dir:
+            with self._lock:
+                if result_id in self._results:
+                    self._attachments[(result_id, name)] = value
+            return
+
+        path = self._attachment_path(result_id, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def get_attachment(self, result_id, name):
+        if not self.spill_dir:
+            with self._lock:
+                return self._attachments.get((result_id, name))
+        try:
+            with open(self._attachment_path(result_id, name)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _attachment_path(self, result_id, name):
+        return os.path.join(self.spill_dir, f"{result_id}.{name}.json")
+
+    def _remember(self, result_id, df, size):
+        with self._lock:
+            self._results[result_id] = (df, size)
+            self._bytes += size
+            # Evict least recently used results but always keep the one we just added
+            while self._bytes > self.max_bytes and len(self._results) > 1:
+                evicted_id, (_, evicted_size) = self._results.popitem(last=False)
+                self._bytes -= evicted_size
+                for key in [key for key in self._attachments if key[0] == evicted_id]:
+                    del self._attachments[key]
+
+    def _spill_path(self, result_id):
+        return os.path.join(self.spill_dir, f"{result_id}.{serializers.extension(self.serializer)}")
+
+    def _spill(self, result_id, df):
+        path = self._spill_path(result_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with metrics.timed("serialize"):
+                try:
+                    serializers.write(self.serializer, df, tmp_path, self.compression)
+                except Exception:
+                    # Columns with mixed python objects can't be written to arrow/parquet, store them as text
+                    object_columns = df.select_dtypes(include="object").columns
+                    df = df.astype({col: str for col in object_columns})
+                    serializers.write(self.serializer, df, tmp_path, self.compression)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if self.spill_max_bytes:
+            self._prune_spilled()
+
+    def _read_spilled(self, result_id):
+        if not self.spill_dir:
+            return None
+        try:
+            with metrics.timed("deserialize"):
+                return serializers.read(self.serializer, self._spill_path(result_id))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _prune_spilled(self):
+        """
+        Remove the oldest spilled results until the spill directory fits in spill_max_bytes
+        """
+        files = []
+        attachments = {}  # result_id -> paths of its attachments
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(f".{serializers.extension(self.serializer)}"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith(".json") and entry.name.count(".") == 2:
+                attachments.setdefault(entry.name.split(".")[0], []).append(entry.path)
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.spill_max_bytes:
+                break
+            result_id = os.path.basename(path).split(".")[0]
+            for removed_path in [path] + attachments.get(result_id, []):
+                try:
+                    os.remove(removed_path)
+                except FileNotFoundError:
+                    pass  # Another worker removed it already
+            total_size -= size
+
+
+def _size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+_store = ResultStore(
+    max_bytes=config.result_store_max_bytes,
+    spill_dir=config.result_store_spill_dir,
+    spill_max_bytes=config.result_store_spill_max_bytes,
+    serializer=config.result_serializer,
+    compression=config.result_compression,
+)
+
+
+def put(df, keep_in_memory=True, **metadata):
+    """
+    Store a query result on the server and return the data to keep
+    in the browser for it, a dictionary with:
+    0. result_id: The id to get the dataframe back with get()
+    1. columns: The column names of the result
+    2. dtypes: The dtype of each column
+    3. rows: The number of rows of the result
+    4. bytes: The size of the result in memory
+    Any extra keyword arguments are added to the dictionary as they are.
+    Results that are not kept in memory (e.g the ones of background jobs) are only written to disk.
+    """
+    size = _size(df)
+    return {
+        "result_id": _store.put(df, size, keep_in_memory),
+        "columns": list(df.columns),
+        "dtypes": [str(dtype) for dtype in df.dtypes],
+        "rows": len(df),
+        "bytes": size,
+        **metadata,
+    }
+
+
+def put_file(path, **metadata):
+    """
+    Store an Arrow IPC file (e.g an uploaded dataset) as a result without reading its rows into memory
+    and return the same data as put(), the size of the result is the size of the file.
+    Only possible when stores_files() is True.
+    """
+    empty_df, rows = serializers.read_arrow_schema(path)
+    return {
+        "result_id": _store.put_file(path),
+        "columns": list(empty_df.columns),
+        "dtypes": [str(dtype) for dtype in empty_df.dtypes],
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        **metadata,
+    }
+
+
+def stores_files():
+    """
+    True if put_file() can store files, the results have to be spilled with the arrow serializer
+    """
+    return _store.stores_files()
+
+
+def get(result_id):
+    """
+    Return the dataframe of a stored result or None if it was evicted
+    """
+    return _store.get(result_id)
+
+
+def put_attachment(result_id, name, value):
+    """
+    Store a JSON serializable value with a result, it is removed when the result is
+    """
+    _store.put_attachment(result_id, name, value)
+
+
+def get_attachment(result_id, name):
+    """
+    Return a value that was stored with a result, None if there is none
+    """
+    return _store.get_attachment(result_id, name)
+
+
+def contains(result_id):
+    """
+    True if a result is still stored, in memory or on disk
+    """
+    return _store.contains(result_id)
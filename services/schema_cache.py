@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from database_controllers import pool
+
+
+class SchemaCache:
+    """
+    Cache of the tables and columns of the databases, keyed by (connection identity, table).
+    Everything is loaded on first use. Entries older than ttl are still served,
+    a background thread reloads them so that nobody waits for the catalog.
+    The least recently used entries are evicted above max_entries.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, loaded at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, load_func):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry[1] > self.ttl and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, load_func), daemon=True).start()
+                return entry[0]
+
+        value = load_func()
+        self._put(key, value)
+        return value
+
+    def _refresh(self, key, load_func):
+        try:
+            self._put(key, load_func())
+        except Exception:
+            pass  # The old entry is served until a reload works
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, identity):
+        """
+        Drop the tables and columns of one database
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == identity]:
+                del self._entries[key]
+
+
+_cache = SchemaCache(ttl=config.schema_cache_ttl, max_entries=config.schema_cache_max_entries)
+
+
+def _identity(data_source, db_config):
+    # The same key as the connection pools, users of the same database with the same credentials share the entries
+    return pool.pool_key(data_source, db_config)
+
+
+def tables(data_source, db_config):
+    """
+    Return the tables of a database as a list of (table name, estimated rows) tuples sorted by name
+    """
+    list_tables_func = config.database_tables_functions[data_source]
+    return _cache.get((_identity(data_source, db_config), None), lambda: list_tables_func(db_config))
+
+
+def columns(data_source, db_config, table):
+    """
+    Return the columns of a table as a list of (column name, column type) tuples
+    """
+    table_columns_func = config.database_columns_functions[data_source]
+    return _cache.get((_identity(data_source, db_config), table), lambda: table_columns_func(db_config, table))
+
+
+def row_estimate(data_source, db_config, table):
+    """
+    Return the estimated number of rows of a table, None if the database doesn't know it
+    """
+    return dict(tables(data_source, db_config)).get(table)
+
+
+def search(data_source, db_config, search_value, limit):
+    """
+    Return at most limit tables (same tuples as tables()) whose name contains search_value,
+    ignoring case. The tables whose name starts with it come first.
+    """
+    search_value = (search_value or "").lower()
+    starts_with = []
+    contains = []
+    for table in tables(data_source, db_config):
+        name = table[0].lower()
+        if name.startswith(search_value):
+            starts_with.append(table)
+            if len(starts_with) == limit:
+                break
+        elif search_value in name and len(contains) < limit:
+            contains.append(table)
+    return (starts_with + contains)[:limit]
+
+
+def refresh(data_source, db_config):
+    """
+    Forget the cached tables and columns of a database, e.g after the user created or dropped tables
+    """
+    _cache.invalidate(_identity(data_source, db_config))
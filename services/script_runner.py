@@ -0,0 +1,223 @@
+import concurrent.futures
+import contextlib
+import re
+import threading
+import time
+
+import config
+from services import query_cache
+from services import result_store
+
+_WRITE_TARGET = re.compile(
+    r"\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from|truncate(?:\s+table)?|alter\s+table"
+    r"|create\s+(?:(?:global|local)\s+)?(?:(?:temporary|temp|unlogged)\s+)?table(?:\s+if\s+not\s+exists)?"
+    r"|drop\s+(?:temporary\s+)?table(?:\s+if\s+exists)?"
+    r"|create\s+(?:or\s+replace\s+)?view|drop\s+view(?:\s+if\s+exists)?)"
+    r"\s+([`\"]?[\w$]+[`\"]?(?:\.[`\"]?[\w$]+[`\"]?)?)",
+    re.IGNORECASE,
+)
+_SESSION_STATEMENT = re.compile(
+    r"\s*(set|use|begin|start\s+transaction|commit|rollback|savepoint|release|lock|unlock"
+    r"|prepare|execute|deallocate)\b",
+    re.IGNORECASE,
+)
+_VARIABLE = re.compile(r"@[\w@]")
+
+
+def split_statements(script, mysql_syntax=True):
+    """
+    Split a script in its statements on the semicolons that are outside of quotes and comments, comments are removed.
+    mysql_syntax enables the # comments and the backslash escapes in strings of MySQL/MariaDB.
+    """
+    statements = []
+    current = []
+    quote = None
+    i = 0
+    while i < len(script):
+        char = script[i]
+        if quote is not None:
+            current.append(char)
+            if char == "\\" and mysql_syntax and quote != "`" and i + 1 < len(script):
+                current.append(script[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif script.startswith("--", i) or (char == "#" and mysql_syntax):
+            end = script.find("\n", i)
+            i = len(script) if end == -1 else end
+            continue
+        elif script.startswith("/*", i):
+            end = script.find("*/", i + 2)
+            i = len(script) if end == -1 else end + 2
+            current.append(" ")
+            continue
+        elif char == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            if char in ("'", '"', "`"):
+                quote = char
+            current.append(char)
+        i += 1
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def _table_name(reference):
+    return reference.split(".")[-1].strip('`"').lower()
+
+
+def plan_statements(statements):
+    """
+    Build the dependency graph of the statements of a script. Returns a list with a dictionary for every statement:
+    0. session: True if the statement runs on the session connection, in script order with the other session statements.
+       These are the statements that write, use temporary tables or variables, or read a table the script writes.
+    1. depends_on: The positions of the statements that have to finish before it starts
+    Read-only statements that don't depend on the script run in parallel, each on its own connection.
+    Everything after a statement that changes the session (e.g USE, SET search_path, BEGIN) or that we don't
+    understand (e.g CALL) runs on the session connection, the other connections never saw the change.
+    A read whose tables can't be told only runs in parallel before the script writes, and every write waits for it.
+    """
+    plan = []
+    parallel_reads = {}  # position of a parallel statement -> tables it reads, None if they are unknown
+    written_tables = set()
+    last_session = None
+    in_order = False
+    for position, statement in enumerate(statements):
+        referenced = query_cache.referenced_tables(statement)
+        reads = None if referenced is None else {_table_name(table) for table in referenced}
+        write_target = _WRITE_TARGET.match(statement)
+        reads_only = query_cache.is_cacheable(statement)
+        independent = not written_tables if reads is None else not reads & written_tables
+        if reads_only and not _VARIABLE.search(statement) and not in_order and independent:
+            plan.append({"session": False, "depends_on": []})
+            parallel_reads[position] = reads
+            continue
+
+        writes = {_table_name(write_target.group(1))} if write_target else set()
+        changes_session = bool(_SESSION_STATEMENT.match(statement))
+        barrier = not (reads_only or write_target or changes_session)
+        depends_on = set() if last_session is None else {last_session}
+        for earlier, earlier_reads in parallel_reads.items():
+            # Parallel reads of a table finish before the script changes it,
+            # and nothing runs next to a statement whose effects we don't know
+            if barrier or (earlier_reads & writes if earlier_reads is not None else writes):
+                depends_on.add(earlier)
+        plan.append({"session": True, "depends_on": sorted(depends_on)})
+        written_tables |= writes
+        last_session = position
+        in_order = in_order or barrier or changes_session
+    return plan
+
+
+def _plan_script(data_source, script):
+    dialect = config.database_sql_dialects[data_source]
+    statements = split_statements(script, mysql_syntax=dialect["quote"] == "`")
+    return statements, plan_statements(statements)
+
+
+def connections_needed(data_source, script):
+    """
+    Return the most database connections that run_script() opens at the same time for a script
+    """
+    _, plan = _plan_script(data_source, script)
+    parallel = sum(1 for step in plan if not step["session"])
+    session = any(step["session"] for step in plan)
+    return max(min(parallel, config.script_max_parallel) + session, 1)
+
+
+def run_script(
+    data_source, db_config, script, query_token=None, on_progress=None, keep_in_memory=True, max_connections=None
+):
+    """
+    Run the statements of a script, the independent read-only ones at the same time on a thread pool of
+    pooled connections (config.script_max_parallel) and the rest in order on one session connection.
+    on_progress, if given, is called with the number of finished statements and the number of statements,
+    it can raise to stop the script.
+    max_connections, if given, is the most connections the script can open at the same time (e.g the admission
+    slots it got). When there is no connection left next to the session connection, every statement runs on it.
+    Returns a list with a dictionary for every statement:
+    0. statement: The sql of the statement
+    1. session: True if it ran on the session connection
+    2. result: The result_store data of the rows it returned, None if it returned none
+    3. rows: The number of rows it returned or changed
+    4. seconds: How long it took
+    5. error: The error message if it failed or was skipped, None otherwise
+    """
+    statements, plan = _plan_script(data_source, script)
+    max_parallel = config.script_max_parallel
+    if max_connections is not None:
+        max_parallel = min(max_parallel, max_connections - any(step["session"] for step in plan))
+        if max_parallel < 1:
+            # One worker runs the statements in script order
+            plan = [{**step, "session": True} for step in plan]
+            max_parallel = 1
+    stream_query_func = config.database_stream_functions[data_source]
+    execute_statement_func = config.database_statement_functions[data_source]
+    outcomes = [None] * len(statements)
+    stopped = threading.Event()
+
+    def run(position, session_conn):
+        statement = statements[position]
+        step = plan[position]
+        outcome = {"statement": statement, "session": step["session"], "result": None, "rows": None, "seconds": None}
+        for earlier in step["depends_on"]:
+            if outcomes[earlier] is None or outcomes[earlier]["error"] is not None:
+                outcomes[position] = {**outcome, "error": f"Skipped because statement {earlier + 1} did not finish"}
+                return
+        if stopped.is_set():
+            outcomes[position] = {**outcome, "error": "Skipped because the script was stopped"}
+            return
+
+        start = time.perf_counter()
+        try:
+            if step["session"]:
+                df, truncated, rows = execute_statement_func(
+                    session_conn, statement, config.query_max_rows, config.query_max_bytes, query_token
+                )
+                metadata = {"truncated": truncated}
+            else:
+                df, truncated = stream_query_func(
+                    db_config, statement, config.query_max_rows, config.query_max_bytes, query_token=query_token
+                )
+                rows = len(df)
+                # Plots can aggregate all the rows of an independent statement
+                metadata = {"truncated": truncated, "source_query": statement}
+            if df is not None:
+                outcome["result"] = result_store.put(df, keep_in_memory=keep_in_memory, **metadata)
+            outcome["rows"] = rows
+            outcome["error"] = None
+        except Exception as err:
+            outcome["error"] = str(err)
+        outcome["seconds"] = time.perf_counter() - start
+        outcomes[position] = outcome
+
+    with contextlib.ExitStack() as stack:
+        session_conn = None
+        if any(step["session"] for step in plan):
+            # It commits every statement, and it is closed so temporary tables and variables don't leak to the pool
+            session_conn = stack.enter_context(config.database_session_functions[data_source](db_config))
+
+        # Statements wait for the ones they depend on in their worker thread. They are submitted
+        # in script order so the statements they wait for have always started already.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = {}
+            for position, step in enumerate(plan):
+                earlier_futures = [futures[earlier] for earlier in step["depends_on"]]
+                futures[position] = executor.submit(_after, earlier_futures, run, position, session_conn)
+            try:
+                for finished, _ in enumerate(concurrent.futures.as_completed(futures.values()), start=1):
+                    if on_progress is not None:
+                        on_progress(finished, len(statements))
+            except BaseException:
+                stopped.set()
+                for future in futures.values():
+                    future.cancel()
+                raise
+
+    return outcomes
+
+
+def _after(earlier_futures, func, *args):
+    concurrent.futures.wait(earlier_futures)
+    func(*args)
@@ -0,0 +1,90 @@
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+
+def _write_json(df, path, compression):
+    # The format results used to travel in between the callbacks, kept to compare against
+    df.to_json(path, date_format="iso", orient="split")
+
+
+def _read_json(path):
+    return pd.read_json(path, orient="split")
+
+
+def _write_parquet(df, path, compression):
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path, compression=compression or "none")
+
+
+def _read_parquet(path):
+    return pq.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+
+
+def _write_arrow(df, path, compression):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    options = ipc.IpcWriteOptions(compression=compression or None)
+    with ipc.new_file(path, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+
+def _arrow_to_pandas(table):
+    # The datasets of uploaded files (see datasets.ingest_csv) list the string columns to read as categoricals
+    metadata = table.schema.metadata or {}
+    categorical_columns = json.loads(metadata.get(b"categorical_columns", b"[]"))
+    return table.to_pandas(split_blocks=True, categories=categorical_columns)
+
+
+def _read_arrow(path):
+    """
+    The file is memory-mapped, uncompressed numeric columns are used by pandas without being copied
+    """
+    with pa.memory_map(path) as source:
+        table = ipc.open_file(source).read_all()
+    return _arrow_to_pandas(table)
+
+
+# name -> (file extension, write function, read function)
+SERIALIZERS = {
+    "json": ("json", _write_json, _read_json),
+    "parquet": ("parquet", _write_parquet, _read_parquet),
+    "arrow": ("arrow", _write_arrow, _read_arrow),
+}
+
+
+def extension(name):
+    """
+    Return the file extension of the files a serializer writes
+    """
+    return SERIALIZERS[name][0]
+
+
+def write(name, df, path, compression=None):
+    """
+    Write a dataframe to path with the serializer name.
+    compression is a codec of pyarrow (e.g zstd or lz4), the json serializer ignores it.
+    Dtypes (ints, datetimes, categoricals) survive the arrow and parquet serializers.
+    """
+    _, write_func, _ = SERIALIZERS[name]
+    write_func(df, path, compression)
+
+
+def read(name, path):
+    """
+    Read a dataframe that was written with the serializer name
+    """
+    _, _, read_func = SERIALIZERS[name]
+    return read_func(path)
+
+
+def read_arrow_schema(path):
+    """
+    Return an empty dataframe with the columns and dtypes of an Arrow IPC file and the number of rows of the file,
+    without reading its columns
+    """
+    with pa.memory_map(path) as source:
+        reader = ipc.open_file(source)
+        rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+        return _arrow_to_pandas(reader.schema.empty_table()), rows
@@ -0,0 +1,334 @@
+import datetime
+import decimal
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import config
+from database_controllers import pool
+from services.table_query import subquery
+
+# Snapshots are queried as views of the embedded database, their names are SQL identifiers
+_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def _snapshot_dir(snapshot_id):
+    """
+    Every snapshot is a directory of Parquet partitions and the manifest that lists them
+    """
+    if not re.fullmatch(r"[a-f0-9]+", snapshot_id):
+        raise ValueError(f"Invalid snapshot id {snapshot_id!r}")
+    return os.path.join(config.snapshot_dir, snapshot_id)
+
+
+def _identity(data_source, db_config):
+    # The password is part of the pool key (hashed), only the same credentials can refresh a snapshot
+    return hashlib.sha1(json.dumps(pool.pool_key(data_source, db_config)).encode()).hexdigest()[:16]
+
+
+def _write_manifest(snapshot_id, manifest):
+    path = os.path.join(_snapshot_dir(snapshot_id), "manifest.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def manifest(snapshot_id):
+    """
+    Return the manifest of a snapshot, a dictionary with its name, source (data_source, table or query),
+    watermark_column, key_columns, watermark (the SQL literal of the largest watermark copied so far),
+    partitions (file and rows of every Parquet partition, oldest first), rows (copied so far),
+    truncated (a snapshot without watermark column that has only the first rows of its source)
+    and refreshed_at (a unix timestamp, None before the first refresh)
+    """
+    try:
+        with open(os.path.join(_snapshot_dir(snapshot_id), "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError("The snapshot does not exist anymore")
+
+
+def create(name, data_source, db_config, table=None, query=None, watermark_column=None, key_columns=None):
+    """
+    Create an empty snapshot of a table (or of the result of a query), refresh() copies the rows.
+    With a watermark column (e.g an auto increment id or an updated at timestamp) every refresh only copies
+    the rows whose watermark is larger than the largest one copied before, otherwise every refresh copies
+    everything again. Rows that are copied again because they changed replace the older copies of the rows
+    with the same key_columns when the snapshot is queried.
+    Returns the data the browser keeps for the snapshot: its snapshot_id and name.
+    """
+    if not name or not _NAME.fullmatch(name):
+        raise ValueError("The name of a snapshot can only have letters, digits and underscores")
+    if name == "data":
+        raise ValueError('"data" is the name of the uploaded file')
+    if not table and not (query or "").strip():
+        raise ValueError("Select a table or write a query to snapshot")
+
+    prune()
+    snapshot_id = uuid.uuid4().hex
+    os.makedirs(_snapshot_dir(snapshot_id))
+    _write_manifest(
+        snapshot_id,
+        {
+            "name": name,
+            "data_source": data_source,
+            "identity": _identity(data_source, db_config),
+            "table": table or None,
+            "query": None if table else query,
+            "watermark_column": watermark_column or None,
+            "key_columns": list(key_columns or []),
+            "watermark": None,
+            "partitions": [],
+            "next_partition": 0,
+            "obsolete": [],
+            "rows": 0,
+            "truncated": False,
+            "refreshed_at": None,
+        },
+    )
+    return {"snapshot_id": snapshot_id, "name": name}
+
+
+@contextmanager
+def _refreshing(snapshot_id):
+    with open(os.path.join(_snapshot_dir(snapshot_id), "lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ValueError("The snapshot is being refreshed already")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def remove(snapshot_id):
+    """
+    Delete a snapshot with its partitions and manifest, a snapshot can't be removed while it is refreshed
+    """
+    path = _snapshot_dir(snapshot_id)
+    if not os.path.isdir(path):
+        return
+    try:
+        with _refreshing(snapshot_id):
+            shutil.rmtree(path)
+    except ValueError:
+        raise ValueError("The snapshot is being refreshed, remove it when the refresh finishes")
+
+
+def mark_used(snapshot_ids):
+    """
+    Record that the snapshots are still listed or queried by a browser, see prune()
+    """
+    for snapshot_id in snapshot_ids:
+        path = os.path.join(_snapshot_dir(snapshot_id), "used")
+        try:
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except FileNotFoundError:
+            # The snapshot was removed
+            pass
+
+
+def prune():
+    """
+    Remove the snapshots that no browser listed or queried for config.snapshot_max_idle_age seconds,
+    the browsers keep the ids of their snapshots and the server can't tell when they are forgotten
+    """
+    if not os.path.isdir(config.snapshot_dir):
+        return
+    oldest = time.time() - config.snapshot_max_idle_age
+    for entry in os.scandir(config.snapshot_dir):
+        if not entry.is_dir() or not re.fullmatch(r"[a-f0-9]+", entry.name):
+            continue
+        last_used = entry.stat().st_mtime
+        for name in ("manifest.json", "used"):
+            try:
+                last_used = max(last_used, os.stat(os.path.join(entry.path, name)).st_mtime)
+            except FileNotFoundError:
+                pass
+        if last_used >= oldest:
+            continue
+        try:
+            remove(entry.name)
+        except (ValueError, OSError):
+            # Being refreshed, or removed by another process
+            pass
+
+
+def _quote(identifier, quote):
+    return quote + str(identifier).replace(quote, quote * 2) + quote
+
+
+def _literal(value):
+    """
+    Return the SQL literal of a watermark value
+    """
+    if isinstance(value, (bool, np.bool_)):
+        raise ValueError("The watermark column must be a number, a date or a timestamp")
+    if isinstance(value, (int, float, decimal.Decimal, np.integer, np.floating)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return f"'{value.isoformat(sep=' ')}'"
+    if isinstance(value, datetime.date):
+        return f"'{value.isoformat()}'"
+    raise ValueError("The watermark column must be a number, a date or a timestamp")
+
+
+def _source_query(snapshot, quote):
+    if snapshot["table"]:
+        query = f"SELECT * FROM {_quote(snapshot['table'], quote)}"
+    else:
+        query = f"SELECT * FROM {subquery(snapshot['query'], 'snapshot_source')}"
+    watermark_column = snapshot["watermark_column"]
+    if watermark_column is None:
+        return query
+    if snapshot["watermark"] is not None:
+        query += f" WHERE {_quote(watermark_column, quote)} > {snapshot['watermark']}"
+    return query + f" ORDER BY {_quote(watermark_column, quote)}"
+
+
+def _write_partition(snapshot_id, snapshot, df):
+    name = f"part-{snapshot['next_partition']:06d}.parquet"
+    path = os.path.join(_snapshot_dir(snapshot_id), name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    snapshot["next_partition"] += 1
+    return {"file": name, "rows": len(df)}
+
+
+def refresh(snapshot_id, data_source, db_config, query_token=None, on_progress=None):
+    """
+    Copy the new rows of the source of a snapshot, in partitions of at most config.snapshot_partition_rows rows.
+    The partitions are compacted into one when there are more than config.snapshot_max_partitions.
+    on_progress, if given, is called with the rows copied so far.
+    Returns a tuple that contains:
+    0. The manifest of the snapshot
+    1. The number of rows that were copied
+    """
+    with _refreshing(snapshot_id):
+        snapshot = manifest(snapshot_id)
+        if snapshot["data_source"] != data_source or snapshot["identity"] != _identity(data_source, db_config):
+            raise ValueError(f"Connect to the database of the snapshot {snapshot['name']} to refresh it")
+
+        # Files replaced by the last refresh were kept for the queries that were reading them
+        for name in snapshot["obsolete"]:
+            try:
+                os.remove(os.path.join(_snapshot_dir(snapshot_id), name))
+            except FileNotFoundError:
+                pass
+        snapshot["obsolete"] = []
+
+        stream_query_func = config.database_stream_functions[data_source]
+        quote = config.database_sql_dialects[data_source]["quote"]
+        watermark_column = snapshot["watermark_column"]
+        if watermark_column is None:
+            # Everything is copied again
+            snapshot["obsolete"] = [partition["file"] for partition in snapshot["partitions"]]
+            snapshot["partitions"] = []
+            snapshot["rows"] = 0
+
+        copied = 0
+        while True:
+            df, truncated = stream_query_func(
+                db_config,
+                _source_query(snapshot, quote),
+                config.snapshot_partition_rows,
+                config.query_max_bytes,
+                query_token=query_token,
+            )
+            if watermark_column is not None and len(df):
+                if watermark_column not in df.columns:
+                    raise ValueError(f"The source of the snapshot has no column {watermark_column}")
+                if truncated:
+                    # The rows with the last watermark may continue past the partition, they go in the next one
+                    last = df[watermark_column].max()
+                    df = df[df[watermark_column] < last]
+                    if not len(df):
+                        raise ValueError(
+                            f"More than {config.snapshot_partition_rows:,} rows have the same {watermark_column}"
+                        )
+                watermark = df[watermark_column].dropna().max()
+                if not pd.isna(watermark):
+                    snapshot["watermark"] = _literal(watermark)
+
+            if len(df) or not snapshot["partitions"]:
+                snapshot["partitions"].append(_write_partition(snapshot_id, snapshot, df))
+            copied += len(df)
+            snapshot["rows"] += len(df)
+            if on_progress is not None:
+                on_progress(copied)
+            if not truncated or watermark_column is None:
+                break
+
+        snapshot["truncated"] = watermark_column is None and truncated
+        if len(snapshot["partitions"]) > config.snapshot_max_partitions:
+            _compact(snapshot_id, snapshot)
+        snapshot["refreshed_at"] = time.time()
+        _write_manifest(snapshot_id, snapshot)
+    return snapshot, copied
+
+
+def _view_sql(snapshot_id, snapshot):
+    files = [os.path.join(_snapshot_dir(snapshot_id), partition["file"]) for partition in snapshot["partitions"]]
+    file_list = "[" + ", ".join("'" + path.replace("'", "''") + "'" for path in files) + "]"
+    if not snapshot["key_columns"]:
+        return f"SELECT * FROM read_parquet({file_list}, union_by_name = true)"
+
+    # The partitions are named in the order they were written, the last copy of a row is the current one
+    keys = ", ".join(_quote(column, '"') for column in snapshot["key_columns"])
+    return (
+        f"SELECT * EXCLUDE (filename) FROM read_parquet({file_list}, union_by_name = true, filename = true) "
+        f"QUALIFY row_number() OVER (PARTITION BY {keys} ORDER BY filename DESC) = 1"
+    )
+
+
+def _compact(snapshot_id, snapshot):
+    """
+    Rewrite the partitions of a snapshot as one, without the older copies of the rows
+    """
+    import duckdb
+
+    partition = {"file": f"part-{snapshot['next_partition']:06d}.parquet"}
+    path = os.path.join(_snapshot_dir(snapshot_id), partition["file"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    conn = duckdb.connect(database=":memory:")
+    try:
+        conn.execute(f"COPY ({_view_sql(snapshot_id, snapshot)}) TO '{tmp_path}' (FORMAT PARQUET)")
+        partition["rows"] = conn.execute(f"SELECT count(*) FROM read_parquet('{tmp_path}')").fetchone()[0]
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    snapshot["next_partition"] += 1
+    snapshot["obsolete"] += [old["file"] for old in snapshot["partitions"]]
+    snapshot["partitions"] = [partition]
+    snapshot["rows"] = partition["rows"]
+
+
+def views(snapshot_ids):
+    """
+    Return the (name, SQL) of the views that the snapshots are queried with,
+    snapshots that don't exist anymore are left out
+    """
+    mark_used(snapshot_ids)
+    snapshot_views = []
+    for snapshot_id in snapshot_ids:
+        try:
+            snapshot = manifest(snapshot_id)
+        except ValueError:
+            continue
+        if snapshot["partitions"]:
+            snapshot_views.append((snapshot["name"], _view_sql(snapshot_id, snapshot)))
+    return snapshot_views
@@ -0,0 +1,210 @@
+import json
+import math
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# DataTable filter operators and their SQL equivalent
+FILTER_OPERATORS = [
+    ["ge ", ">="],
+    ["le ", "<="],
+    ["lt ", "<"],
+    ["gt ", ">"],
+    ["ne ", "!="],
+    ["eq ", "="],
+    ["contains "],
+    ["datestartswith "],
+]
+SQL_OPERATORS = {"ge": ">=", "le": "<=", "lt": "<", "gt": ">", "ne": "<>", "eq": "="}
+# The semicolon that ends a query, with the line comments after it
+_QUERY_END = re.compile(r";(?:\s*(?:--|#)[^\n]*)*\s*$")
+
+# Filtered and sorted row positions of the most recently viewed tables,
+# so that moving to the next page doesn't sort the whole result again
+MAX_CACHED_VIEWS = 8
+_views = OrderedDict()
+_views_lock = threading.Lock()
+
+
+def split_filter_part(filter_part):
+    """
+    Split one part of a DataTable filter query (e.g "{price} ge 10")
+    and return a tuple with the column name, the operator and the value
+    """
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find("{") + 1 : name_part.rfind("}")]
+
+                value_part = value_part.strip()
+                if not value_part:
+                    # e.g "{col} contains " while the user is still typing, the filter is ignored
+                    return [None] * 3
+                v0 = value_part[0]
+                if v0 == value_part[-1] and v0 in ("'", '"', "`"):
+                    value = value_part[1:-1].replace("\\" + v0, v0)
+                elif operator_type[0] in ("contains ", "datestartswith "):
+                    # Text operators match the value as it was typed, e.g 2024 and not 2024.0
+                    value = value_part
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                # word operators need spaces after them in the filter string,
+                # but we don't want these later
+                return name, operator_type[0].strip(), value
+
+    return [None] * 3
+
+
+def parse_filter_query(filter_query):
+    """
+    Return a list with the (column, operator, value) of each part of a filter query
+    """
+    if not filter_query:
+        return []
+    filters = []
+    for filter_part in filter_query.split(" && "):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name is not None:
+            filters.append((col_name, operator, filter_value))
+    return filters
+
+
+def _filter_mask(df, filters):
+    columns = {str(col): col for col in df.columns}
+    mask = np.ones(len(df), dtype=bool)
+    for col_name, operator, filter_value in filters:
+        if col_name not in columns:
+            continue
+        column = df[columns[col_name]]
+        if operator in SQL_OPERATORS:
+            try:
+                condition = getattr(column, operator)(filter_value)
+            except TypeError:
+                # e.g "{price} lt abc", nothing can match
+                mask[:] = False
+                continue
+        elif operator == "contains":
+            condition = column.astype(str).str.contains(str(filter_value), regex=False)
+        else:
+            condition = column.astype(str).str.startswith(str(filter_value))
+        mask &= condition.to_numpy(dtype=bool, na_value=False)
+    return mask
+
+
+def _view_positions(df, result_id, sort_by, filter_query):
+    """
+    Return the row positions of df after filtering and sorting it,
+    or None if the table is neither filtered nor sorted
+    """
+    if not sort_by and not filter_query:
+        return None
+
+    key = (result_id, json.dumps(sort_by, sort_keys=True), filter_query)
+    with _views_lock:
+        positions = _views.get(key)
+        if positions is not None:
+            _views.move_to_end(key)
+            return positions
+
+    filters = parse_filter_query(filter_query)
+    if filters:
+        positions = np.flatnonzero(_filter_mask(df, filters))
+    else:
+        positions = np.arange(len(df))
+
+    columns = {str(col): col for col in df.columns}
+    sort_by = [sort for sort in sort_by or [] if sort["column_id"] in columns]
+    if sort_by:
+        sort_columns = [columns[sort["column_id"]] for sort in sort_by]
+        keys = df[sort_columns].iloc[positions].reset_index(drop=True)
+        order = keys.sort_values(
+            sort_columns,
+            ascending=[sort["direction"] == "asc" for sort in sort_by],
+            kind="mergesort",
+            na_position="last",
+        ).index.to_numpy()
+        positions = positions[order]
+
+    with _views_lock:
+        _views[key] = positions
+        while len(_views) > MAX_CACHED_VIEWS:
+            _views.popitem(last=False)
+    return positions
+
+
+def get_page(df, result_id, page_current, page_size, sort_by, filter_query):
+    """
+    Filter, sort and slice a stored result and return a tuple with:
+    0. A dataframe with the rows of the requested page
+    1. The number of pages after filtering
+    """
+    positions = _view_positions(df, result_id, sort_by, filter_query)
+    total_rows = len(df) if positions is None else len(positions)
+    start = page_current * page_size
+    end = start + page_size
+    if positions is None:
+        page = df.iloc[start:end]
+    else:
+        page = df.iloc[positions[start:end]]
+    return page, max(math.ceil(total_rows / page_size), 1)
+
+
+def quote_identifier(name, quote):
+    return quote + str(name).replace(quote, quote * 2) + quote
+
+
+def subquery(query, alias):
+    """
+    Return a query as a subquery named alias. The query is on lines of its own, a line comment at its end
+    (e.g "-- top customers") doesn't comment out the closing parenthesis.
+    """
+    return f"(\n{_QUERY_END.sub('', query.strip())}\n) AS {alias}"
+
+
+def _like_literal(value):
+    # The text of the user is matched as it is, ! escapes the wildcards of LIKE (see the ESCAPE clauses)
+    return str(value).replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+
+def build_page_query(table_name, sort_by, filter_query, page_current, page_size, dialect):
+    """
+    Build the sql query that returns one page of a database table,
+    pushing the filtering and sorting of the DataTable down to the database.
+    One more row than page_size is requested to know if there is a next page.
+    Returns a tuple with the query and its parameters.
+    """
+    quote = dialect["quote"]
+    placeholder = dialect["placeholder"]
+    text_type = dialect["text_type"]
+    conditions = []
+    params = []
+    for col_name, operator, filter_value in parse_filter_query(filter_query):
+        column = quote_identifier(col_name, quote)
+        if operator in SQL_OPERATORS:
+            conditions.append(f"{column} {SQL_OPERATORS[operator]} {placeholder}")
+            params.append(filter_value)
+        elif operator == "contains":
+            conditions.append(f"CAST({column} AS {text_type}) LIKE {placeholder} ESCAPE '!'")
+            params.append(f"%{_like_literal(filter_value)}%")
+        else:
+            conditions.append(f"CAST({column} AS {text_type}) LIKE {placeholder} ESCAPE '!'")
+            params.append(f"{_like_literal(filter_value)}%")
+
+    query = f"SELECT * FROM {quote_identifier(table_name, quote)}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if sort_by:
+        order_by = [
+            f"{quote_identifier(sort['column_id'], quote)} {'ASC' if sort['direction'] == 'asc' else 'DESC'}"
+            for sort in sort_by
+        ]
+        query += " ORDER BY " + ", ".join(order_by)
+    query += f" LIMIT {int(page_size) + 1} OFFSET {int(page_current) * int(page_size)}"
+    return query, params
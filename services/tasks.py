@@ -0,0 +1,206 @@
+import os
+import re
+
+import pandas as pd
+
+import config
+from services import admission
+from services import datasets
+from services import figure_export
+from services import jobs
+from services import query_cache
+from services import result_store
+from services import script_runner
+from services import snapshots
+
+_SQL_QUERY = re.compile(r"\s*(select|with|from)\b", re.IGNORECASE)
+
+
+def run_database_query(job_id, data_source, db_config, query, query_token, source_table=None):
+    """
+    Background job that runs a query on a database and stores its result.
+    Returns a dictionary with:
+    0. result: The result_store data of the result
+    1. freshness: The freshness token of the tables the query read, from before it ran
+    """
+
+    def on_batch(rows, size):
+        jobs.report_progress(job_id, f"{rows:,} rows loaded")
+
+    try:
+        query_freshness = query_cache.freshness(data_source, db_config, query)
+    except Exception:
+        query_freshness = None
+
+    stream_query_func = config.database_stream_functions[data_source]
+    with admission.slot(job_id, data_source, db_config):
+        df, truncated = stream_query_func(
+            db_config,
+            query,
+            config.query_max_rows,
+            config.query_max_bytes,
+            query_token=query_token,
+            on_batch=on_batch,
+        )
+    metadata = {"truncated": truncated}
+    if source_table is not None:
+        # Sorting, filtering and aggregating a table preview is pushed down to the whole table
+        metadata["source_table"] = source_table
+    else:
+        # Plots can aggregate all the rows of the query, not only the loaded ones
+        metadata["source_query"] = query
+    data = result_store.put(df, keep_in_memory=not jobs.in_job_process(), **metadata)
+    return {"result": data, "freshness": query_freshness}
+
+
+def run_table_sample(job_id, data_source, db_config, table, sample_size, row_estimate, query_token):
+    """
+    Background job that reads a random sample of a database table and stores it.
+    Returns a dictionary with the result_store data of the sample (result), samples are not cached.
+    """
+
+    def on_batch(rows, kept_rows):
+        jobs.report_progress(job_id, f"Sampling the table, {rows:,} rows read")
+
+    sample_table_func = config.database_sample_functions[data_source]
+    with admission.slot(job_id, data_source, db_config):
+        df, method = sample_table_func(
+            db_config,
+            table,
+            sample_size,
+            row_estimate,
+            config.preview_scan_max_rows,
+            query_token=query_token,
+            on_batch=on_batch,
+        )
+    # Sorting, filtering and aggregating the sample are pushed down to the whole table, like a table preview
+    data = result_store.put(
+        df,
+        keep_in_memory=not jobs.in_job_process(),
+        source_table=table,
+        sample={"method": method, "estimated_rows": row_estimate},
+    )
+    return {"result": data}
+
+
+def run_file_query(job_id, data_source, file_config, query):
+    """
+    Background job that runs a query on an uploaded csv/excel file and the local snapshots and stores the result.
+    file_config is a dictionary with the dataset_id of the file (None if no file was uploaded)
+    and the ids of the snapshots (snapshots).
+    SQL queries run on the embedded engine of config.database_stream_functions,
+    anything else (or every query when there is no engine) is a pandas DataFrame.query filter of the file.
+    Returns a dictionary with the result_store data of the result (result).
+    """
+
+    def on_batch(rows, size):
+        jobs.report_progress(job_id, f"{rows:,} rows loaded")
+
+    stream_query_func = config.database_stream_functions.get(data_source)
+    if stream_query_func is None or not _SQL_QUERY.match(query):
+        if file_config["dataset_id"] is None:
+            raise ValueError("Only SQL queries can run on the snapshots")
+        df = datasets.load(file_config["dataset_id"])
+        jobs.report_progress(job_id, f"Filtering {len(df):,} rows")
+        df = df.query(query)
+        return {"result": result_store.put(df, keep_in_memory=not jobs.in_job_process())}
+
+    df, truncated = stream_query_func(
+        file_config,
+        query,
+        config.query_max_rows,
+        config.query_max_bytes,
+        on_batch=on_batch,
+    )
+    # Plots can aggregate all the rows of the query on the file, not only the loaded ones
+    data = result_store.put(
+        df,
+        keep_in_memory=not jobs.in_job_process(),
+        truncated=truncated,
+        source_query=query,
+        file_config=file_config,
+    )
+    return {"result": data}
+
+
+def store_dataset(job_id, dataset_id):
+    """
+    Background job that stores an uploaded dataset as the result that the table and the plots show.
+    When the results are spilled as arrow the file of the dataset is the stored result as it is,
+    otherwise the dataset is loaded here and spilled with the serializer of the results.
+    Returns a dictionary with the result_store data of the dataset (result).
+    """
+    if result_store.stores_files():
+        return {"result": result_store.put_file(datasets.file_path(dataset_id))}
+    df = datasets.load(dataset_id)
+    return {"result": result_store.put(df, keep_in_memory=not jobs.in_job_process())}
+
+
+def ingest_upload(job_id, path, filename):
+    """
+    Background job that converts a finished chunked upload (see services.uploads) to a dataset, the file is removed.
+    Returns a dictionary with the data of the dataset (dataset), see datasets.create().
+    """
+    try:
+        if "csv" in filename:
+            dataset = datasets.ingest_csv(path, filename)
+        else:
+            # Excel files can't be read in blocks
+            dataset = datasets.create(pd.read_excel(path), filename)
+    except ValueError:
+        raise
+    except Exception:
+        raise ValueError("There was an error processing this file.")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return {"dataset": dataset}
+
+
+def refresh_snapshot(job_id, snapshot_id, data_source, db_config, query_token):
+    """
+    Background job that copies the new rows of the source table (or query) of a snapshot, see snapshots.refresh().
+    Returns a dictionary with the name of the snapshot (name), the rows that were copied (rows)
+    and the rows of the snapshot (total_rows).
+    """
+
+    def on_progress(rows):
+        jobs.report_progress(job_id, f"{rows:,} rows copied")
+
+    with admission.slot(job_id, data_source, db_config):
+        snapshot, rows = snapshots.refresh(snapshot_id, data_source, db_config, query_token, on_progress)
+    return {"name": snapshot["name"], "rows": rows, "total_rows": snapshot["rows"]}
+
+
+def run_script(job_id, data_source, db_config, script, query_token):
+    """
+    Background job that runs the statements of a script, the independent ones in parallel.
+    Returns a dictionary with the outcome of every statement (statements), see script_runner.run_script().
+    """
+
+    def on_progress(finished, total):
+        jobs.report_progress(job_id, f"{finished} of {total} statements finished")
+
+    # Every connection of the script takes a slot, the script runs on as many connections as it got slots
+    connections = script_runner.connections_needed(data_source, script)
+    with admission.slot(job_id, data_source, db_config, connections) as granted:
+        statements = script_runner.run_script(
+            data_source,
+            db_config,
+            script,
+            query_token,
+            on_progress,
+            keep_in_memory=not jobs.in_job_process(),
+            max_connections=granted,
+        )
+    return {"statements": statements}
+
+
+def export_figures(job_id, exports):
+    """
+    Background job that renders figures to files, see figure_export.render(). Several figures are zipped together.
+    Returns the name of the exported file.
+    """
+    if len(exports) == 1:
+        return figure_export.render(**exports[0])
+    return figure_export.render_batch(exports)
@@ -0,0 +1,122 @@
+import os
+import re
+import time
+
+import flask
+
+import config
+from services import jobs
+from services import tasks
+
+# Size of the pieces that a chunk is streamed to disk in
+WRITE_SIZE = 1024 * 1024
+# Unfinished uploads older than this (in seconds) are removed
+STALE_UPLOAD_AGE = 24 * 60 * 60
+
+
+def _path(upload_id):
+    if not re.fullmatch(r"[a-f0-9]{16,64}", upload_id):
+        flask.abort(400, "Invalid upload id")
+    uploads_dir = os.path.join(config.shared_state_dir, "uploads")
+    os.makedirs(uploads_dir, exist_ok=True)
+    return os.path.join(uploads_dir, f"{upload_id}.part")
+
+
+def _received(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def received(upload_id):
+    """
+    Return how many bytes of an upload the server has, the client resumes the upload from there
+    """
+    return flask.jsonify(received=_received(_path(upload_id)))
+
+
+def append_chunk(upload_id):
+    """
+    Write the body of the request at the offset given in the query string.
+    A chunk can be sent again (e.g after a network error) but chunks can't skip bytes.
+    """
+    path = _path(upload_id)
+    offset = flask.request.args.get("offset", type=int)
+    size = _received(path)
+    if offset is None or offset > size:
+        return flask.jsonify(received=size), 409
+
+    with open(path, "r+b" if size else "wb") as f:
+        f.seek(offset)
+        while True:
+            data = flask.request.stream.read(WRITE_SIZE)
+            if not data:
+                break
+            f.write(data)
+        f.truncate()
+        size = f.tell()
+    return flask.jsonify(received=size)
+
+
+def complete(upload_id):
+    """
+    Start the background job that converts a finished upload to a dataset and return its job id (or an error)
+    as json. Large files take longer to convert than a web request can last, the client polls the job.
+    """
+    path = _path(upload_id)
+    filename = (flask.request.get_json(silent=True) or {}).get("filename", "")
+    _remove_stale_uploads(os.path.dirname(path))
+    if "csv" not in filename and "xls" not in filename:
+        if os.path.exists(path):
+            os.remove(path)
+        return flask.jsonify(error="File is not in csv of xls format"), 400
+
+    # The finished file is moved away from the chunks, so it can't be appended to while it is converted
+    ready_path = f"{path[: -len('.part')]}.ready"
+    try:
+        os.replace(path, ready_path)
+    except FileNotFoundError:
+        return flask.jsonify(error="The upload does not exist, please upload the file again"), 400
+    return flask.jsonify(job_id=jobs.submit(tasks.ingest_upload, ready_path, filename))
+
+
+def conversion(job_id):
+    """
+    Return the state of the job that converts an upload as json: its progress while it runs,
+    then the dataset data (dataset) or the error (error)
+    """
+    if not re.fullmatch(r"[a-f0-9]+", job_id):
+        flask.abort(400, "Invalid job id")
+    status = jobs.status(job_id)
+    if status["state"] in ("queued", "running"):
+        return flask.jsonify(state=status["state"], progress=status.get("progress"))
+    jobs.forget(job_id)
+    if status["state"] == "done":
+        return flask.jsonify(state="done", dataset=status["result"]["dataset"])
+    return flask.jsonify(state="error", error=status.get("error", "The file was not converted"))
+
+
+def _remove_stale_uploads(uploads_dir):
+    now = time.time()
+    for entry in os.scandir(uploads_dir):
+        try:
+            if now - entry.stat().st_mtime > STALE_UPLOAD_AGE:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def register_routes(server):
+    """
+    Add the routes of the resumable chunked upload of large files to the flask server:
+    GET /uploads/<upload_id> returns the bytes received so far,
+    PUT /uploads/<upload_id>?offset=<n> writes a chunk,
+    POST /uploads/<upload_id>/complete starts the job that converts the file to a dataset,
+    GET /uploads/jobs/<job_id> returns the state of that job.
+    The client requests them under the path prefix of the app (requests_pathname_prefix), like the export links.
+    """
+    server.add_url_rule("/uploads/<upload_id>", "upload_received", received, methods=["GET"])
+    server.add_url_rule("/uploads/<upload_id>", "upload_append_chunk", append_chunk, methods=["PUT"])
+    server.add_url_rule("/uploads/<upload_id>/complete", "upload_complete", complete, methods=["POST"])
+    server.add_url_rule("/uploads/jobs/<job_id>", "upload_conversion", conversion, methods=["GET"])